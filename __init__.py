@@ -7,3 +7,8 @@ api_keys = {}
 # Server for our geocoders and layers
 server_url = "http://localhost:8000"
 
+# Format in which to request vector tiles from that server, "geojson"
+# or "mvt". Servers older than the Mapbox Vector Tile support can only
+# send GeoJSON.
+vector_tile_format = "geojson"
+
@@ -7,6 +7,9 @@ import math
 
 # Add a string of line segments to the path.
 def line_string(ctx, points):
+	if hasattr(points, "add_to_path"):	# PackedPoints
+		points.add_to_path(ctx)
+		return
 	if len(points) < 1:		# empty line?
 		return
 	point = points[0]
@@ -1,28 +1,31 @@
 # pykarta/formats/mbtiles.py
 # Copyright 2013, 2014, Trinity College
-# Last modified: 24 January 2013
+# Last modified: 31 May 2018
 
 import sqlite3
 
+# If the MBTiles file already exists, tiles are added to it (replacing
+# any with the same coordinates). This allows an interrupted run of
+# MapTilegen to be resumed.
 class MapMbtilesWriter(object):
 	def __init__(self, mbtiles, metadata):
 		self.conn = sqlite3.connect(mbtiles)
 		self.cursor = self.conn.cursor()
 
-		self.cursor.execute("CREATE TABLE metadata (name text, value text)")
-		self.cursor.execute("CREATE UNIQUE INDEX metadata_index on metadata (name)")
-		self.cursor.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
-		self.cursor.execute("CREATE UNIQUE INDEX tile_index on tiles (zoom_level, tile_column, tile_row)")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_index on metadata (name)")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index on tiles (zoom_level, tile_column, tile_row)")
 
 		for name, value in metadata.items():
-			self.cursor.execute("INSERT INTO metadata (name, value) values (?, ?)", (name, value))
+			self.cursor.execute("INSERT OR REPLACE INTO metadata (name, value) values (?, ?)", (name, value))
 
 		self.count = 0
 
 	def add_tile(self, zoom, x, y, tile_data):
 		flipped_y = (2**zoom-1) - y
 		self.cursor.execute(
-			"INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?)",
+			"INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?)",
 			#(zoom, x, flipped_y, sqlite3.Binary(tile_data))
 			(zoom, x, flipped_y, buffer(tile_data))
 			)
@@ -31,6 +34,9 @@ class MapMbtilesWriter(object):
 		if (self.count % 1000) == 0:
 			self.conn.commit()
 
+	def commit(self):
+		self.conn.commit()
+
 	def close(self):
 		print "%d tiles saved" % self.count
 		self.conn.commit()
@@ -0,0 +1,488 @@
+# pykarta/formats/mvt.py
+# Copyright 2018, Trinity College
+# Last modified: 31 May 2018
+#
+# Reader and writer for Mapbox Vector Tiles (version 2 of the spec)
+# https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+#
+# Geometry is stored as integer coordinates within the tile (0 to extent)
+# which are delta encoded and packed as varints, so these tiles are
+# several times smaller than GeoJSON and need no projection when loaded.
+#
+# Only the small part of Protocol Buffers which the spec needs is
+# implemented here, so the protobuf package is not required.
+#
+# MVT property values are scalars. Lists and dicts are stored as JSON
+# text. Other values which are not strings, numbers, or booleans are
+# rejected. MVT has no null either, so properties which are None are
+# left out. The reader puts them back by giving each feature all of the
+# keys of its layer, with None for those which it lacks, just as each
+# feature of a GeoJSON layer from our tile server has all of its columns.
+
+import struct
+import json
+
+try:
+	from collections import OrderedDict
+except ImportError:
+	from pykarta.fallback.ordereddict import OrderedDict
+
+from pykarta.geometry.projection import project_to_tilespace_pixels_flat
+
+try:
+	text_type = unicode
+	integer_types = (int, long)
+except NameError:		# Python 3
+	text_type = str
+	integer_types = (int,)
+
+# Geometry types
+MVT_POINT = 1
+MVT_LINESTRING = 2
+MVT_POLYGON = 3
+
+# Geometry commands
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_CLOSE_PATH = 7
+
+# Protocol Buffers wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_BYTES = 2
+WIRE_FIXED32 = 5
+
+MIME_TYPE = "application/vnd.mapbox-vector-tile"
+
+class MvtDecodeError(Exception):
+	pass
+
+#=============================================================================
+# Protocol Buffers primitives
+#=============================================================================
+
+def _zigzag(n):
+	return (n << 1) if n >= 0 else ((-n << 1) - 1)
+
+def _unzigzag(n):
+	return (n >> 1) ^ -(n & 1)
+
+def _write_varint(buf, n):
+	while n > 0x7F:
+		buf.append((n & 0x7F) | 0x80)
+		n >>= 7
+	buf.append(n)
+
+def _write_key(buf, field, wire_type):
+	_write_varint(buf, (field << 3) | wire_type)
+
+def _write_bytes(buf, field, data):
+	_write_key(buf, field, WIRE_BYTES)
+	_write_varint(buf, len(data))
+	buf.extend(data)
+
+def _write_string(buf, field, text):
+	if isinstance(text, text_type):
+		text = text.encode("utf-8")
+	_write_bytes(buf, field, text)
+
+def _write_packed(buf, field, values):
+	packed = bytearray()
+	for value in values:
+		_write_varint(packed, value)
+	_write_bytes(buf, field, packed)
+
+def _read_varint(data, pos):
+	result = 0
+	shift = 0
+	while True:
+		b = data[pos]
+		pos += 1
+		result |= (b & 0x7F) << shift
+		if b < 0x80:
+			return (result, pos)
+		shift += 7
+
+def _read_packed(data, pos, end):
+	values = []
+	append = values.append
+	while pos < end:
+		b = data[pos]
+		if b < 0x80:
+			append(b)
+			pos += 1
+		else:
+			# Two bytes hold any delta between points within the tile,
+			# so handle them here rather than in _read_varint().
+			b2 = data[pos+1]
+			if b2 < 0x80:
+				append((b & 0x7F) | (b2 << 7))
+				pos += 2
+			else:
+				value, pos = _read_varint(data, pos)
+				append(value)
+	return values
+
+# Yield (field number, wire type, value) for each field of the message
+# in data[pos:end]. The value of a length-delimited field is the
+# (start, end) of its contents.
+def _iter_fields(data, pos, end):
+	while pos < end:
+		key, pos = _read_varint(data, pos)
+		wire_type = key & 0x07
+		if wire_type == WIRE_VARINT:
+			value, pos = _read_varint(data, pos)
+		elif wire_type == WIRE_BYTES:
+			length, pos = _read_varint(data, pos)
+			value = (pos, pos + length)
+			pos += length
+		elif wire_type == WIRE_FIXED64:
+			value = bytes(data[pos:pos+8])
+			pos += 8
+		elif wire_type == WIRE_FIXED32:
+			value = bytes(data[pos:pos+4])
+			pos += 4
+		else:
+			raise MvtDecodeError("unsupported wire type %d" % wire_type)
+		yield (key >> 3, wire_type, value)
+	if pos != end:
+		raise MvtDecodeError("truncated message")
+
+#=============================================================================
+# Writer
+#
+# Features are supplied in GeoJSON form with coordinates in degrees. They
+# are projected into the tile and rounded to integers on the way in.
+#=============================================================================
+class MvtWriter(object):
+	def __init__(self, zoom, x, y, extent=4096):
+		self.zoom = zoom
+		self.x = x
+		self.y = y
+		self.extent = extent
+		self.buf = bytearray()
+
+	def add_layer(self, name, features):
+
+		# Sort each feature's geometry by type, since an MVT feature can
+		# have only one, and gather all of the coordinates of all of the
+		# features so that they can be projected at once.
+		flattened = []
+		coordinate_lists = []
+		for feature in features:
+			geometry = feature.get('geometry')
+			if geometry is None:
+				continue
+			parts = {}
+			_flatten_geometry(geometry, parts)
+			for geom_type in (MVT_POINT, MVT_LINESTRING, MVT_POLYGON):
+				geom_parts = parts.get(geom_type)
+				if geom_parts:
+					flattened.append((feature, geom_type, geom_parts))
+					coordinate_lists.extend([part[0] for part in geom_parts])
+		k = self.extent / 256.0
+		ints = [int(round(value * k)) for value in project_to_tilespace_pixels_flat(coordinate_lists, self.zoom, self.x, self.y)]
+
+		layer = bytearray()
+		_write_key(layer, 15, WIRE_VARINT)		# version
+		_write_varint(layer, 2)
+		_write_string(layer, 1, name)
+
+		keys = []
+		key_index = {}
+		values = []
+		value_index = {}
+
+		i = 0
+		for feature, geom_type, parts in flattened:
+			part_points = []
+			for coordinates, is_hole in parts:
+				n = len(coordinates) * 2
+				flat = ints[i:i+n]
+				i += n
+				part_points.append((list(zip(flat[0::2], flat[1::2])), is_hole))
+			geometry = _encode_geometry(geom_type, part_points)
+			if len(geometry) == 0:
+				continue
+
+			tags = []
+			for key, value in feature.get('properties', {}).items():
+				# Keys with only None values are still listed so that
+				# the reader knows about them.
+				index = key_index.get(key)
+				if index is None:
+					index = key_index[key] = len(keys)
+					keys.append(key)
+				if value is None:
+					continue
+				tags.append(index)
+				value = _scalar_value(key, value)
+				value_key = (type(value), value)
+				index = value_index.get(value_key)
+				if index is None:
+					index = value_index[value_key] = len(values)
+					values.append(value)
+				tags.append(index)
+
+			encoded_feature = bytearray()
+			id = feature.get('id')
+			if isinstance(id, integer_types) and id >= 0:
+				_write_key(encoded_feature, 1, WIRE_VARINT)
+				_write_varint(encoded_feature, id)
+			if len(tags) > 0:
+				_write_packed(encoded_feature, 2, tags)
+			_write_key(encoded_feature, 3, WIRE_VARINT)
+			_write_varint(encoded_feature, geom_type)
+			_write_packed(encoded_feature, 4, geometry)
+			_write_bytes(layer, 2, encoded_feature)
+
+		for key in keys:
+			_write_string(layer, 3, key)
+		for value in values:
+			_write_bytes(layer, 4, _encode_value(value))
+		_write_key(layer, 5, WIRE_VARINT)
+		_write_varint(layer, self.extent)
+
+		_write_bytes(self.buf, 3, layer)
+
+	def getvalue(self):
+		return bytes(self.buf)
+
+# Add the parts of a GeoJSON geometry to a dict of lists keyed by
+# MVT geometry type. Each part is (coordinates, is_hole).
+def _flatten_geometry(geometry, parts):
+	geometry_type = geometry['type']
+	if geometry_type == 'GeometryCollection':
+		for geometry2 in geometry['geometries']:
+			_flatten_geometry(geometry2, parts)
+		return
+	coordinates = geometry.get('coordinates')
+	if not coordinates:
+		return
+	if geometry_type == 'Point':
+		parts.setdefault(MVT_POINT, []).append(([coordinates], False))
+	elif geometry_type == 'MultiPoint':
+		parts.setdefault(MVT_POINT, []).extend([([point], False) for point in coordinates])
+	elif geometry_type == 'LineString':
+		parts.setdefault(MVT_LINESTRING, []).append((coordinates, False))
+	elif geometry_type == 'MultiLineString':
+		parts.setdefault(MVT_LINESTRING, []).extend([(line, False) for line in coordinates])
+	elif geometry_type == 'Polygon':
+		_flatten_polygon(coordinates, parts)
+	elif geometry_type == 'MultiPolygon':
+		for polygon in coordinates:
+			_flatten_polygon(polygon, parts)
+	else:
+		raise ValueError("unsupported geometry type: %s" % geometry_type)
+
+def _flatten_polygon(rings, parts):
+	polygon_parts = parts.setdefault(MVT_POLYGON, [])
+	for i, ring in enumerate(rings):
+		polygon_parts.append((ring, i > 0))
+
+# Turn lists of integer points into MVT geometry commands
+def _encode_geometry(geom_type, part_points):
+	commands = []
+	cursor_x = cursor_y = 0
+
+	if geom_type == MVT_POINT:
+		points = [points[0] for points, is_hole in part_points]
+		commands.append(CMD_MOVE_TO | (len(points) << 3))
+		for x, y in points:
+			commands.append(_zigzag(x - cursor_x))
+			commands.append(_zigzag(y - cursor_y))
+			cursor_x, cursor_y = x, y
+		return commands
+
+	for points, is_hole in part_points:
+
+		# Remove points which rounding has made into duplicates
+		deduped = [points[0]]
+		for point in points[1:]:
+			if point != deduped[-1]:
+				deduped.append(point)
+		points = deduped
+
+		if geom_type == MVT_POLYGON:
+			if len(points) > 1 and points[0] == points[-1]:
+				points.pop()		# implied by ClosePath
+			if len(points) < 3:
+				continue
+
+			# Exterior rings must have positive area (clockwise with y down),
+			# holes negative.
+			area = 0
+			prev_x, prev_y = points[-1]
+			for x, y in points:
+				area += prev_x * y - x * prev_y
+				prev_x, prev_y = x, y
+			if area == 0:
+				continue
+			if (area < 0) != is_hole:
+				points.reverse()
+
+		elif len(points) < 2:
+			continue
+
+		x, y = points[0]
+		commands.append(CMD_MOVE_TO | (1 << 3))
+		commands.append(_zigzag(x - cursor_x))
+		commands.append(_zigzag(y - cursor_y))
+		cursor_x, cursor_y = x, y
+		commands.append(CMD_LINE_TO | ((len(points) - 1) << 3))
+		for x, y in points[1:]:
+			commands.append(_zigzag(x - cursor_x))
+			commands.append(_zigzag(y - cursor_y))
+			cursor_x, cursor_y = x, y
+		if geom_type == MVT_POLYGON:
+			commands.append(CMD_CLOSE_PATH | (1 << 3))
+
+	return commands
+
+# MVT has no list or map values, so encode those as JSON.
+def _scalar_value(key, value):
+	if isinstance(value, (bool, float, text_type, bytes) + integer_types):
+		return value
+	if isinstance(value, (list, tuple, dict)):
+		return json.dumps(value, sort_keys=True, separators=(',', ':'))
+	raise TypeError("property %s: cannot store %s in a vector tile" % (key, type(value).__name__))
+
+def _encode_value(value):
+	buf = bytearray()
+	if isinstance(value, bool):
+		_write_key(buf, 7, WIRE_VARINT)
+		_write_varint(buf, int(value))
+	elif isinstance(value, integer_types):
+		if value >= 0:
+			_write_key(buf, 5, WIRE_VARINT)		# uint_value
+			_write_varint(buf, value)
+		else:
+			_write_key(buf, 6, WIRE_VARINT)		# sint_value
+			_write_varint(buf, _zigzag(value))
+	elif isinstance(value, float):
+		_write_key(buf, 3, WIRE_FIXED64)		# double_value
+		buf.extend(struct.pack("<d", value))
+	else:
+		if not isinstance(value, (text_type, bytes)):
+			value = text_type(value)
+		_write_string(buf, 1, value)
+	return buf
+
+#=============================================================================
+# Reader
+#=============================================================================
+class MvtTile(object):
+	def __init__(self, data):
+		self.layers = OrderedDict()
+		data = bytearray(data)
+		for field, wire_type, value in _iter_fields(data, 0, len(data)):
+			if field == 3:
+				layer = MvtLayer(data, *value)
+				self.layers[layer.name] = layer
+
+	def get(self, name, default=None):
+		return self.layers.get(name, default)
+
+	# For tiles which hold only one layer
+	def first_layer(self):
+		for layer in self.layers.values():
+			return layer
+		return None
+
+class MvtLayer(object):
+	def __init__(self, data, pos, end):
+		self.name = None
+		self.extent = 4096
+		self.features = []
+		keys = []
+		values = []
+		feature_ranges = []
+		for field, wire_type, value in _iter_fields(data, pos, end):
+			if field == 1:
+				self.name = bytes(data[value[0]:value[1]]).decode("utf-8")
+			elif field == 2:
+				feature_ranges.append(value)
+			elif field == 3:
+				keys.append(bytes(data[value[0]:value[1]]).decode("utf-8"))
+			elif field == 4:
+				values.append(_decode_value(data, *value))
+			elif field == 5:
+				self.extent = value
+		for start, stop in feature_ranges:
+			self.features.append(MvtFeature(data, start, stop, keys, values))
+
+class MvtFeature(object):
+	__slots__ = ('id', 'type', 'properties', 'geometry')
+
+	def __init__(self, data, pos, end, keys, values):
+		self.id = None
+		self.type = 0
+		self.properties = dict.fromkeys(keys)
+		self.geometry = []
+		for field, wire_type, value in _iter_fields(data, pos, end):
+			if field == 1:
+				self.id = value
+			elif field == 2:
+				tags = _read_packed(data, *value)
+				properties = self.properties
+				for i in range(0, len(tags) - 1, 2):
+					properties[keys[tags[i]]] = values[tags[i+1]]
+			elif field == 3:
+				self.type = value
+			elif field == 4:
+				self.geometry = _read_packed(data, *value)
+
+	# Decode the geometry commands. Returns a list of parts (points, lines,
+	# or rings), each a flat list of x, y, x, y... in tile coordinates
+	# multiplied by scale. Rings are closed by repeating the first point.
+	def get_parts(self, scale=1.0):
+		geometry = self.geometry
+		parts = []
+		part = None
+		x = y = 0
+		i = 0
+		n = len(geometry)
+		while i < n:
+			command = geometry[i]
+			i += 1
+			command_id = command & 0x07
+			count = command >> 3
+			if command_id == CMD_CLOSE_PATH:
+				if part is not None:
+					part.extend(part[0:2])
+				continue
+			if command_id != CMD_MOVE_TO and command_id != CMD_LINE_TO:
+				raise MvtDecodeError("unknown geometry command %d" % command_id)
+			for j in range(count):
+				dx = geometry[i]
+				dy = geometry[i+1]
+				i += 2
+				x += (dx >> 1) ^ -(dx & 1)
+				y += (dy >> 1) ^ -(dy & 1)
+				if command_id == CMD_MOVE_TO:
+					part = [x * scale, y * scale]
+					parts.append(part)
+				else:
+					part.append(x * scale)
+					part.append(y * scale)
+		return parts
+
+def _decode_value(data, pos, end):
+	value = None
+	for field, wire_type, field_value in _iter_fields(data, pos, end):
+		if field == 1:
+			value = bytes(data[field_value[0]:field_value[1]]).decode("utf-8")
+		elif field == 2:
+			value = struct.unpack("<f", field_value)[0]
+		elif field == 3:
+			value = struct.unpack("<d", field_value)[0]
+		elif field == 4:
+			value = field_value - (1 << 64) if field_value >= (1 << 63) else field_value
+		elif field == 5:
+			value = field_value
+		elif field == 6:
+			value = _unzigzag(field_value)
+		elif field == 7:
+			value = bool(field_value)
+	return value
+
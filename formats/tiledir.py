@@ -1,13 +1,13 @@
 # pykarta/formats/tiledir.py
 # Copyright 2013, 2014, Trinity College
-# Last modified: 2 September 2014
+# Last modified: 31 May 2018
 
 import os
 
 class MapTiledirWriter(object):
 	def __init__(self, output_dir):
 		self.output_dir = output_dir
-	def add_tile(self, x, y, zoom, tile_data):
+	def add_tile(self, zoom, x, y, tile_data):
 		dirname = "%s/%d/%d" % (self.output_dir, zoom, x)
 		filename = "%s/%d.png" % (dirname, y)
 		if not os.path.exists(dirname):
@@ -15,6 +15,8 @@ class MapTiledirWriter(object):
 		f = open(filename, "wb")
 		f.write(tile_data)
 		f.close()
+	def commit(self):
+		pass
 	def close(self):
 		pass
 
@@ -13,6 +13,7 @@ class GeocoderBing(GeocoderBase):
 	url_server = "dev.virtualearth.net"
 	url_path = "/REST/v1/Locations"
 	delay = 1.0			# no more than one request per second
+	metered = True
 
 	def __init__(self, **kwargs):
 		GeocoderBase.__init__(self, **kwargs)
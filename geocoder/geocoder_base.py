@@ -50,6 +50,8 @@ class GeocoderBase(object):
 	retry_limit = 5				# how many times to retry failed request
 	retry_delay = 10			# delay in seconds between retries
 	timeout = 30
+	metered = False				# do requests cost money or count against a quota?
+	cancel_event = None			# once this is set, requests are not sent (see GeocoderMulti)
 
 	def __init__(self, progress_dialog=None, debug=False):
 		self.progress_dialog = progress_dialog
@@ -127,6 +129,10 @@ class GeocoderBase(object):
 			self.debug("    remaining_delay: %f" % remaining_delay)
 			if remaining_delay > 0:
 				time.sleep(remaining_delay)
+
+			# The answer may no longer be wanted.
+			if self.cancel_event is not None and self.cancel_event.is_set():
+				raise GeocoderCancelled("%s request not sent" % self.name)
 			self.last_request_time = time.time()
 
 			for attempt in (1, 2):
@@ -221,6 +227,11 @@ class GeocoderBase(object):
 	def FindAddr(self, address, countrycode=None):
 		raise GeocoderUnimplemented
 
+	# Geocoders which can look up many addresses in one request
+	# override this to do so.
+	def FindAddrBatch(self, addresses, countrycode=None):
+		return [self.FindAddr(address, countrycode=countrycode) for address in addresses]
+
 	def FindStreet(self, street, city, state, countrycode=None):
 		raise GeocoderUnimplemented
 
@@ -259,6 +270,10 @@ class GeocoderError(Exception):
 	def __str__(self):
 		return self.message
 
+# Raised instead of sending a request which is no longer wanted
+class GeocoderCancelled(Exception):
+	pass
+
 # For methods which a particular geocoder does not implement.
 class GeocoderUnimplemented(GeocoderError):
 	pass
@@ -13,6 +13,7 @@ class GeocoderGoogle(GeocoderBase):
 	url_server = "maps.google.com"
 	url_path = "/maps/api/geocode/xml"
 	delay = 0.2		# no more than 5 requests per second
+	metered = True
 
 	# Send the query to the Google geocoder while taking care of
 	# pacing the request rate.
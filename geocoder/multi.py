@@ -3,9 +3,10 @@
 # Copyright 2013--2018, Trinity College Computing Center
 # Last modified: 15 May 2018
 
-import os
-from pykarta.misc import file_age_in_days, get_cachedir
-from .geocoder_base import GeocoderBase, GeocoderResult, GeocoderError
+import os, time
+import threading
+from pykarta.misc import get_cachedir
+from .geocoder_base import GeocoderBase, GeocoderResult, GeocoderError, GeocoderCancelled
 
 # Import the geocoders
 from .spreadsheet import GeocoderSpreadsheet
@@ -20,11 +21,22 @@ from .uscensus import GeocoderUsCensus
 # This geocoder is a wrapper for a list of actual geocoders. It calls them
 # in sequence until one of them finds the requested information.
 # It also caches the result.
+#
+# If concurrent=True is passed, the geocoders are all started at once,
+# each in its own thread. The results are still considered in the order
+# of the list, so the answer is the same as when they are called in
+# sequence, but a geocoder which misses no longer delays the next one.
+# Each geocoder handles only one request at a time, so each still
+# observes its own delay between requests. Metered geocoders (such as
+# Bing) are held back until all of those before them have answered
+# without a good match, so they are not asked unless they would be
+# asked in sequential mode.
 #=============================================================================
 class GeocoderMulti(GeocoderBase):
 
-	def __init__(self, **kwargs):
+	def __init__(self, concurrent=False, **kwargs):
 		GeocoderBase.__init__(self, **kwargs)
+		self.concurrent = concurrent
 		self.cache = GeocoderCache(**kwargs)
 		self.geocoders = [
 			(GeocoderSpreadsheet(**kwargs), True),
@@ -36,6 +48,13 @@ class GeocoderMulti(GeocoderBase):
 			#(GeocoderMassGIS(**kwargs), True),
 			(GeocoderUsCensus(**kwargs), True),
 			]
+		self.geocoder_locks = [threading.Lock() for i in self.geocoders]
+
+		# In concurrent mode the geocoders run in other threads, so only
+		# this object may talk to the progress dialog.
+		if concurrent:
+			for geocoder, stop_on_interpolated in self.geocoders:
+				geocoder.progress_dialog = None
 
 	# Query the geocoders and cache the answers
 	def FindAddr(self, address, countrycode=None, bypass_cache=False):
@@ -57,19 +76,20 @@ class GeocoderMulti(GeocoderBase):
 		# Run each geocoder in turn until we find a good-quality match.
 		# If all we can get is an interpolated match, take the first one.
 		best = None
-		i = 0
-		for geocoder, stop_on_interpolated in self.geocoders:
-			self.debug("Trying: %s..." % geocoder.name)
-			self.progress(i, len(self.geocoders), _("Trying %s...") % geocoder.name)
-			iresult = geocoder.FindAddr(address, countrycode=countrycode)
-			self.debug("")
-			if iresult.coordinates is not None:
-				best = (geocoder, iresult)
-				if stop_on_interpolated or iresult.precision != "INTERPOLATED":
-					break		# good enough
-			else:
-				result.alternative_addresses.extend(iresult.alternative_addresses)
-			i += 1
+		if self.concurrent:
+			results = self.results_concurrent(address, countrycode)
+		else:
+			results = self.results_sequential(address, countrycode)
+		try:
+			for geocoder, stop_on_interpolated, iresult in results:
+				if iresult.coordinates is not None:
+					best = (geocoder, iresult)
+					if stop_on_interpolated or iresult.precision != "INTERPOLATED":
+						break		# good enough
+				else:
+					result.alternative_addresses.extend(iresult.alternative_addresses)
+		finally:
+			results.close()		# abandon any requests still running
 
 		if best is not None:
 			geocoder, iresult = best
@@ -84,11 +104,102 @@ class GeocoderMulti(GeocoderBase):
 
 		# Store the result.
 		if should_cache:
-			self.cache.store(result)
+			self.cache.store(result, countrycode=countrycode)
 
 		self.debug("")	# blank line
 		return result
 
+	# Like FindAddr() for a list of addresses. The cache is searched
+	# for all of them at once.
+	def FindAddrBatch(self, addresses, countrycode=None):
+		results = self.cache.get_many(addresses, countrycode=countrycode)
+		for i in range(len(results)):
+			if results[i].coordinates is None:
+				results[i] = self.FindAddr(addresses[i], countrycode=countrycode, bypass_cache=True)
+		return results
+
+	# Call the geocoders one after another. Yields
+	# (geocoder, stop_on_interpolated, result).
+	def results_sequential(self, address, countrycode):
+		i = 0
+		for geocoder, stop_on_interpolated in self.geocoders:
+			self.debug("Trying: %s..." % geocoder.name)
+			self.progress(i, len(self.geocoders), _("Trying %s...") % geocoder.name)
+			iresult = geocoder.FindAddr(address, countrycode=countrycode)
+			self.debug("")
+			yield (geocoder, stop_on_interpolated, iresult)
+			i += 1
+
+	# Start the geocoders at once and yield their results in the same
+	# order as results_sequential(). If the caller stops early, geocoders
+	# which have not yet sent their requests do not send them (they check
+	# just before sending, after waiting out their delay) and the answers
+	# to those which have are discarded. Metered geocoders are not started
+	# until the caller asks for their results.
+	def results_concurrent(self, address, countrycode):
+		count = len(self.geocoders)
+		finished = [False] * count
+		answers = [None] * count
+		waiting_for = [0]			# index of the geocoder whose result the caller wants
+		condition = threading.Condition()
+		cancelled = threading.Event()
+
+		def worker(i, geocoder):
+			try:
+				if geocoder.metered:
+					with condition:
+						while waiting_for[0] < i and not cancelled.is_set():
+							condition.wait()
+				with self.geocoder_locks[i]:
+					if cancelled.is_set():
+						answer = None
+					else:
+						self.debug("Starting: %s..." % geocoder.name)
+						geocoder.cancel_event = cancelled
+						try:
+							answer = geocoder.FindAddr(address, countrycode=countrycode)
+						finally:
+							geocoder.cancel_event = None
+			except GeocoderCancelled:
+				answer = None
+			except Exception as e:
+				answer = e
+			with condition:
+				answers[i] = answer
+				finished[i] = True
+				condition.notify_all()
+
+		for i in range(count):
+			thread = threading.Thread(target=worker, args=(i, self.geocoders[i][0]))
+			thread.daemon = True
+			thread.start()
+
+		try:
+			for i in range(count):
+				geocoder, stop_on_interpolated = self.geocoders[i]
+				self.progress(i, count, _("Waiting for %s...") % geocoder.name)
+				bump = 0.0
+				with condition:
+					waiting_for[0] = i
+					condition.notify_all()
+				while True:
+					with condition:
+						if not finished[i]:
+							condition.wait(0.2)
+						if finished[i]:
+							break
+					self.progress_bump(bump)
+					bump += 0.1
+				answer = answers[i]
+				if isinstance(answer, Exception):
+					raise answer
+				self.debug("Result from: %s" % geocoder.name)
+				yield (geocoder, stop_on_interpolated, answer)
+		finally:
+			cancelled.set()
+			with condition:
+				condition.notify_all()
+
 	# Like FindAddr() but rather than returning the best result,
 	# it returns all of the results.
 	def FindAddrAll(self, address, countrycode=None):
@@ -103,54 +214,102 @@ class GeocoderMulti(GeocoderBase):
 
 #=============================================================================
 # This geocoder is used to return results from the cache.
+#
+# The answers are kept in one SQLite database keyed on the normalized
+# address and the country code. Answers older than max_age_days are
+# ignored and purge() deletes them. All threads share one connexion
+# which is protected by a lock.
 #=============================================================================
 class GeocoderCache(GeocoderBase):
+	max_age_days = 30
 
 	def __init__(self, **kwargs):
 		GeocoderBase.__init__(self, **kwargs)
+		import sqlite3
+
+		cachedir = get_cachedir()
+		if not os.path.exists(cachedir):
+			os.makedirs(cachedir)
+		self.filename = os.path.join(cachedir, "geocoder.sqlite")
 
-		self.cachedir = os.path.join(get_cachedir(), "geocoder")
-		if not os.path.exists(self.cachedir):
-			os.makedirs(self.cachedir)	
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+		self.cursor = self.conn.cursor()
+		self.cursor.execute("PRAGMA journal_mode=WAL")
+		self.cursor.execute("PRAGMA synchronous=NORMAL")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS answers (address text, countrycode text, latitude real, longitude real, precision text, source text, mtime real)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS answers_address ON answers (address, countrycode)")
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS answers_mtime ON answers (mtime)")
+		self.conn.commit()
 
-	def cachefile_name(self, address):
+	# The key under which the answer for an address is stored. Differences
+	# in case and spacing are ignored.
+	def address_key(self, address):
 		formated_address = "%s %s, %s, %s %s" \
 			% (address[self.f_house_number], address[self.f_street],
 			  address[self.f_city], address[self.f_state], address[self.f_postal_code]
 			)
-		return "%s/%s" % (self.cachedir, formated_address.replace("/", "_"))
-
-	def FindAddr(self, address, countrycode=None):	# FIXME: countrycode is ignored
-		result = GeocoderResult(address, "Cache")
-
-		cachefile_name = self.cachefile_name(address)
-		cachefile_age = file_age_in_days(cachefile_name)
-		if cachefile_age and cachefile_age < 30:
-			fh = open(cachefile_name, "r")
-			cached_answer = fh.read()
-			fh.close()
-			self.debug("  Using %.1f day old answer from cache." % cachefile_age)
-			try:
-				lines = cached_answer.splitlines()
-				if len(lines) != 1:
-					raise AssertionError
-				lat, lon, result.precision, result.source = lines[0].split(",")
-				result.coordinates = (float(lat), float(lon))
-			except:
-				self.debug("  Bad cache entry")
+		return " ".join(formated_address.upper().split())
+
+	def FindAddr(self, address, countrycode=None):
+		return self.get_many([address], countrycode=countrycode)[0]
+
+	# Look up a list of addresses. Returns a list of results in the same
+	# order. The coordinates of those which are not in the cache are None.
+	def get_many(self, addresses, countrycode=None):
+		keys = [self.address_key(address) for address in addresses]
+		oldest = time.time() - self.max_age_days * 86400
+		answers = {}
+		self.lock.acquire()
+		try:
+			unique_keys = list(set(keys))
+			for i in range(0, len(unique_keys), 500):
+				chunk = unique_keys[i:i+500]
+				self.cursor.execute("SELECT address, latitude, longitude, precision, source, mtime FROM answers WHERE countrycode = ? AND mtime >= ? AND address IN (%s)" % ",".join(["?"] * len(chunk)),
+					[countrycode or "", oldest] + chunk)
+				for row in self.cursor:
+					answers[row[0]] = row[1:]
+		finally:
+			self.lock.release()
 
+		results = []
+		for address, key in zip(addresses, keys):
+			result = GeocoderResult(address, "Cache")
+			answer = answers.get(key)
+			if answer is not None:
+				lat, lon, result.precision, result.source, mtime = answer
+				result.coordinates = (lat, lon)
+				self.debug("  Using %.1f day old answer from cache." % ((time.time() - mtime) / 86400.0))
+			else:
+				self.debug("  No match")
+			results.append(result)
+		return results
+
+	def store(self, result, countrycode=None):
 		if result.coordinates is None:
-			self.debug("  No match")
-		return result
+			return
+		self.debug("Storing new result in cache.")
+		self.lock.acquire()
+		try:
+			self.cursor.execute("INSERT OR REPLACE INTO answers (address, countrycode, latitude, longitude, precision, source, mtime) VALUES (?, ?, ?, ?, ?, ?, ?)",
+				(self.address_key(result.query_address), countrycode or "", result.coordinates[0], result.coordinates[1], result.precision, result.source, time.time()))
+			self.conn.commit()
+		finally:
+			self.lock.release()
 
-	def store(self, result):
-		cachefile = open(self.cachefile_name(result.query_address), "w")
-		if result:	
-			self.debug("Storing new result in cache.")
-			cachefile.write("%s,%s,%s,%s\n" % (repr(result.coordinates[0]), repr(result.coordinates[1]), result.precision, result.source))
-		else:
-			self.debug("Storing empty result in cache.")
-		cachefile.close()
+	# Delete answers which are too old to be used.
+	def purge(self, max_age_days=None):
+		if max_age_days is None:
+			max_age_days = self.max_age_days
+		self.lock.acquire()
+		try:
+			self.cursor.execute("DELETE FROM answers WHERE mtime < ?", (time.time() - max_age_days * 86400,))
+			count = self.cursor.rowcount
+			self.conn.commit()
+		finally:
+			self.lock.release()
+		self.debug("Purged %d old answers from cache." % count)
+		return count
 
 #=============================================================================
 # Test
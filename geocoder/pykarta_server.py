@@ -10,11 +10,12 @@ except ImportError:
 	from urllib.parse import quote_plus
 
 import pykarta
-from .geocoder_base import GeocoderBase, GeocoderResult
+from .geocoder_base import GeocoderBase, GeocoderResult, GeocoderError
 from pykarta.misc.http import simple_url_split
 
 class GeocoderPykartaBase(GeocoderBase):
 	delay = 0.1
+	batch_size = 1000			# addresses per request in FindAddrBatch()
 	geocoder_source_name = None
 	geocoder_basename = None
 
@@ -23,23 +24,44 @@ class GeocoderPykartaBase(GeocoderBase):
 		url = "%s/geocoders/%s" % (pykarta.server_url, self.geocoder_basename)
 		self.url_method, self.url_server, self.url_path = simple_url_split(url)
 
-	# Given a street address, try to find the latitude and longitude.
-	def FindAddr(self, address, countrycode=None):
-		result = GeocoderResult(address, self.geocoder_source_name)
-
-		query = json.dumps([
+	# Put an address in the order which the server expects
+	def address_query(self, address):
+		return [
 			address[self.f_house_number],
 			address[self.f_apartment],
 			address[self.f_street],
 			address[self.f_city],
 			address[self.f_state],
 			address[self.f_postal_code]
-			])
+			]
 
+	# Given a street address, try to find the latitude and longitude.
+	def FindAddr(self, address, countrycode=None):
+		query = json.dumps(self.address_query(address))
 		response_text = self.get("%s?%s" % (self.url_path, quote_plus(query)))
 		feature = json.loads(response_text.decode("UTF-8"))
 		self.debug_indented(json.dumps(feature, indent=4, separators=(',', ': ')))
+		return self.feature_result(address, feature)
 
+	# Find a list of addresses. The server looks up batch_size of
+	# them at a time. Returns a list of results in the same order.
+	def FindAddrBatch(self, addresses, countrycode=None):
+		results = []
+		for i in range(0, len(addresses), self.batch_size):
+			self.progress(i, len(addresses), "%s: %d of %d addresses" % (self.name, i, len(addresses)))
+			batch = addresses[i:i+self.batch_size]
+			query = json.dumps([self.address_query(address) for address in batch]).encode("UTF-8")
+			response_text = self.get(self.url_path, query=query, method="POST", content_type="application/json")
+			features = json.loads(response_text.decode("UTF-8"))
+			if not isinstance(features, list) or len(features) != len(batch):
+				raise GeocoderError("Server returned %s results for %d addresses" % (len(features) if isinstance(features, list) else "no", len(batch)), retryable=False)
+			for address, feature in zip(batch, features):
+				results.append(self.feature_result(address, feature))
+		return results
+
+	# Make a result from the GeoJSON feature which the server returned
+	def feature_result(self, address, feature):
+		result = GeocoderResult(address, self.geocoder_source_name)
 		if feature is not None and feature['type'] == 'Feature':
 			geometry = feature['geometry']
 			assert geometry['type'] == 'Point'
@@ -69,6 +91,8 @@ if __name__ == "__main__":
 		gc.debug_enabled = True
 		print(type(gc))
 		print(gc.FindAddr(["6","Elm Street","","Westfield","MA","01085"]))
+		for result in gc.FindAddrBatch([["6","Elm Street","","Westfield","MA","01085"], ["8","Elm Street","","Westfield","MA","01085"]]):
+			print(result)
 		print()
 
 
@@ -0,0 +1,84 @@
+# encoding=utf-8
+# pykarta/geometry/packed.py
+# Last modified: 30 May 2018
+
+from array import array
+
+#=============================================================================
+# Compact storage for the projected lines and polygons of vector tiles
+#
+# The coordinates of all of the lines in a tile are stored in a single
+# flat array of 32-bit floats (x0, y0, x1, y1, ...). Each line is
+# represented by a PackedPoints object which holds only the offsets of
+# its first and last coordinates in the array. This takes about 8 bytes
+# per point rather than the 120 or so which a list of tuples takes.
+#
+# PackedPoints acts like a read-only sequence of (x, y) tuples so that
+# code which expects a list of points still works, but the drawing
+# code in pykarta.draw uses its coordinates directly.
+#=============================================================================
+
+def new_coords_buffer():
+	return array('f')
+
+class PackedPoints(object):
+	__slots__ = ('coords', 'start', 'end', 'scale')
+
+	def __init__(self, coords, start, end, scale=1.0):
+		self.coords = coords		# array('f') shared with other features
+		self.start = start			# index of x of first point
+		self.end = end				# index after y of last point
+		self.scale = scale
+
+	# Append flat x, y, x, y... values to the buffer and return
+	# a PackedPoints which refers to them.
+	@staticmethod
+	def pack(coords, flat_values):
+		start = len(coords)
+		coords.extend(flat_values)
+		return PackedPoints(coords, start, len(coords))
+
+	def __len__(self):
+		return (self.end - self.start) >> 1
+
+	def __getitem__(self, i):
+		if i < 0:
+			i += len(self)
+		index = self.start + (i << 1)
+		if i < 0 or index >= self.end:
+			raise IndexError(i)
+		scale = self.scale
+		return (self.coords[index] * scale, self.coords[index+1] * scale)
+
+	def __iter__(self):
+		xs, ys = self.get_xs_ys()
+		return iter(zip(xs, ys))
+
+	# Return the x and y coordinates as two lists
+	def get_xs_ys(self):
+		flat = self.coords[self.start:self.end]
+		xs = flat[0::2]
+		ys = flat[1::2]
+		if self.scale != 1.0:
+			scale = self.scale
+			xs = [x * scale for x in xs]
+			ys = [y * scale for y in ys]
+		return (xs, ys)
+
+	# Return a view of the same points multiplied by scale. No copy is made.
+	def scaled(self, scale):
+		return PackedPoints(self.coords, self.start, self.end, self.scale * scale)
+
+	# Return (min_x, min_y, max_x, max_y)
+	def get_bbox(self):
+		xs, ys = self.get_xs_ys()
+		return (min(xs), min(ys), max(xs), max(ys))
+
+	# Add the points to the current path of a Cairo context
+	# as a string of line segments.
+	def add_to_path(self, ctx):
+		if self.end - self.start < 2:
+			return
+		xs, ys = self.get_xs_ys()
+		ctx.move_to(xs[0], ys[0])
+		map(ctx.line_to, xs[1:], ys[1:])
@@ -2,6 +2,19 @@
 # Last modified: 3 February 2015
 
 from math import radians, degrees, exp, log, tan, cos, sinh, atan, pi
+from array import array
+import itertools
+
+# NumPy is optional. It speeds up the batch functions below.
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+# Batches with fewer points than this are done in pure Python since
+# for them the cost of converting to and from NumPy arrays is greater
+# than the savings.
+numpy_threshold = 100
 
 #=============================================================================
 # Web Mercator tiles
@@ -31,6 +44,68 @@ def project_to_tilespace_pixel(lat, lon, zoom, xtile, ytile):
 	xtile2, ytile2 = project_to_tilespace(lat, lon, zoom)
 	return ((xtile2 - xtile) * 256.0, (ytile2 - ytile) * 256.0)
 
+#=============================================================================
+# Batch versions of the above
+#=============================================================================
+
+# Project sequences of latitudes and longitudes to tile coordinates.
+# The results are moved so that (x_origin, y_origin) is at (0, 0) and
+# then multiplied by scale. Returns two lists: x and y.
+def project_to_tilespace_batch(lats, lons, zoom, x_origin=0.0, y_origin=0.0, scale=1.0):
+	n = 2.0 ** zoom
+	if numpy is not None and len(lats) >= numpy_threshold:
+		lat_rad = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+		lons = numpy.asarray(lons, dtype=numpy.float64)
+		xs = ((lons + 180.0) * (n / 360.0) - x_origin) * scale
+		ys = ((1.0 - numpy.log(numpy.tan(lat_rad) + 1.0 / numpy.cos(lat_rad)) / pi) * (n / 2.0) - y_origin) * scale
+		return (xs.tolist(), ys.tolist())
+	xs = [((lon + 180.0) / 360.0 * n - x_origin) * scale for lon in lons]
+	ys = []
+	for lat in lats:
+		lat_rad = radians(lat)
+		ys.append(((1.0 - log(tan(lat_rad) + (1 / cos(lat_rad))) / pi) / 2.0 * n - y_origin) * scale)
+	return (xs, ys)
+
+# Project a list of GeoJSON coordinate lists (each a list of [lon, lat]
+# pairs) to pixel positions within the coordinate space of a particular
+# tile. The lists are done together in one batch. Returns an array('f')
+# of x0, y0, x1, y1, ... with the points of all of the lists in order.
+# Points may have a third (Z) coordinate. It is ignored.
+def project_to_tilespace_pixels_flat(coordinate_lists, zoom, xtile, ytile):
+	total = sum(map(len, coordinate_lists))
+	if numpy is not None and total >= numpy_threshold:
+		lonlat = numpy.fromiter(
+			itertools.chain.from_iterable((p[0], p[1]) for coordinates in coordinate_lists for p in coordinates),
+			dtype=numpy.float64, count=total * 2
+			).reshape(total, 2)
+		n = 2.0 ** zoom
+		lat_rad = numpy.radians(lonlat[:,1])
+		result = numpy.empty((total, 2), dtype=numpy.float32)
+		result[:,0] = ((lonlat[:,0] + 180.0) * (n / 360.0) - xtile) * 256.0
+		result[:,1] = ((1.0 - numpy.log(numpy.tan(lat_rad) + 1.0 / numpy.cos(lat_rad)) / pi) * (n / 2.0) - ytile) * 256.0
+		flat = array('f')
+		flat.fromstring(result.tostring())
+		return flat
+	n = 2.0 ** zoom
+	nx2 = 2.0 / n
+	nx360 = 360.0 / n
+	coordinates = list(itertools.chain.from_iterable(coordinate_lists))
+	flat = [0.0] * (total * 2)
+	flat[0::2] = [((p[0] + 180.0) / nx360 - xtile) * 256.0 for p in coordinates]
+	flat[1::2] = [(((1.0 - log(tan(radians(p[1])) + (1 / cos(radians(p[1])))) / pi) / nx2) - ytile) * 256.0 for p in coordinates]
+	return array('f', flat)
+
+# Apply ((x * n) - x_origin) * scale and the like to a list of (x, y)
+# points. Returns two lists: x and y.
+def transform_points_batch(points, n, x_origin, y_origin, scale):
+	if numpy is not None and len(points) >= numpy_threshold:
+		a = numpy.asarray(points, dtype=numpy.float64)
+		return (((a[:,0] * n - x_origin) * scale).tolist(), ((a[:,1] * n - y_origin) * scale).tolist())
+	return (
+		[(p[0] * n - x_origin) * scale for p in points],
+		[(p[1] * n - y_origin) * scale for p in points]
+		)
+
 #=============================================================================
 # Spherical Mercartor in meters rather than in tiles
 # http://wiki.openstreetmap.org/wiki/Mercator
@@ -12,7 +12,7 @@ import cairo
 import weakref
 
 from pykarta.geometry import Point, BoundingBox
-from pykarta.geometry.projection import project_to_tilespace, unproject_from_tilespace
+from pykarta.geometry.projection import project_to_tilespace, unproject_from_tilespace, project_to_tilespace_batch, transform_points_batch
 import pykarta.maps.symbols
 from pykarta.maps.layers import MapLayerBuilder, map_layer_sets, MapCacheCleaner
 import pykarta.misc
@@ -26,7 +26,7 @@ class MapBase(object):
 	lazy_tiles = False			# Load tiles asyncronously?
 	print_mode = False			# Need higher resolution?
 
-	def __init__(self, tile_source="osm-default", tile_cache_basedir=None, feedback=None, debug_level=0, offline=False):
+	def __init__(self, tile_source="osm-default", tile_cache_basedir=None, feedback=None, debug_level=0, offline=False, tile_fetch_engine="threads", tile_cache_backend="dir"):
 		if tile_cache_basedir is not None:
 			self.tile_cache_basedir = tile_cache_basedir
 		else:
@@ -42,6 +42,15 @@ class MapBase(object):
 
 		self.offline = offline
 
+		# How tile layers should download tiles: "threads" for a pool of
+		# threads per layer or "select" for a single thread shared by all
+		# layers which keeps many requests in flight at once.
+		self.tile_fetch_engine = tile_fetch_engine
+
+		# How downloaded tiles are stored in tile_cache_basedir: "dir" for
+		# one file per tile or "sqlite" for one MBTiles file per tileset
+		self.tile_cache_backend = tile_cache_backend
+
 		# Default Settings
 		self.zoom_min = 0		# at level 0 the whole Earth fits on one tile
 		self.zoom_max = 18
@@ -129,16 +138,21 @@ class MapBase(object):
 		x, y = project_to_tilespace(point.lat, point.lon, self.zoom)
 		return (int((x - self.top_left_pixel[0]) * 256), int((y - self.top_left_pixel[1]) * 256))
 
-	# Apply project_point() to a list of points
+	# Apply project_point() to a list of points. This is done in one batch.
 	def project_points(self, points):
-		return map(self.project_point, points)
+		points = list(points)		# in case it is an iterator
+		xs, ys = project_to_tilespace_batch(
+			[point.lat for point in points], [point.lon for point in points],
+			self.zoom, self.top_left_pixel[0], self.top_left_pixel[1], 256
+			)
+		return zip(map(int, xs), map(int, ys))
 
 	# Take a list of points which have already been passed through
 	# project_to_tilespace() return a new list with them converted
 	# to coordinates according to the current viewport.
 	def scale_points(self, projected_points):
-		n = 2 ** self.zoom
-		return map(lambda p: (int((p[0] * n - self.top_left_pixel[0]) * 256), int((p[1] * n - self.top_left_pixel[1]) * 256)), projected_points)
+		xs, ys = transform_points_batch(projected_points, 2 ** self.zoom, self.top_left_pixel[0], self.top_left_pixel[1], 256)
+		return zip(map(int, xs), map(int, ys))
 
 	# Convert screen coordinates to latitude and longitude.
 	# Returns: (lat, lon)
@@ -7,13 +7,9 @@ import math
 import cairo
 import weakref
 
-try:
-	from collections import OrderedDict
-except ImportError:
-	from pykarta.fallback.ordereddict import OrderedDict
-
 from pykarta.maps.image_loaders import surface_from_pixbuf, pixbuf_from_file, pixbuf_from_file_data
 from pykarta.geometry.projection import project_to_tilespace
+from pykarta.maps.layers.ram_cache import MapTileRamCacheView
 
 class MapTileError(Exception):
 	pass
@@ -32,6 +28,7 @@ class MapLayerOpts(object):
 		self.saturation = None
 		self.transparent_color = None		# which color of a raster tile should be made transparent (often white or gray)
 		self.opacity = 1.0
+		self.tile_raster_cache = True		# keep vector tiles rendered as rasters (see MapTileRaster)
 
 #=============================================================================
 # Base of all map layers
@@ -45,6 +42,7 @@ class MapLayer(object):
 		self.feedback = None
 		self.stale = False
 		self.cache_surface = None			# Cairo raster surface to which the layer is drawn first if the cache_enable option is enabled
+		self.cache_surface_viewport = None	# (zoom, width, height, top_left_pixel) of the map when cache_surface was drawn
 
 	# Called automatically when the layer is added to the container.
 	# It is called again if offline mode is entered or left so that the layer
@@ -70,6 +68,11 @@ class MapLayer(object):
 	def set_tool(self, tool):
 		pass
 
+	# Called in a child process after fork(). Overridden in layers which
+	# hold database connexions, since these must not be shared.
+	def reopen(self):
+		pass
+
 	# The viewport has changed. Select objects or tiles and
 	# determine their positions.
 	def do_viewport(self):
@@ -79,23 +82,76 @@ class MapLayer(object):
 	def do_draw(self, ctx):
 		pass
 
+	# Draw the part of the layer within the clip region of ctx in order to
+	# add it to what do_draw() drew before (see shift_cache_surface()).
+	# Overridden in layers which must not place the same labels again.
+	def do_draw_part(self, ctx):
+		self.do_draw(ctx)
+
 	# MapWidget actually calls this instead of calling do_draw() directly.
 	def do_draw_cached(self, ctx):
 		if self.opts.cache_enabled:
+			containing_map = self.containing_map
+			viewport = (containing_map.zoom, containing_map.width, containing_map.height, containing_map.top_left_pixel)
+			if self.cache_surface is not None and viewport != self.cache_surface_viewport:
+				if not self.shift_cache_surface(ctx, viewport):
+					self.cache_surface = None
 			if self.cache_surface is None:
-				self.cache_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.containing_map.width, self.containing_map.height)
-				cache_ctx = cairo.Context(self.cache_surface)
-				cache_ctx.set_line_join(ctx.get_line_join())
-				cache_ctx.set_line_cap(ctx.get_line_cap())
-				self.do_draw(cache_ctx)
+				self.cache_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, containing_map.width, containing_map.height)
+				self.do_draw(self.cache_context(ctx))
 			else:
 				#print "cached"
 				pass
+			self.cache_surface_viewport = viewport
 			ctx.set_source_surface(self.cache_surface, 0, 0)
 			ctx.paint()
 		else:
 			self.do_draw(ctx)
 
+	# A Cairo context for drawing on cache_surface
+	def cache_context(self, ctx):
+		cache_ctx = cairo.Context(self.cache_surface)
+		cache_ctx.set_line_join(ctx.get_line_join())
+		cache_ctx.set_line_cap(ctx.get_line_cap())
+		return cache_ctx
+
+	# If the map has only been moved by a whole number of pixels since
+	# cache_surface was drawn, move its contents to match and draw only
+	# the strips along the edges which have come into view. Returns
+	# False if cache_surface must be drawn again from scratch.
+	def shift_cache_surface(self, ctx, viewport):
+		zoom, width, height, top_left_pixel = viewport
+		old_zoom, old_width, old_height, old_top_left_pixel = self.cache_surface_viewport
+		if zoom != old_zoom or width != old_width or height != old_height \
+				or top_left_pixel is None or old_top_left_pixel is None:
+			return False
+		dx = (old_top_left_pixel[0] - top_left_pixel[0]) * 256.0
+		dy = (old_top_left_pixel[1] - top_left_pixel[1]) * 256.0
+		shift_x = int(round(dx))
+		shift_y = int(round(dy))
+		if abs(dx - shift_x) > 0.01 or abs(dy - shift_y) > 0.01:
+			return False
+		if abs(shift_x) >= width or abs(shift_y) >= height:
+			return False
+
+		old_surface = self.cache_surface
+		self.cache_surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+		cache_ctx = self.cache_context(ctx)
+		cache_ctx.set_source_surface(old_surface, shift_x, shift_y)
+		cache_ctx.paint()
+
+		if shift_x > 0:
+			cache_ctx.rectangle(0, 0, shift_x, height)
+		elif shift_x < 0:
+			cache_ctx.rectangle(width + shift_x, 0, -shift_x, height)
+		if shift_y > 0:
+			cache_ctx.rectangle(0, 0, width, shift_y)
+		elif shift_y < 0:
+			cache_ctx.rectangle(0, height + shift_y, width, -shift_y)
+		cache_ctx.clip()
+		self.do_draw_part(cache_ctx)
+		return True
+
 	# Mouse button pressed down while pointer is over map
 	def on_button_press(self, gdkevent):
 		return False
@@ -108,6 +164,45 @@ class MapLayer(object):
 	def on_motion(self, gdkevent):
 		return False
 
+#=============================================================================
+# The labels which the tiles of a tile layer have placed, so that each
+# is placed only once. Tile classes use it as a set. Since the layer
+# tells it which tile is being drawn, it knows which tile placed each.
+#
+# When only strips along the edges of the map are drawn to add to what
+# was drawn before, a label which a tile placed before may only be
+# placed again by that tile (which will put it in the same place).
+#=============================================================================
+class MapLabelDedup(object):
+	def __init__(self):
+		self.placed = {}			# label to key of the tile which placed it
+		self.earlier = {}			# the same for the drawings which this one adds to
+		self.tile = None			# key of the tile being drawn
+
+	def __contains__(self, label):
+		if label in self.placed:
+			return True
+		owner = self.earlier.get(label)
+		return owner is not None and owner != self.tile
+
+	def add(self, label):
+		self.placed[label] = self.tile
+
+	# Start a new drawing of the whole layer
+	def clear(self):
+		self.placed.clear()
+		self.earlier.clear()
+
+	# Start a drawing of part of the layer which adds to the previous ones.
+	# Labels placed by tiles which are no longer in view are forgotten.
+	def resume(self, tiles_in_view):
+		earlier = self.earlier
+		earlier.update(self.placed)
+		self.placed.clear()
+		for label, owner in earlier.items():
+			if owner not in tiles_in_view:
+				del earlier[label]
+
 #=============================================================================
 # Base of all tile layers
 #=============================================================================
@@ -116,16 +211,20 @@ class MapTileLayer(MapLayer):
 	def __init__(self, tile_class):
 		MapLayer.__init__(self)
 		self.tile_class = tile_class
-		self.ram_cache_max = 1000		# number of tiles to keep in RAM
 
-		self.ram_cache = OrderedDict()
+		# Loaded tiles are kept in a RAM cache shared by all tile layers.
+		# It has a limit on its total size in bytes.
+		self.ram_cache = MapTileRamCacheView()
+		self.raster_cache = MapTileRamCacheView()
+		self.style_version = 0			# part of the key of the rasters in raster_cache
 		self.tiles = []
 		self.tile_scale_factor = None
 		self.zoom = None				# zoom level (possibly fractional)
 		self.int_zoom = None			# nearest integer zoom level (for fetching tiles)
 		self.tile_size = None
 		self.tile_ranges = None			# used for precaching
-		self.dedup = set()				# for deduplicating labels, shared by all the tiles
+		self.center_tile = None			# tilespace coordinates of center of viewport
+		self.dedup = MapLabelDedup()	# for deduplicating labels, shared by all the tiles
 
 	#def __del__(self):
 	#	print "Map: tile layer %s destroyed" % self.name
@@ -178,8 +277,10 @@ class MapTileLayer(MapLayer):
 		# Make a list of the tiles to use used and their positions on the screen.
 		self.tiles = []
 		self.tile_ranges = None
+		self.center_tile = None
 		if self.int_zoom >= self.opts.zoom_min and self.int_zoom <= self.opts.zoom_max:
 			center_tile_x, center_tile_y = project_to_tilespace(lat, lon, self.int_zoom)
+			self.center_tile = (center_tile_x, center_tile_y)
 
 			half_width_in_pixels = self.containing_map.width / 2.0
 			half_height_in_pixels = self.containing_map.height / 2.0
@@ -220,18 +321,30 @@ class MapTileLayer(MapLayer):
 
 	# Called whenever redrawing required
 	def do_draw(self, ctx):
+		self.dedup.clear()
+		self.draw_tiles(ctx)
+
+	# Labels which tiles placed when the whole layer was drawn are already
+	# on the cache surface, so other tiles must not place them again.
+	def do_draw_part(self, ctx):
+		self.dedup.resume(set([tile[:3] for tile in self.tiles]))
+		self.draw_tiles(ctx)
+
+	def draw_tiles(self, ctx):
 		#print "Draw %s tiles..." % self.name
 
-		self.dedup.clear()
+		# If only part of the layer is to be drawn (see shift_cache_surface()),
+		# skip the tiles which are entirely outside it.
+		tiles = self.tiles_within(ctx.clip_extents())
 
 		# Load tiles
 		progress = 1
 		tile_objs = []
-		for zoom, x, y, xpixoff, ypixoff in self.tiles:
+		for zoom, x, y, xpixoff, ypixoff in tiles:
 
 			# If this map blocks until all of the tiles are loaded, display progress.
 			if not self.containing_map.lazy_tiles:
-				numtiles = len(self.tiles)
+				numtiles = len(tiles)
 				self.feedback.progress(progress, numtiles, _("Downloading {layername} tile {progress} of {numtiles}").format(layername=self.name, progress=progress, numtiles=numtiles))
 
 			# Load the tile if it is already cached.
@@ -257,18 +370,58 @@ class MapTileLayer(MapLayer):
 			tile_objs.append(tile_obj)
 			progress += 1
 
+		# If the tiles are vectors, draw those passes which stay within the
+		# tile from rasters which we keep in the RAM cache. Each run of
+		# such passes between label passes gets its own raster so that the
+		# passes are still drawn in order. A pass which draws beyond the
+		# tile's borders (see tile_raster_pad()) overlaps the neighboring
+		# tiles, so it gets a raster of its own. Otherwise it would be
+		# drawn over the next pass of the tiles drawn before it.
+		raster_runs = {}			# first pass of each run to the passes of the run
+		raster_passes = set()
+		if self.use_tile_rasters():
+			raster_scale = max(1.0, round(self.tile_scale_factor * 32.0)) / 32.0
+			run = None
+			for draw_pass in range(self.tile_class.draw_passes):
+				if draw_pass in self.tile_class.label_passes:
+					run = None
+				elif self.tile_raster_pad(draw_pass) > 0:
+					raster_runs[draw_pass] = [draw_pass]
+					raster_passes.add(draw_pass)
+					run = None
+				else:
+					if run is None:
+						run = raster_runs[draw_pass] = []
+					run.append(draw_pass)
+					raster_passes.add(draw_pass)
+
 		# Draw tiles
 		for draw_pass in range(self.tile_class.draw_passes):
+			if draw_pass in raster_runs:
+				draw_passes = tuple(raster_runs[draw_pass])
+				i = 0
+				for zoom, x, y, xpixoff, ypixoff in tiles:
+					tile = tile_objs[i][0]
+					if tile is not None:
+						raster = self.load_tile_raster(tile, zoom, x, y, raster_scale, draw_passes, ctx)
+						ctx.save()
+						ctx.translate(xpixoff, ypixoff)
+						raster.draw(ctx, self.tile_scale_factor)
+						ctx.restore()
+					i += 1
+
 			i = 0
-			for zoom, x, y, xpixoff, ypixoff in self.tiles:
+			for zoom, x, y, xpixoff, ypixoff in tiles:
 				#print zoom, x, y, xpixoff, ypixoff
 				ctx.save()
 				ctx.translate(xpixoff, ypixoff)
 	
 				tile, bigger_tile, subtile_scale_factor, x_adj, y_adj = tile_objs[i]
+				self.dedup.tile = (zoom, x, y)
 	
 				if tile is not None:
-					tile.draw(ctx, self.tile_scale_factor, draw_pass)
+					if not draw_pass in raster_passes:
+						tile.draw(ctx, self.tile_scale_factor, draw_pass)
 				elif bigger_tile is not None:
 					ctx.rectangle(-1, -1, self.tile_size+2, self.tile_size+2)
 					ctx.clip()
@@ -279,28 +432,78 @@ class MapTileLayer(MapLayer):
 				tile_objs.append(tile)
 				i += 1
 
+	# Return those tiles in self.tiles which overlap a rectangle given as
+	# (x1, y1, x2, y2). Labels may extend beyond a tile by up to margin.
+	def tiles_within(self, extents, margin=64):
+		x1, y1, x2, y2 = extents
+		x1 -= margin
+		y1 -= margin
+		x2 += margin
+		y2 += margin
+		tile_size = self.tile_size
+		return [tile for tile in self.tiles
+			if tile[3] < x2 and (tile[3] + tile_size) > x1 and tile[4] < y2 and (tile[4] + tile_size) > y1]
+
 	# This wraps load_tile() and caches the most recently used tiles in RAM.
 	def load_tile_cached(self, zoom, x, y, may_download):
 		#print "Tile:", zoom, x, y, may_download
 		key = (zoom, x, y)
-		try:
-			result = self.ram_cache.pop(key)	# will reinsert below
-			#print " cache hit"
-		except KeyError:
-			#print " cache miss"
+		result, found = self.ram_cache.get(key)
+		if not found:
 			result = self.load_tile(zoom, x, y, may_download)
 			if result == None and not may_download:
 				return None
-			if len(self.ram_cache) > self.ram_cache_max:		# trim cache?
-				self.ram_cache.popitem(last=False)
-		self.ram_cache[key] = result
+			self.ram_cache.put(key, result)
 		return result
 
 	def ram_cache_invalidate(self, zoom, x, y):
-		try:
-			self.ram_cache.pop((zoom, x, y))
-		except KeyError:
+		if not self.ram_cache.remove((zoom, x, y)):
 			print "cache_invalidate(): not in cache", zoom, x, y
+		self.raster_cache.clear((zoom, x, y))		# rasters of this tile at any scale
+
+	# Should do_draw() draw the tiles from rasters in raster_cache? Only
+	# vector tile classes say which of their passes draw labels. In print
+	# mode the tiles are drawn at full resolution.
+	def use_tile_rasters(self):
+		return self.opts.tile_raster_cache \
+			and getattr(self.tile_class, "label_passes", None) is not None \
+			and not self.containing_map.print_mode
+
+	# How many pixels beyond the tile's borders the indicated pass of
+	# the vector tile class may draw. This is the clip attribute of
+	# MapGeoJSONTile. Tile classes made of several others list it for
+	# each pass in pass_clips. None (no clipping) counts as zero since
+	# the features of such tiles are cut off at the tile's borders.
+	def tile_raster_pad(self, draw_pass):
+		pass_clips = getattr(self.tile_class, "pass_clips", None)
+		if pass_clips is not None:
+			clip = pass_clips[draw_pass]
+		else:
+			clip = getattr(self.tile_class, "clip", None)
+		return int(math.ceil(clip or 0))
+
+	# Return a raster of the indicated passes of a tile at the indicated
+	# scale, rendering it if it is not in the RAM cache.
+	def load_tile_raster(self, tile, zoom, x, y, scale, draw_passes, ctx):
+		key = (zoom, x, y, scale, draw_passes, self.style_version)
+		raster, found = self.raster_cache.get(key)
+		if not found:
+			pad = max([self.tile_raster_pad(draw_pass) for draw_pass in draw_passes])
+			raster = MapTileRaster(tile, scale, draw_passes, ctx, pad)
+			self.raster_cache.put(key, raster)
+		return raster
+
+	# Call this if the tile class has changed its styles so that the
+	# tiles will be rendered again.
+	def styles_changed(self):
+		self.style_version += 1
+		self.raster_cache.clear()
+		self.redraw()
+
+	# Returns a dict with the hit and miss counts of this layer's
+	# view of the RAM cache and the number and size of its tiles there.
+	def get_ram_cache_stats(self):
+		return self.ram_cache.get_stats()
 
 	# Return the indicated tile as a Cairo surface. If it is not yet
 	# available, return None.
@@ -315,7 +518,13 @@ class MapTileLayer(MapLayer):
 class MapRasterTile(object):
 	draw_passes = 1
 	def __init__(self, layer, filename, zoom, x, y, data=None):
-		self.layer = layer
+		# Keep only the options. A reference to the layer would keep
+		# it alive for as long as this tile is in the RAM cache.
+		self.opts = layer.opts
+
+		# The tile cache may give us a file-like object rather than a filename.
+		if hasattr(filename, "read"):
+			filename, data = None, filename.read()
 
 		if filename is not None:
 			try:
@@ -342,11 +551,50 @@ class MapRasterTile(object):
 		# Convert pixbuf to a Cairo image surface.
 		self.tile_surface = surface_from_pixbuf(pixbuf)
 
+	def get_ram_size(self):
+		return self.tile_surface.get_stride() * self.tile_surface.get_height() + 256
+
 	# Draw a tile so that it covers an area of 256x256 pixels multiplied by scale.
 	# Scale will be 1.0 when the zoom level is an integer and the tiles are not overzoomed.
 	def draw(self, ctx, scale, draw_pass):
 		scale *= (256.0 / self.tile_surface.get_width())	# support retina tiles
 		ctx.scale(scale, scale)
 		ctx.set_source_surface(self.tile_surface, 0, 0)
-		ctx.paint_with_alpha(self.layer.opts.opacity)
+		ctx.paint_with_alpha(self.opts.opacity)
+
+# A vector tile rendered to a raster so that it need not be rendered
+# again each time the map is redrawn. Vector tile classes have a
+# label_passes attribute which lists those of their passes which draw
+# labels. Since labels are deduplicated across tiles and may extend
+# beyond the tile's borders, those passes are not included. A raster
+# holds a run of consecutive passes between label passes. It extends
+# pad pixels beyond the tile's borders on each side so as to hold what
+# the tile class draws there (see MapTileLayer.tile_raster_pad()). Tiles
+# are rendered at a few fixed scales which are stretched slightly to
+# fit the actual scale.
+class MapTileRaster(object):
+	def __init__(self, tile, scale, draw_passes, ctx, pad=0):
+		self.scale = scale
+		self.pad = pad
+		size = int(math.ceil(256.0 * scale)) + 2 * pad
+		self.surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+		raster_ctx = cairo.Context(self.surface)
+		raster_ctx.set_line_join(ctx.get_line_join())
+		raster_ctx.set_line_cap(ctx.get_line_cap())
+		raster_ctx.translate(pad, pad)
+		for draw_pass in draw_passes:
+			raster_ctx.save()
+			tile.draw(raster_ctx, scale, draw_pass)
+			raster_ctx.restore()
+
+	def get_ram_size(self):
+		return self.surface.get_stride() * self.surface.get_height() + 256
+
+	def draw(self, ctx, scale):
+		stretch = scale / self.scale
+		ctx.scale(stretch, stretch)
+		ctx.set_source_surface(self.surface, -self.pad, -self.pad)
+		if abs(stretch - 1.0) < 0.02:		# do not blur for a fraction of a pixel
+			ctx.get_source().set_filter(cairo.FILTER_FAST)
+		ctx.paint()
 
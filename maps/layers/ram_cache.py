@@ -0,0 +1,183 @@
+# encoding=utf-8
+# pykarta/maps/layers/ram_cache.py
+# Copyright 2013--2018, Trinity College
+# Last modified: 30 May 2018
+#
+# RAM cache for loaded tiles. There is one cache for the whole program
+# so that the memory it uses is limited no matter how many tile layers
+# there are. Each tile layer has a view of it which keeps its tiles
+# apart from those of the other layers.
+
+import threading
+import itertools
+
+try:
+	from collections import OrderedDict
+except ImportError:
+	from pykarta.fallback.ordereddict import OrderedDict
+
+# Estimate the memory which a tile object occupies. Tile classes can
+# provide a get_ram_size() method. Otherwise we assume a 256x256 raster.
+def tile_ram_size(tile):
+	if tile is None:
+		return 64
+	get_ram_size = getattr(tile, "get_ram_size", None)
+	if get_ram_size is not None:
+		return get_ram_size()
+	return 256 * 256 * 4
+
+class MapTileRamCache(object):
+	def __init__(self, max_bytes=256*1024*1024):
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.entries = OrderedDict()		# (namespace, zoom, x, y, ...) to (tile, size), least recently used first
+		self.tile_keys = {}					# (namespace, zoom, x, y) to set of keys in entries which start with it
+		self.bytes = 0
+		self.namespaces = {}				# namespace to [tile count, bytes]
+		self.namespace_counter = itertools.count(1)
+
+	def new_namespace(self):
+		self.lock.acquire()
+		namespace = self.namespace_counter.next()
+		self.namespaces[namespace] = [0, 0]
+		self.lock.release()
+		return namespace
+
+	def set_max_bytes(self, max_bytes):
+		self.lock.acquire()
+		self.max_bytes = max_bytes
+		self._trim()
+		self.lock.release()
+
+	# Returns the tile (which may be None) and a flag which is
+	# True if it was found.
+	def get(self, key):
+		self.lock.acquire()
+		try:
+			entry = self.entries.pop(key)
+		except KeyError:
+			return (None, False)
+		else:
+			self.entries[key] = entry		# most recently used
+			return (entry[0], True)
+		finally:
+			self.lock.release()
+
+	def put(self, key, tile):
+		size = tile_ram_size(tile)
+		self.lock.acquire()
+		try:
+			self._remove(key)
+			self.entries[key] = (tile, size)
+			self.tile_keys.setdefault(key[:4], set()).add(key)
+			self.bytes += size
+			totals = self.namespaces.setdefault(key[0], [0, 0])
+			totals[0] += 1
+			totals[1] += size
+			self._trim()
+		finally:
+			self.lock.release()
+
+	def remove(self, key):
+		self.lock.acquire()
+		try:
+			return self._remove(key)
+		finally:
+			self.lock.release()
+
+	# Remove all of the tiles in a namespace or, if a prefix is
+	# supplied, those whose keys (after the namespace) start with it.
+	# If the prefix includes the zoom, x, and y, only the keys for that
+	# tile need be examined.
+	def clear(self, namespace, prefix=()):
+		start = len(prefix) + 1
+		self.lock.acquire()
+		try:
+			if len(prefix) >= 3:
+				keys = self.tile_keys.get((namespace,) + tuple(prefix[:3]), ())
+			else:
+				keys = self.entries
+			for key in [key for key in keys if key[0] == namespace and key[1:start] == prefix]:
+				self._remove(key)
+		finally:
+			self.lock.release()
+
+	def drop_namespace(self, namespace):
+		self.clear(namespace)
+		self.lock.acquire()
+		self.namespaces.pop(namespace, None)
+		self.lock.release()
+
+	def _remove(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self._unindex(key)
+			self.bytes -= entry[1]
+			totals = self.namespaces[key[0]]
+			totals[0] -= 1
+			totals[1] -= entry[1]
+			return True
+		return False
+
+	def _unindex(self, key):
+		keys = self.tile_keys[key[:4]]
+		keys.discard(key)
+		if len(keys) == 0:
+			del self.tile_keys[key[:4]]
+
+	# Evict least recently used tiles until we are within budget
+	def _trim(self):
+		while self.bytes > self.max_bytes and len(self.entries) > 1:
+			key, (tile, size) = self.entries.popitem(last=False)
+			self._unindex(key)
+			self.bytes -= size
+			totals = self.namespaces[key[0]]
+			totals[0] -= 1
+			totals[1] -= size
+
+# The cache which tile layers use unless they are given another one
+tile_ram_cache = MapTileRamCache()
+
+#=============================================================================
+# A tile layer's view of the RAM cache. Keys are (zoom, x, y).
+#=============================================================================
+class MapTileRamCacheView(object):
+	def __init__(self, cache=None):
+		self.cache = cache if cache is not None else tile_ram_cache
+		self.namespace = self.cache.new_namespace()
+		self.hits = 0
+		self.misses = 0
+
+	# Returns the tile (which may be None) and a flag which
+	# is True if it was found.
+	def get(self, key):
+		result = self.cache.get((self.namespace,) + key)
+		if result[1]:
+			self.hits += 1
+		else:
+			self.misses += 1
+		return result
+
+	def put(self, key, tile):
+		self.cache.put((self.namespace,) + key, tile)
+
+	def remove(self, key):
+		return self.cache.remove((self.namespace,) + key)
+
+	def clear(self, prefix=()):
+		self.cache.clear(self.namespace, prefix)
+
+	def get_stats(self):
+		self.cache.lock.acquire()
+		tiles, bytes = self.cache.namespaces.get(self.namespace, (0, 0))
+		self.cache.lock.release()
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'tiles': tiles,
+			'bytes': bytes,
+			}
+
+	# When the layer goes away, its tiles are no longer of any use.
+	def __del__(self):
+		self.cache.drop_namespace(self.namespace)
@@ -0,0 +1,281 @@
+# encoding=utf-8
+# pykarta/maps/layers/tile_cache.py
+# Copyright 2013--2018, Trinity College
+# Last modified: 30 May 2018
+#
+# Disk caches for tiles downloaded by MapTileDownloader. There are two
+# backends with the same interface:
+#
+#  MapTileCacheDir--one file per tile in <basedir>/<tileset>/<z>/<x>/<y>
+#  MapTileCacheSqlite--all of a tileset's tiles in <basedir>/<tileset>.mbtiles
+#
+# lookup() returns (source, mtime, etag) where source is something which
+# the tile classes can load: a filename in the case of the directory
+# backend and a file-like object in the case of the SQLite backend.
+
+import os
+import errno
+import time
+import threading
+import atexit
+from StringIO import StringIO
+
+from pykarta.misc import SaveAtomically
+
+#=============================================================================
+# Backend which stores each tile in its own file
+#=============================================================================
+class MapTileCacheDir(object):
+	def __init__(self, basedir, tileset_key):
+		self.basedir = basedir
+		self.tileset_key = tileset_key
+
+	def filename(self, zoom, x, y):
+		return "%s/%s/%d/%d/%d" % (self.basedir, self.tileset_key, zoom, x, y)
+
+	def lookup(self, zoom, x, y):
+		filename = self.filename(zoom, x, y)
+		try:
+			statbuf = os.stat(filename)
+		except OSError:
+			return None
+		return (filename, statbuf.st_mtime, None)
+
+	def store(self, zoom, x, y, data, etag=None):
+		filename = self.filename(zoom, x, y)
+
+		# Make the cache directory which holds this tile, if it does not exist already.
+		dirname = os.path.dirname(filename)
+		if not os.path.exists(dirname):
+			# This may fail if another thread creates.
+			try:
+				os.makedirs(dirname)
+			except OSError, e:
+				if e.errno != errno.EEXIST:
+					raise
+
+		# Save the file in such a manner that there is never a partial tile with the final name.
+		cachefile = SaveAtomically(filename)
+		cachefile.write(data)
+		try:
+			cachefile.close()
+		except OSError, e:
+			print "FIXME: OSError: %d" % e.errno
+
+	# Mark a tile as fresh
+	def touch(self, zoom, x, y):
+		fh = open(self.filename(zoom, x, y), "a")
+		fh.close()
+
+	def delete(self, zoom, x, y):
+		try:
+			os.unlink(self.filename(zoom, x, y))
+		except OSError:
+			pass
+
+	def flush(self):
+		pass
+
+	def reopen(self):
+		pass
+
+#=============================================================================
+# Backend which stores all of the tiles of a tileset in one SQLite
+# database. The tiles table follows the MBTiles spec (note that its
+# rows are numbered from the bottom), so the file can be opened with
+# MapTileLayerMbtiles or other MBTiles readers. It has two extra
+# columns for the time the tile was last fetched or revalidated and
+# for the ETag which the server sent.
+#
+# Writes are held in memory and committed in batches. All threads share
+# one connexion which is protected by a lock.
+#=============================================================================
+class MapTileCacheSqlite(object):
+	def __init__(self, basedir, tileset_key):
+		self.basedir = basedir
+		self.tileset_key = tileset_key
+		self.filename = os.path.join(basedir, "%s.mbtiles" % tileset_key)
+
+		# Flush pending writes when this many have accumulated or the
+		# oldest has been waiting this many seconds.
+		self.batch_size = 100
+		self.batch_time = 5.0
+
+		if not os.path.exists(basedir):
+			os.makedirs(basedir)
+
+		self.inherited_conns = []
+		self._open()
+
+	def _open(self):
+		import sqlite3
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+		self.conn.text_factory = str
+		self.cursor = self.conn.cursor()
+		self.cursor.execute("PRAGMA journal_mode=WAL")
+		self.cursor.execute("PRAGMA synchronous=NORMAL")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob, mtime real, etag text)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+		self.cursor.execute("CREATE INDEX IF NOT EXISTS tile_mtime ON tiles (mtime)")
+		self.cursor.execute("SELECT value FROM metadata WHERE name = 'name'")
+		if self.cursor.fetchone() is None:
+			self.cursor.executemany("INSERT INTO metadata (name, value) VALUES (?, ?)", (
+				('name', self.tileset_key),
+				('type', 'baselayer'),
+				('version', '1.0'),
+				('description', 'PyKarta tile cache'),
+				))
+		self.conn.commit()
+
+		# (zoom, x, y) to (data, mtime, etag). Data is None if
+		# only the mtime and etag of a tile are to be updated.
+		self.pending = {}
+		self.pending_since = None
+
+	# Call this in a child process after fork(). An SQLite connexion must
+	# not be used in a child process. Even closing it could disturb the
+	# parent's locks, so the inherited one is kept but never touched again.
+	# Writes which the parent had not yet committed are the parent's to
+	# make, so they are dropped. Since the child may exit without calling
+	# the atexit functions, its own writes are committed at once.
+	def reopen(self):
+		self.inherited_conns.append(self.conn)
+		self._open()
+		self.batch_size = 1
+
+	def lookup(self, zoom, x, y):
+		self.lock.acquire()
+		try:
+			entry = self.pending.get((zoom, x, y))
+			if entry is None or entry[0] is None:
+				self.cursor.execute("SELECT tile_data, mtime, etag FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (zoom, x, (2**zoom-1) - y))
+				row = self.cursor.fetchone()
+				if row is None:
+					return None
+				if entry is None:
+					entry = row
+				else:
+					entry = (row[0], entry[1], entry[2])
+		finally:
+			self.lock.release()
+		data, mtime, etag = entry
+		return (StringIO(str(data)), mtime, etag)
+
+	def store(self, zoom, x, y, data, etag=None):
+		self.lock.acquire()
+		try:
+			self.pending[(zoom, x, y)] = (data, time.time(), etag)
+			self._maybe_flush()
+		finally:
+			self.lock.release()
+
+	def touch(self, zoom, x, y):
+		self.lock.acquire()
+		try:
+			key = (zoom, x, y)
+			entry = self.pending.get(key)
+			if entry is not None:
+				self.pending[key] = (entry[0], time.time(), entry[2])
+			else:
+				self.pending[key] = (None, time.time(), None)
+			self._maybe_flush()
+		finally:
+			self.lock.release()
+
+	def delete(self, zoom, x, y):
+		self.lock.acquire()
+		try:
+			self.pending.pop((zoom, x, y), None)
+			self.cursor.execute("DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", (zoom, x, (2**zoom-1) - y))
+			self.conn.commit()
+		finally:
+			self.lock.release()
+
+	def flush(self):
+		self.lock.acquire()
+		try:
+			self._flush()
+		finally:
+			self.lock.release()
+
+	def _maybe_flush(self):
+		now = time.time()
+		if self.pending_since is None:
+			self.pending_since = now
+		if len(self.pending) >= self.batch_size or (now - self.pending_since) >= self.batch_time:
+			self._flush()
+
+	def _flush(self):
+		if len(self.pending) == 0:
+			return
+		import sqlite3
+		replace = []
+		touch = []
+		for (zoom, x, y), (data, mtime, etag) in self.pending.items():
+			row = (2**zoom-1) - y
+			if data is not None:
+				replace.append((zoom, x, row, sqlite3.Binary(data), mtime, etag))
+			else:
+				touch.append((mtime, zoom, x, row))
+		self.cursor.executemany("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, mtime, etag) VALUES (?, ?, ?, ?, ?, ?)", replace)
+		self.cursor.executemany("UPDATE tiles SET mtime = ? WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?", touch)
+		self.conn.commit()
+		self.pending = {}
+		self.pending_since = None
+
+	# Delete tiles last fetched or revalidated before the indicated time.
+	# Returns the number deleted and the number left.
+	def expire(self, before):
+		self.lock.acquire()
+		try:
+			self._flush()
+			self.cursor.execute("DELETE FROM tiles WHERE mtime < ?", (before,))
+			deleted = self.cursor.rowcount
+			self.conn.commit()
+			self.cursor.execute("SELECT count(*) FROM tiles")
+			left = self.cursor.fetchone()[0]
+			return (deleted, left)
+		finally:
+			self.lock.release()
+
+#=============================================================================
+# Each cache is opened only once so that the SQLite backend can batch
+# the writes from all of the downloaders which use it.
+#=============================================================================
+tile_cache_backends = {
+	"dir": MapTileCacheDir,
+	"sqlite": MapTileCacheSqlite,
+	}
+tile_caches = {}
+tile_caches_lock = threading.Lock()
+
+def get_tile_cache(backend, basedir, tileset_key):
+	tile_caches_lock.acquire()
+	try:
+		key = (backend, basedir, tileset_key)
+		cache = tile_caches.get(key)
+		if cache is None:
+			cache = tile_cache_backends[backend](basedir, tileset_key)
+			tile_caches[key] = cache
+		return cache
+	finally:
+		tile_caches_lock.release()
+
+def flush_tile_caches():
+	tile_caches_lock.acquire()
+	caches = tile_caches.values()
+	tile_caches_lock.release()
+	for cache in caches:
+		cache.flush()
+
+# Call this in a child process after fork(). Another thread of the
+# parent may have held the lock, so it is not used.
+def reopen_tile_caches():
+	global tile_caches_lock
+	tile_caches_lock = threading.Lock()
+	for cache in tile_caches.values():
+		cache.reopen()
+
+atexit.register(flush_tile_caches)
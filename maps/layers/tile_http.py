@@ -1,22 +1,25 @@
 # encoding=utf-8
 # pykarta/maps/layers/tile_http.py
 # Copyright 2013--2018, Trinity College
-# Last modified: 30 May 2018
+# Last modified: 31 May 2018
 
 import os
-import errno
 import random
+import math
+import heapq
 import httplib
 import threading
 import time
 import socket
+import traceback
 import gobject
 import gzip
 from StringIO import StringIO
 
 from pykarta.misc.http import http_date
 from pykarta.maps.layers.base import MapTileLayer, MapTileError
-from pykarta.misc import file_age_in_days, BoundMethodProxy, NoInet, tile_count, SaveAtomically
+from pykarta.maps.layers.tile_cache import get_tile_cache
+from pykarta.misc import file_age_in_days, BoundMethodProxy, NoInet, tile_count
 
 #=============================================================================
 # TMS tile layer loaded over HTTP
@@ -41,8 +44,10 @@ class MapTileLayerHTTP(MapTileLayer):
 		self.tile_wait = 200
 
 		self.downloader = None
+		self.decoder = None
+		self.stale_decodes = set()		# (zoom, x, y) of tiles replaced while being parsed
 		self.timer = None
-		self.missing_tiles = {}
+		self.missing_tiles = set()		# (zoom, x, y) of tiles for which we expect callbacks
 		self.redraw_needed = False
 		self.tile_ranges = None
 
@@ -76,31 +81,78 @@ class MapTileLayerHTTP(MapTileLayer):
 				self.tileset,
 				self.containing_map.tile_cache_basedir,
 				feedback=self.feedback,
+				tile_cache_backend=self.containing_map.tile_cache_backend,
 				)
 		else:
-			self.downloader = MapTileDownloader(
+			if self.containing_map.tile_fetch_engine == "select":
+				from pykarta.maps.layers.tile_http_async import MapTileDownloaderAsync as downloader_class
+			else:
+				downloader_class = MapTileDownloader
+			self.downloader = downloader_class(
 				self.tileset,
 				self.containing_map.tile_cache_basedir,
 				feedback=self.feedback,
 				done_callback=BoundMethodProxy(self.tile_loaded_cb) if self.containing_map.lazy_tiles else None,
+				tile_cache_backend=self.containing_map.tile_cache_backend,
+				)
+
+		# If tiles are loaded lazily and they take a while to parse (as
+		# vector tiles do), parse them in background threads so that the
+		# GTK main loop is not held up.
+		if self.containing_map.lazy_tiles and getattr(self.tile_class, "decode_in_thread", False):
+			self.decoder = MapTileDecoder(
+				self.tileset.key,
+				BoundMethodProxy(self.decode_tile),
+				BoundMethodProxy(self.tile_decoded_cb),
+				feedback=self.feedback,
 				)
+		else:
+			self.decoder = None
+		self.stale_decodes = set()
 
 		# The RAM cache may reflect absence of tiles. Dump it.
 		self.ram_cache.clear()
 
+	# Hook do_viewport() so that when the map is moved we can tell the
+	# downloader to forget about tiles which are no longer in view and
+	# to download those nearest the new center first.
+	def do_viewport(self):
+		MapTileLayer.do_viewport(self)
+		if self.downloader is not None:
+			self.downloader.cancel_unwanted(self.tile_in_view, self.tile_priority)
+		if self.decoder is not None:
+			# The RAM cache holds None for these. Remove it so that
+			# they will be loaded again if they come back into view.
+			for key in self.decoder.cancel_unwanted(self.tile_in_view, self.tile_priority):
+				self.ram_cache.remove(key)
+		self.missing_tiles = set(filter(lambda key: self.tile_in_view(*key), self.missing_tiles))
+
 	# Return the indicated tile as a Cairo surface or None
 	# if it is not (yet) available.
 	def load_tile(self, zoom, x, y, may_download):
-		filename, pending = self.downloader.load_tile(zoom, x, y, may_download)
+		priority = self.tile_priority(zoom, x, y)
+		source, pending = self.downloader.load_tile(zoom, x, y, may_download, priority=priority)
 		if pending:
-			self.missing_tiles[zoom] = self.missing_tiles.get(zoom, 0) + 1
-		if filename is not None:
-			try:
-				return self.tile_class(self, filename, zoom, x, y)
-			except MapTileError as e:
-				self.feedback.debug(1, " %s" % str(e))
+			self.missing_tiles.add((zoom, x, y))
+		if source is not None:
+			if self.decoder is not None:
+				# The decoder will deliver the tile to tile_decoded_cb().
+				self.decoder.enqueue(source, zoom, x, y, priority)
+				if self.tile_in_view(zoom, x, y):
+					self.missing_tiles.add((zoom, x, y))
+				return None
+			return self.decode_tile(source, zoom, x, y)
 		return None
 
+	# Turn a tile from the disk cache into a tile object. When there
+	# is a decoder this is called from its threads.
+	def decode_tile(self, source, zoom, x, y):
+		try:
+			return self.tile_class(self, source, zoom, x, y)
+		except MapTileError as e:
+			self.feedback.debug(1, " %s" % str(e))
+			return None
+
 	# The tile downloader calls this when the tile has been received
 	# and is waiting in the disk cache. Note that it is called from
 	# the downloader thread, so we have to schedual the work
@@ -114,9 +166,12 @@ class MapTileLayerHTTP(MapTileLayer):
 		self.feedback.debug(2, "Tile received: %d %d,%d %s" % (zoom, x, y, str(modified)))
 
 		# If the tile was modified, dump it from the RAM cache whether
-		# it is still needed or not.
+		# it is still needed or not. If the old copy is being parsed,
+		# the result must be thrown away.
 		if modified:
 			self.ram_cache_invalidate(zoom, x, y)
+			if self.decoder is not None and self.decoder.discard((zoom, x, y)):
+				self.stale_decodes.add((zoom, x, y))
 
 		# If this tile is still needed.
 		if self.tile_in_view(zoom, x, y):
@@ -126,8 +181,8 @@ class MapTileLayerHTTP(MapTileLayer):
 				self.redraw_needed = True
 
 			# If this is the last tile we were waiting for,
-			self.missing_tiles[zoom] -= 1
-			if self.missing_tiles[zoom] == 0:
+			self.missing_tiles.discard((zoom, x, y))
+			if len(self.missing_tiles) == 0:
 				self.feedback.debug(5, " All tiles in, immediate redraw")
 
 				# If last tile arrived before timer expired,
@@ -143,17 +198,52 @@ class MapTileLayerHTTP(MapTileLayer):
 
 			# If some tiles still out, set a timer at the limit of or patience.
 			else:
-				self.feedback.debug(5, " %d tiles to go" % self.missing_tiles[zoom])
+				self.feedback.debug(5, " %d tiles to go" % len(self.missing_tiles))
 				if self.timer == None:
 					self.timer = gobject.timeout_add(self.tile_wait, self.timer_expired)
 
+	# A decoder thread calls this when it has parsed a tile. As above, the
+	# work is done in the gobject event loop. The tile goes into the RAM
+	# cache in place of the None which load_tile() returned, so the draw
+	# code only ever sees finished tiles.
+	def tile_decoded_cb(self, *args):
+		gobject.idle_add(lambda: self.tile_decoded_cb_idle(*args), priority=gobject.PRIORITY_HIGH)
+	def tile_decoded_cb_idle(self, zoom, x, y, tile):
+		self.feedback.debug(2, "Tile parsed: %d %d,%d" % (zoom, x, y))
+		key = (zoom, x, y)
+		if key in self.stale_decodes:
+			self.feedback.debug(2, " Out of date, will parse again")
+			self.stale_decodes.discard(key)
+			modified = True
+		else:
+			self.ram_cache.put(key, tile)
+			modified = False
+			if tile is not None and self.tile_in_view(zoom, x, y):
+				self.redraw_needed = True
+		self.tile_loaded_cb_idle(zoom, x, y, modified)
+
+	# Tiles near the center of the viewport should be downloaded before
+	# those at the edges. Returns the square of the distance (in tiles)
+	# from the center of the viewport to the center of the tile.
+	def tile_priority(self, zoom, x, y):
+		if zoom != self.int_zoom or self.center_tile is None:
+			return 0
+		center_x, center_y = self.center_tile
+		n = 1 << zoom
+		dx = (x + 0.5 - center_x + n / 2.0) % n - n / 2.0		# x wraps around
+		dy = (y + 0.5 - center_y)
+		return dx * dx + dy * dy
+
+	# Is the indicated tile one of those currently in the viewport? Note that
+	# the x coordinates of tiles wrap around at 180 degrees of longitude.
 	def tile_in_view(self, zoom, x, y):
 		if zoom != self.int_zoom:
 			return False
 		if self.tile_ranges is None:
 			return False
 		x_range_start, x_range_end, y_range_start, y_range_end = self.tile_ranges
-		return (x >= x_range_start and x <= x_range_end and y >= y_range_start and y <= y_range_end)
+		x_in_range = ((x - x_range_start) % (1 << zoom)) <= (x_range_end - x_range_start)
+		return (x_in_range and y >= y_range_start and y <= y_range_end)
 
 	# In order to avoid a redraw storm as the tiles come in we hold
 	# of until either they have all arrived or a timer expires. This
@@ -166,12 +256,15 @@ class MapTileLayerHTTP(MapTileLayer):
 
 	# Load tiles into the cache in anticipation of offline use.
 	def precache_tiles(self, progress, max_zoom):
-		if self.tile_ranges is not None:
+		if self.tile_ranges is not None and self.containing_map.tile_fetch_engine == "select":
+			self.precache_tiles_async(progress, max_zoom)
+		elif self.tile_ranges is not None:
 			downloader = MapTileDownloader(
 				self.tileset,
 				self.containing_map.tile_cache_basedir,
 				feedback=progress,
-				delay=0.1
+				delay=0.1,
+				tile_cache_backend=self.containing_map.tile_cache_backend,
 				)
 	
 			# Start downloading
@@ -196,6 +289,33 @@ class MapTileLayerHTTP(MapTileLayer):
 					y_start *= 2
 					y_end = y_end * 2 + 1
 
+	# Same as precache_tiles() but uses the select()-based fetch engine
+	# to download a whole zoom level at a time.
+	def precache_tiles_async(self, progress, max_zoom):
+		from pykarta.maps.layers.tile_http_async import MapTileDownloaderAsync
+		downloader = MapTileDownloaderAsync(
+			self.tileset,
+			self.containing_map.tile_cache_basedir,
+			feedback=progress,
+			tile_cache_backend=self.containing_map.tile_cache_backend,
+			)
+		x_start, x_end, y_start, y_end = self.tile_ranges
+		total = tile_count(x_end-x_start+1, y_end-y_start+1, max_zoom-self.int_zoom+1)
+		print "Will download %d tiles" % total
+		count = 0
+		for z in range(self.int_zoom, max_zoom+1):
+			tiles = [(z, x, y) for x in range(x_start, x_end+1) for y in range(y_start, y_end+1)]
+			def report(done, zoom_total, count=count, z=z):
+				progress.progress(count + done, total,
+					_("Downloading {layer} tile {count} of {total}, zoom level is {zoom}").format(layer=self.name, count=count+done, total=total, zoom=z)
+					)
+			downloader.prefetch(tiles, report)
+			count += len(tiles)
+			x_start *= 2
+			x_end = x_end * 2 + 1
+			y_start *= 2
+			y_end = y_end * 2 + 1
+
 	def reload_tiles(self):
 		if self.tile_ranges is not None:
 			x_range_start, x_range_end, y_range_start, y_range_end = self.tile_ranges
@@ -204,11 +324,7 @@ class MapTileLayerHTTP(MapTileLayer):
 				for y in range(y_range_start, y_range_end+1):
 					self.ram_cache_invalidate(zoom, x, y)
 					# FIXME: should instead queue for revalidation
-					local_filename = "%s/%s/%d/%d/%d" % (self.containing_map.tile_cache_basedir, self.tileset.key, zoom, x, y)
-					try:
-						os.unlink(local_filename)
-					except OSError:
-						pass
+					self.downloader.cache.delete(zoom, x, y)
 		self.cache_surface = None
 
 #=============================================================================
@@ -218,9 +334,9 @@ class MapTileLayerHTTP(MapTileLayer):
 #=============================================================================
 
 class MapTileDownloader(object):
-	def __init__(self, tileset, tile_cache_basedir, done_callback=None, feedback=None, delay=None):
+	def __init__(self, tileset, tile_cache_basedir, done_callback=None, feedback=None, delay=None, tile_cache_backend="dir"):
 		self.tileset = tileset
-		self.tile_cache_basedir = tile_cache_basedir
+		self.cache = get_tile_cache(tile_cache_backend, tile_cache_basedir, tileset.key)
 		self.feedback = feedback
 		self.done_callback = done_callback
 		self.delay = delay
@@ -228,50 +344,69 @@ class MapTileDownloader(object):
 		if feedback is None:
 			raise AssertionError
 
+		# No more threads are started than can be given connexions. Each
+		# server named in the URL template has its own connexion pool.
+		self.max_threads = self.tileset.max_connections * self.tileset.get_hostname_count()
+
+		# How quickly (in seconds) we would like to work through the queue.
+		# This is used together with the observed latency to decide when
+		# more threads are needed.
+		self.drain_time = 0.5
+
 		# Should we start threads?
 		self.threads = []
 		if self.done_callback:		# multi-threaded mode
-			self.syncer = threading.Condition()
-			self.queue = []
-			for i in range(3):		# number of threads
-				thread = MapTileDownloaderThread(self, name="%s-%d" % (self.tileset.key, i))
-				self.threads.append(thread)
-				thread.start()
+			self.queue = MapTileQueue()
+			self.start_thread()		# more will be started as needed
 		else:						# syncronous mode
-			self.syncer = None
 			self.queue = None
 			self.threads.append(MapTileDownloaderThread(self, name="%s-dummy" % self.tileset.key))
 
-	# If the indicated tile is in the cache and is not too old, return its path
-	# so that the caller can download it. If it is not, and there is no callback
+	# Find the indicated tile in the cache. Returns what the cache backend
+	# returns (None if the tile is not in the cache) and a flag which
+	# is True if the tile is not too old.
+	def cache_lookup(self, zoom, x, y):
+		cached = self.cache.lookup(zoom, x, y)
+		if cached is None:
+			self.feedback.debug(3, " Not in cache")
+			return (None, False)
+
+		cachefile_age = (float(time.time() - cached[1]) / 86400.0)
+		self.feedback.debug(4, " Cache file age: %s" % cachefile_age)
+		if cachefile_age > self.tileset.max_age_in_days:
+			self.feedback.debug(3, " Old in cache")
+			return (cached, False)
+		else:
+			self.feedback.debug(3, " Fresh in cache")
+			return (cached, True)
+
+	# Build the work item for downloading a tile. If we have an old copy,
+	# include its time and ETag so that the server can tell us if it is
+	# still good.
+	def make_item(self, zoom, x, y, cached):
+		remote_filename = self.tileset.get_path(zoom, x, y)
+		if cached is None:
+			return (zoom, x, y, remote_filename, None, None)
+		else:
+			return (zoom, x, y, remote_filename, cached[1], cached[2])
+
+	# If the indicated tile is in the cache and is not too old, return it
+	# (as a filename or file-like object, depending on the cache backend)
+	# so that the caller can load it. If it is not, and there is no callback
 	# function, download it immediately. If there is a callback function, put
-	# it in the queue for a background thread the download.
+	# it in the queue for a background thread the download. Tiles with a lower
+	# priority number are downloaded first.
 	#
 	# Returns:
-	#  filename--None if not (yet) available
+	#  source--None if not (yet) available
 	#  pending--True if a callback is to be expected	
-	def load_tile(self, zoom, x, y, may_download):
+	def load_tile(self, zoom, x, y, may_download, priority=0):
 		debug_args = (self.tileset.key, zoom, x, y)
 		self.feedback.debug(1, "Load tile %s %d/%d/%d" % debug_args)
-		local_filename = "%s/%s/%d/%d/%d" % (self.tile_cache_basedir, self.tileset.key, zoom, x, y)
-		result = None
-
-		try:
-			statbuf = os.stat(local_filename)
-		except OSError:
-			statbuf = None
-
-		if statbuf is None:
-			self.feedback.debug(3, " Not in cache")
-		else:
-			cachefile_age = (float(time.time() - statbuf.st_mtime) / 86400.0)
-			self.feedback.debug(4, " Cache file age: %s" % cachefile_age)
-			if cachefile_age > self.tileset.max_age_in_days:
-				self.feedback.debug(3, " Old in cache")
-				result = local_filename
-			else:
-				self.feedback.debug(3, " Fresh in cache")
-				return (local_filename, False)
+		cached, fresh = self.cache_lookup(zoom, x, y)
+		result = cached[0] if cached is not None else None
+		if fresh:
+			return (result, False)
 
 		# The caller may want the tile only if it is available instantly.
 		# This is used when using scaled up tiles from a lower zoom level
@@ -280,48 +415,329 @@ class MapTileDownloader(object):
 			self.feedback.debug(2, " Caller does not want to download this tile")
 			return (result, False)
 
-		remote_filename = self.tileset.get_path(zoom, x, y)
+		item = self.make_item(zoom, x, y, cached)
 		if self.done_callback:
 			self.feedback.debug(2, " Added to queue")
-			self.enqueue((zoom, x, y, local_filename, remote_filename, statbuf))
+			self.enqueue(item, priority)
 			return (result, True)
 		else:
 			self.feedback.debug(2, " Downloading syncronously...")
-			if self.threads[0].download_tile_worker(zoom, x, y, local_filename, remote_filename, statbuf):
+			if self.download_now(item):
 				if self.delay:
 					time.sleep(self.delay)
-				return (local_filename, False)
+				cached = self.cache.lookup(zoom, x, y)
+				return (cached[0] if cached is not None else None, False)
 			else:
 				return (None, False)
 
+	# Download a tile in the caller's thread. Returns False if it failed.
+	def download_now(self, item):
+		return self.threads[0].download_tile_worker(*item)
+
 	# Add an item to the work queue for the background threads
-	def enqueue(self, item, clear=False):
-		self.syncer.acquire()
-		if clear:
-			while len(self.queue):
-				self.queue.pop(0)
-		self.queue.insert(0, item)
-		if item is None:			# None is stop signal
-			self.syncer.notifyAll()
-		else:
-			self.syncer.notify()
-		self.syncer.release()
+	def enqueue(self, item, priority=0):
+		if self.queue.put(item[:3], priority, item):
+			self.adjust_threads()
+
+	# Drop queued tiles for which wanted(zoom, x, y) returns False.
+	# Recompute the priority of the rest using priority(zoom, x, y).
+	def cancel_unwanted(self, wanted, priority):
+		if self.queue is not None:
+			dropped = self.queue.prune(wanted, priority)
+			if dropped > 0:
+				self.feedback.debug(2, " %d tiles dropped from %s queue" % (dropped, self.tileset.key))
+
+	# Start enough threads to work through the queue within self.drain_time
+	# seconds if each thread takes as long per tile as recent tiles have taken.
+	def adjust_threads(self):
+		wanted = int(math.ceil(len(self.queue) * self.queue.latency / self.drain_time))
+		wanted = max(1, min(wanted, self.max_threads))
+		while len(self.threads) < wanted:
+			self.start_thread()
+
+	def start_thread(self):
+		thread = MapTileDownloaderThread(self, name="%s-%d" % (self.tileset.key, len(self.threads)))
+		self.feedback.debug(2, " Starting thread %s" % thread.name)
+		self.threads.append(thread)
+		thread.start()
 
 	# This tile downloader is no longer needed. Shut down the background threads.
 	def __del__(self):
 		#print "Destroying tile downloader..."
 		if self.queue is not None:
 			# Tell the threads to stop
-			self.enqueue(None, clear=True)
+			self.queue.stop()
+
+#=============================================================================
+# Queue of tiles waiting to be downloaded by the threads of a MapTileDownloader.
+# Tiles are served in order of priority. Among tiles of equal priority
+# the most recently requested is served first.
+#
+# Each tile appears in the queue only once, no matter how many times it is
+# requested during redraws, and a tile is not queued again while a thread
+# is downloading it.
+#=============================================================================
+class MapTileQueue(object):
+	def __init__(self):
+		self.syncer = threading.Condition()
+		self.heap = []				# [priority, -serial, key, item] lists
+		self.pending = {}			# key to the list in self.heap which is current
+		self.in_flight = set()		# keys of tiles which the threads are downloading
+		self.serial = 0
+		self.stopping = False
+		self.latency = 0.25			# running estimate of seconds per tile
+
+	def __len__(self):
+		return len(self.pending)
+
+	# Add an item unless it is already queued or being downloaded. If it
+	# is already queued, it may be moved up. Returns True if added.
+	def put(self, key, priority, item):
+		self.syncer.acquire()
+		try:
+			if key in self.in_flight:
+				return False
+			old_entry = self.pending.get(key)
+			if old_entry is not None and old_entry[0] <= priority:
+				return False
+			# If there is an old entry, replacing it in self.pending leaves
+			# it in self.heap, but get() will discard it.
+			self.serial += 1
+			entry = [priority, -self.serial, key, item]
+			self.pending[key] = entry
+			heapq.heappush(self.heap, entry)
+			self.syncer.notify()
+			return old_entry is None
+		finally:
+			self.syncer.release()
+
+	# Wait for an item. Returns None if the queue has been stopped or,
+	# if block is False, if it is empty. The caller must call done()
+	# once it has finished with the item.
+	def get(self, block=True):
+		self.syncer.acquire()
+		try:
+			while True:
+				while len(self.heap) < 1 and not self.stopping:
+					if not block:
+						return None
+					self.syncer.wait()
+				if self.stopping:
+					return None
+				entry = heapq.heappop(self.heap)
+				key = entry[2]
+				if self.pending.get(key) is entry:		# if not superseded or pruned,
+					del self.pending[key]
+					self.in_flight.add(key)
+					return entry[3]
+		finally:
+			self.syncer.release()
+
+	def done(self, key):
+		self.syncer.acquire()
+		self.in_flight.discard(key)
+		self.syncer.release()
+
+	# Remove an item if it is queued. Returns True if a thread is
+	# working on it.
+	def discard(self, key):
+		self.syncer.acquire()
+		try:
+			self.pending.pop(key, None)
+			return key in self.in_flight
+		finally:
+			self.syncer.release()
 
-			# Wait for them to stop
-			#for thread in self.threads:
-			#	self.feedback.debug(1, " Waiting for thread %s to stop..." % thread.name)
-			#	thread.join()
-			#self.feedback.debug(1, "All downloader threads have stopped.")
+	# Remove the items whose keys wanted() rejects and reorder the
+	# rest by the priorities which priority() assigns to their keys.
+	# Returns the number of items removed.
+	def prune(self, wanted, priority):
+		self.syncer.acquire()
+		try:
+			dropped = 0
+			heap = []
+			for key, entry in self.pending.items():
+				if wanted(*key):
+					entry[0] = priority(*key)
+					heap.append(entry)
+				else:
+					del self.pending[key]
+					dropped += 1
+			heapq.heapify(heap)
+			self.heap = heap
+			return dropped
+		finally:
+			self.syncer.release()
+
+	# Discard all items and tell the threads to exit.
+	def stop(self):
+		self.syncer.acquire()
+		self.stopping = True
+		self.heap = []
+		self.pending = {}
+		self.syncer.notifyAll()
+		self.syncer.release()
+
+	# The threads call this with the time each download took.
+	def record_latency(self, seconds):
+		self.latency = self.latency * 0.8 + seconds * 0.2
+
+#=============================================================================
+# Parses tiles in background threads
+#
+# Decompressing and decoding a vector tile, projecting its features, and
+# placing its labels can take tens of milliseconds. If it is done in
+# load_tile(), which is called from the expose handler, the map stutters
+# as it is dragged. So when the tiles are loaded lazily, MapTileLayerHTTP
+# gives them to one of these. The threads call decode(source, zoom, x, y)
+# and pass the result to done_callback(zoom, x, y, tile).
+#
+# Since the tile classes are pure Python, more than a couple threads
+# would only contend for the GIL.
+#=============================================================================
+class MapTileDecoder(object):
+	def __init__(self, name, decode, done_callback, feedback=None, max_threads=2):
+		self.name = name
+		self.decode = decode
+		self.done_callback = done_callback
+		self.feedback = feedback
+		self.max_threads = max_threads
+		self.queue = MapTileQueue()
+		self.threads = []
+
+	# Add a tile to the queue. Tiles with a lower priority number are
+	# parsed first.
+	def enqueue(self, source, zoom, x, y, priority=0):
+		if self.queue.put((zoom, x, y), priority, (zoom, x, y, source)):
+			while len(self.threads) < min(len(self.queue), self.max_threads):
+				thread = MapTileDecoderThread(self, name="%s-decoder-%d" % (self.name, len(self.threads)))
+				self.feedback.debug(2, " Starting thread %s" % thread.name)
+				self.threads.append(thread)
+				thread.start()
+
+	# Drop queued tiles for which wanted(zoom, x, y) returns False and
+	# reorder the rest. Returns the (zoom, x, y) of those dropped.
+	def cancel_unwanted(self, wanted, priority):
+		dropped = []
+		def wanted_or_dropped(*key):
+			if wanted(*key):
+				return True
+			dropped.append(key)
+			return False
+		self.queue.prune(wanted_or_dropped, priority)
+		if len(dropped) > 0:
+			self.feedback.debug(2, " %d tiles dropped from %s decoder queue" % (len(dropped), self.name))
+		return dropped
+
+	# Forget a queued tile. Returns True if it is being parsed now.
+	def discard(self, key):
+		return self.queue.discard(key)
+
+	def __del__(self):
+		self.queue.stop()
+
+class MapTileDecoderThread(threading.Thread):
+	def __init__(self, parent, **kwargs):
+		threading.Thread.__init__(self, **kwargs)
+		self.daemon = True
+		self.feedback = parent.feedback
+		self.queue = parent.queue
+		self.decode = parent.decode
+		self.done_callback = parent.done_callback
+
+	def run(self):
+		while True:
+			item = self.queue.get()
+			if item is None:				# signal to stop
+				break
+			zoom, x, y, source = item
+			try:
+				try:
+					tile = self.decode(source, zoom, x, y)
+				except ReferenceError:		# layer is gone
+					break
+				except Exception:
+					traceback.print_exc()
+					tile = None
+			finally:
+				# Before the callback so that, if the result is out of
+				# date, the tile can be queued again.
+				self.queue.done((zoom, x, y))
+			try:
+				self.done_callback(zoom, x, y, tile)
+			except ReferenceError:
+				break
+		self.feedback.debug(2, " Thread %s exiting..." % self.name)
+
+#=============================================================================
+# Persistent HTTP connexions to a single server. Limits the number of
+# connexions which are open at once and keeps idle ones for reuse.
+# All of the downloaders which use a particular server share its pool.
+#=============================================================================
+class MapHTTPConnectionPool(object):
+	def __init__(self, scheme, hostname, max_connections):
+		self.scheme = scheme
+		self.hostname = hostname
+		self.max_connections = max_connections
+		self.syncer = threading.Condition()
+		self.idle = []				# (connexion, time returned) tuples
+		self.active = 0
+
+		# Servers close idle keep-alive connexions after a while. Rather than
+		# find that out by having a request fail, we close them first.
+		self.idle_timeout = 10
+
+	def set_max_connections(self, max_connections):
+		self.syncer.acquire()
+		if max_connections > self.max_connections:
+			self.max_connections = max_connections
+			self.syncer.notifyAll()
+		self.syncer.release()
+
+	# Wait until we are below the connexion limit. Then return an idle
+	# connexion or, if there are none, a new one.
+	def get(self):
+		self.syncer.acquire()
+		try:
+			while self.active >= self.max_connections:
+				self.syncer.wait()
+			self.active += 1
+			while len(self.idle) > 0:
+				conn, returned = self.idle.pop()
+				if (time.time() - returned) < self.idle_timeout:
+					return conn
+				conn.close()
+		finally:
+			self.syncer.release()
+		if self.scheme == "https":
+			return httplib.HTTPSConnection(self.hostname, timeout=30)
+		else:
+			return httplib.HTTPConnection(self.hostname, timeout=30)
+
+	# Give back a connexion obtained from get(). Pass None if it was closed.
+	def put(self, conn):
+		self.syncer.acquire()
+		self.active -= 1
+		if conn is not None:
+			self.idle.append((conn, time.time()))
+		self.syncer.notify()
+		self.syncer.release()
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+def get_connection_pool(scheme, hostname, max_connections):
+	connection_pools_lock.acquire()
+	try:
+		pool = connection_pools.get((scheme, hostname))
+		if pool is None:
+			pool = MapHTTPConnectionPool(scheme, hostname, max_connections)
+			connection_pools[(scheme, hostname)] = pool
 		else:
-			if self.threads[0].conn is not None:
-				self.threads[0].conn.close()
+			pool.set_max_connections(max_connections)
+		return pool
+	finally:
+		connection_pools_lock.release()
 
 class MapTileDownloaderThread(threading.Thread):
 	def __init__(self, parent, **kwargs):
@@ -329,56 +745,63 @@ class MapTileDownloaderThread(threading.Thread):
 		self.daemon = True
 		self.feedback = parent.feedback
 		self.conn = None
-		self.syncer = parent.syncer
 		self.queue = parent.queue
 		self.tileset = parent.tileset
+		self.cache = parent.cache
 		self.done_callback = parent.done_callback
 		self.hostname = self.tileset.get_hostname()
+		self.pool = get_connection_pool(self.tileset.url_template.scheme, self.hostname, self.tileset.max_connections)
 
 	def run(self):
 		while True:
-			self.syncer.acquire()
 			self.feedback.debug(3, "Thread %s is waiting..." % self.name)
-			while len(self.queue) < 1:
-				self.syncer.wait()
-			item = self.queue[0]
-			if item is not None:
-				self.queue.pop(0)
+			item = self.queue.get()
 			self.feedback.debug(3, "Thread %s received item: %s" % (self.name, str(item)))
-			self.syncer.release()
 			if item is None:				# signal to stop
 				break
-			while True:
-				if self.download_tile_worker(*item):
-					break
-				self.feedback.debug(3, "Thread %s sleeping..." % self.name)
-				time.sleep(10)
-		if self.conn is not None:
-			self.conn.close()
+			try:
+				while True:
+					if self.download_tile_worker(*item):
+						break
+					self.feedback.debug(3, "Thread %s sleeping..." % self.name)
+					time.sleep(10)
+			finally:
+				self.queue.done(item[:3])
 		self.feedback.debug(2, " Thread %s exiting..." % self.name)
 
 	def url(self, remote_filename):
 		return "%s://%s%s" % (self.tileset.url_template.scheme, self.hostname, remote_filename)
 
-	def download_tile_worker(self, zoom, x, y, local_filename, remote_filename, statbuf):
+	# Borrow a connexion from the pool, download the tile, and give the
+	# connexion back so that it can be reused by this or another thread.
+	def download_tile_worker(self, zoom, x, y, remote_filename, mtime, etag):
+		self.conn = self.pool.get()
+		start_time = time.time()
+		try:
+			result = self.download_tile(zoom, x, y, remote_filename, mtime, etag)
+		except:
+			self.conn = None
+			raise
+		finally:
+			self.pool.put(self.conn)
+			self.conn = None
+		if result and self.queue is not None:
+			self.queue.record_latency(time.time() - start_time)
+		return result
+
+	def download_tile(self, zoom, x, y, remote_filename, mtime, etag):
 		debug_args = (self.tileset.key, zoom, x, y)
 		self.feedback.debug(2, "Thread %s downloading tile %s %d/%d/%d" % ((self.name,) + debug_args))
 
 		# Download the tile. This uses a persistent connection.
 		try:
-			# Connect if we are not connected already.
-			if self.conn is None:
-				self.feedback.debug(3, " Thread %s opening HTTP connexion to %s..." % (self.name, self.hostname))
-				if self.tileset.url_template.scheme == "https":
-					self.conn = httplib.HTTPSConnection(self.hostname, timeout=30)
-				else:
-					self.conn = httplib.HTTPConnection(self.hostname, timeout=30)
-
 			# Build the HTTP request headers
 			hdrs = {}
 			hdrs.update(self.tileset.extra_headers)
-			if statbuf is not None:
-				hdrs['If-Modified-Since'] = http_date(statbuf.st_mtime)
+			if mtime is not None:
+				hdrs['If-Modified-Since'] = http_date(mtime)
+			if etag is not None:
+				hdrs['If-None-Match'] = etag
 
 			redirect_count = 0
 			while True:
@@ -419,65 +842,19 @@ class MapTileDownloaderThread(threading.Thread):
 			self.conn = None		# close
 			return False
 
-		content_length = response.getheader("content-length")
-		content_type = response.getheader("content-type")
-		self.feedback.debug(5, "  %s/%d/%d/%d: %d %s %s %s bytes" % (debug_args + (response.status, response.reason, content_type, str(content_length))))
-
-		if response.status == 304:
-			self.feedback.debug(1, "  %s/%d/%d/%d: not modified" % debug_args)
-			response.read()					# discard
-			fh = open(local_filename, "a")	# touch
-			fh.close()
-			modified = False
+		try:
+			response_body = response.read()
+		except socket.timeout:		# FIXME: socket is sometimes None. Why?
+			self.feedback.debug(1, "  %s/%d/%d/%d: Socket timeout" % debug_args)
+			self.feedback.error(_("Timeout during download"))
+			self.conn = None		# close
+			return False
 
-		else:
-			if response.status != 200:
-				self.feedback.debug(1, "  %s/%d/%d/%d: %s: unacceptable response status: %d %s" % (debug_args + (self.url(remote_filename), response.status, response.reason)))
-				response_body = response.read()
-				if response_body != "" and content_type is not None and content_type.startswith("text/"):
-					self.feedback.debug(1, "%s" % response_body.strip())
-				return True	 				# give up on tile
+		modified = save_tile_response(self.feedback, self.cache, (zoom, x, y), self.url(remote_filename),
+			response.status, response.reason, response.getheader, response_body)
+		if modified is None:
+			return True						# give up on tile
 
-			if not content_type.startswith("image/") and content_type != "application/json":
-				self.feedback.debug(1, "  %s/%d/%d/%d: non-image MIME type: %s" % (debug_args + (content_type,)))
-				response_body = response.read()
-				if content_type.startswith("text/"):
-					if response.getheader("content-encoding") == "gzip":
-						response_body = gzip.GzipFile(fileobj=StringIO(response_body)).read()
-					self.feedback.debug(1, "%s" % response_body.strip())
-				return True	 				# give up on tile
-	
-			if content_length is not None and int(content_length) == 0:
-				self.feedback.debug(1, "  %s/%d/%d/%d: empty response" % debug_args)
-				response.read()
-				return True					# give up on tile
-	
-			# Make the cache directory which holds this tile, if it does not exist already.
-			local_dirname = os.path.dirname(local_filename)
-			if not os.path.exists(local_dirname):
-				# This may fail if another thread creates.
-				try:
-					os.makedirs(local_dirname)
-				except OSError, e:
-					if e.errno != errno.EEXIST:
-						raise
-	
-			# Save the file in such a manner that there is never a partial tile with the final name.
-			cachefile = SaveAtomically(local_filename)
-			try:
-				cachefile.write(response.read())
-			except socket.timeout:		# FIXME: socket is sometimes None. Why?
-				self.feedback.debug(1, "  %s/%d/%d/%d: Socket timeout" % debug_args)
-				self.feedback.error(_("Timeout during download"))
-				self.conn = None		# close
-				return False
-			try:
-				cachefile.close()
-			except OSError, e:
-				print "FIXME: OSError: %d" % e.errno
-
-			modified = True
-	
 		# Tell the tile layer that the tile is ready so that it can redraw.
 		if self.done_callback:
 			try:
@@ -487,6 +864,56 @@ class MapTileDownloaderThread(threading.Thread):
 
 		return True
 
+#=============================================================================
+# Act on the server's response to a request for a tile. If it contains
+# the tile, save the tile in the cache. This is shared by the threads
+# above and by the select()-based engine in tile_http_async.py.
+#
+# Returns:
+#  True--a new or modified tile has been saved
+#  False--the server says the cached tile is still good
+#  None--there is no usable tile, give up
+#=============================================================================
+
+# Types other than image/* which we accept from vector tile servers
+vector_tile_mime_types = (
+	"application/json",
+	"application/vnd.mapbox-vector-tile",
+	"application/x-protobuf",
+	)
+
+def save_tile_response(feedback, cache, key, url, status, reason, getheader, response_body):
+	debug_args = (cache.tileset_key,) + key
+	content_length = getheader("content-length")
+	content_type = getheader("content-type")
+	feedback.debug(5, "  %s/%d/%d/%d: %d %s %s %s bytes" % (debug_args + (status, reason, content_type, str(content_length))))
+
+	if status == 304:
+		feedback.debug(1, "  %s/%d/%d/%d: not modified" % debug_args)
+		cache.touch(*key)
+		return False
+
+	if status != 200:
+		feedback.debug(1, "  %s/%d/%d/%d: %s: unacceptable response status: %d %s" % (debug_args + (url, status, reason)))
+		if response_body != "" and content_type is not None and content_type.startswith("text/"):
+			feedback.debug(1, "%s" % response_body.strip())
+		return None
+
+	if content_type is None or (not content_type.startswith("image/") and content_type.split(";")[0].strip() not in vector_tile_mime_types):
+		feedback.debug(1, "  %s/%d/%d/%d: non-image MIME type: %s" % (debug_args + (content_type,)))
+		if content_type is not None and content_type.startswith("text/"):
+			if getheader("content-encoding") == "gzip":
+				response_body = gzip.GzipFile(fileobj=StringIO(response_body)).read()
+			feedback.debug(1, "%s" % response_body.strip())
+		return None
+
+	if (content_length is not None and int(content_length) == 0) or response_body == "":
+		feedback.debug(1, "  %s/%d/%d/%d: empty response" % debug_args)
+		return None
+
+	cache.store(*(key + (response_body, getheader("etag"))))
+	return True
+
 #=============================================================================
 # Clean the tile cache created by MapTileDownloader
 #=============================================================================
@@ -517,6 +944,13 @@ class MapCacheCleaner(threading.Thread):
 		tilesets = []
 		tilesets_count = 0
 		for tileset in os.listdir(self.cache_root):
+			# Caches created by MapTileCacheSqlite have an index on the
+			# time each tile was fetched, so cleaning them is quick.
+			if tileset.endswith(".mbtiles"):
+				self.clean_sqlite(tileset[:-8])
+				continue
+			if not os.path.isdir(os.path.join(self.cache_root, tileset)):
+				continue
 			tilesets_count += 1
 			touchfile = os.path.join(self.cache_root, tileset, ".last-cleaned")
 			if os.path.exists(touchfile):
@@ -576,18 +1010,30 @@ class MapCacheCleaner(threading.Thread):
 
 		print "Cache cleaner: finished"
 
+	# Tiles in the SQLite cache are revalidated (which updates their
+	# time) when they are used after max_age_in_days. So the time is
+	# a stand-in for the time the tile was last used.
+	def clean_sqlite(self, tileset):
+		print "Cache cleaner: cleaning %s.mbtiles..." % tileset
+		cache = get_tile_cache("sqlite", self.cache_root, tileset)
+		deleted, left = cache.expire(self.delete_if_before)
+		print "Cache cleaner: %d of %d tiles removed from %s.mbtiles" % (deleted, deleted + left, tileset)
+
 # Substitute for MapTileDownloader() for use when the map is in offline mode.
 class MapTileCacheLoader(object):
-	def __init__(self, tileset, tile_cache_basedir, feedback=None):
+	def __init__(self, tileset, tile_cache_basedir, feedback=None, tile_cache_backend="dir"):
 		self.tileset = tileset
-		self.tile_cache_basedir = tile_cache_basedir
+		self.cache = get_tile_cache(tile_cache_backend, tile_cache_basedir, tileset.key)
 		self.feedback = feedback
 
-	def load_tile(self, zoom, x, y, may_download):
+	def load_tile(self, zoom, x, y, may_download, priority=0):
 		self.feedback.debug(1, "Load tile %s %d/%d/%d" % (self.tileset.key, zoom, x, y))
-		local_filename = "%s/%s/%d/%d/%d" % (self.tile_cache_basedir, self.tileset.key, zoom, x, y)
-		if os.path.exists(local_filename):
-			return (local_filename, False)
+		cached = self.cache.lookup(zoom, x, y)
+		if cached is not None:
+			return (cached[0], False)
 		else:
 			return (None, False)
 
+	def cancel_unwanted(self, wanted, priority):
+		pass
+
@@ -0,0 +1,636 @@
+# encoding=utf-8
+# pykarta/maps/layers/tile_http_async.py
+# Copyright 2013--2018, Trinity College
+# Last modified: 30 May 2018
+#
+# An alternative to the thread-per-connexion tile downloader in tile_http.py.
+# A single thread multiplexes all of the HTTP connexions of all of the
+# tile layers using select(). This lets us have many requests in flight
+# at once without a thread (and its stack) for each of them.
+
+import os
+import errno
+import socket
+import select
+import ssl
+import heapq
+import threading
+import weakref
+import time
+import traceback
+
+from pykarta.misc.http import http_date
+from pykarta.maps.layers.tile_http import MapTileDownloader, MapTileQueue, save_tile_response
+from pykarta.maps.layers.tile_cache import get_tile_cache
+from pykarta.misc import BoundMethodProxy
+
+#=============================================================================
+# Drop-in replacement for MapTileDownloader which hands its queue to the
+# shared MapTileFetchEngine rather than starting threads of its own.
+#=============================================================================
+class MapTileDownloaderAsync(MapTileDownloader):
+	def __init__(self, tileset, tile_cache_basedir, done_callback=None, feedback=None, delay=None, tile_cache_backend="dir"):
+		self.tileset = tileset
+		self.cache = get_tile_cache(tile_cache_backend, tile_cache_basedir, tileset.key)
+		self.feedback = feedback
+		self.done_callback = done_callback
+		self.delay = delay
+
+		if self.tileset.url_template.scheme not in ("http", "https"):
+			raise AssertionError
+
+		# How many times to try a tile before giving up. In lazy mode
+		# we keep trying until the tile is no longer wanted (see
+		# still_wanted()).
+		self.max_attempts = None if self.done_callback else 5
+
+		# Threads which are waiting for particular tiles, a list
+		# of events for each tile
+		self.waiters = {}
+		self.waiters_lock = threading.Lock()
+
+		# The last function passed to cancel_unwanted(). The engine asks
+		# it whether a tile which failed is still wanted before retrying.
+		self.wanted = None
+
+		self.threads = []
+		self.queue = MapTileQueue()
+		self.engine = get_fetch_engine()
+		self.engine.add_downloader(self)
+
+	def enqueue(self, item, priority=0):
+		if self.queue.put(item[:3], priority, item):
+			self.engine.wakeup()
+
+	# Enqueue the tile and wait for the engine to finish with it.
+	def download_now(self, item):
+		event = self.add_waiter(item[:3])
+		self.enqueue(item)
+		event.wait()
+		return event.result
+
+	# Download those of the indicated tiles which are missing from the cache
+	# or too old and wait until the engine is done with all of them.
+	# The progress function, if supplied, is called with the number of
+	# tiles finished and the total.
+	def prefetch(self, tiles, progress=None):
+		events = []
+		for zoom, x, y in tiles:
+			cached, fresh = self.cache_lookup(zoom, x, y)
+			if not fresh:
+				events.append(self.add_waiter((zoom, x, y)))
+				self.enqueue(self.make_item(zoom, x, y, cached))
+		total = len(tiles)
+		already = total - len(events)
+		while True:
+			# Tiles may finish in any order, so wait for one which has not.
+			unfinished = filter(lambda event: not event.is_set(), events)
+			if progress is not None:
+				progress(already + len(events) - len(unfinished), total)
+			if len(unfinished) == 0:
+				break
+			unfinished[0].wait(0.25)
+		return len(filter(lambda event: event.result, events))
+
+	# As in MapTileDownloader, but remember wanted() for still_wanted().
+	def cancel_unwanted(self, wanted, priority):
+		MapTileDownloader.cancel_unwanted(self, wanted, priority)
+		self.wanted = BoundMethodProxy(wanted)
+
+	# Should the engine try again to download this tile? It should if a
+	# thread is waiting for it or if it is still in the viewport.
+	def still_wanted(self, key):
+		if key in self.waiters or self.wanted is None:
+			return True
+		try:
+			return self.wanted(*key)
+		except ReferenceError:
+			return False
+
+	def add_waiter(self, key):
+		event = threading.Event()
+		event.result = False
+		self.waiters_lock.acquire()
+		self.waiters.setdefault(key, []).append(event)
+		self.waiters_lock.release()
+		return event
+
+	# Called by the engine when it is done with a tile, whether
+	# or not the tile could be downloaded.
+	def fetch_finished(self, item, success):
+		key = item[:3]
+		self.queue.done(key)
+		self.waiters_lock.acquire()
+		events = self.waiters.pop(key, [])
+		self.waiters_lock.release()
+		for event in events:
+			event.result = success
+			event.set()
+
+	def __del__(self):
+		self.queue.stop()
+		self.engine.wakeup()
+
+#=============================================================================
+# The fetch engine. There is only one. It is started the first time
+# a MapTileDownloaderAsync is created.
+#=============================================================================
+fetch_engine = None
+fetch_engine_lock = threading.Lock()
+
+def get_fetch_engine():
+	global fetch_engine
+	fetch_engine_lock.acquire()
+	try:
+		if fetch_engine is None:
+			fetch_engine = MapTileFetchEngine()
+			fetch_engine.start()
+		return fetch_engine
+	finally:
+		fetch_engine_lock.release()
+
+class MapTileFetchEngine(threading.Thread):
+	def __init__(self):
+		threading.Thread.__init__(self, name="tile-fetch-engine")
+		self.daemon = True
+		self.downloaders = []			# weak references to MapTileDownloaderAsync objects
+		self.downloaders_lock = threading.Lock()
+		self.hosts = {}					# (scheme, hostname) to MapFetchHost
+		self.connections = []			# all open connexions, busy or idle
+		self.delayed = []				# heap of (time, serial, MapTileFetch) waiting to be retried
+		self.serial = 0
+
+		# Other threads write to this pipe to interrupt select().
+		self.wakeup_r, self.wakeup_w = os.pipe()
+
+		# Give up on a connexion if nothing happens for this many seconds.
+		self.timeout = 30
+
+		# Wait before retrying a failed download. This is doubled with
+		# each failure up to max_retry_delay.
+		self.retry_delay = 2
+		self.max_retry_delay = 60
+
+	def add_downloader(self, downloader):
+		self.downloaders_lock.acquire()
+		self.downloaders.append(weakref.ref(downloader))
+		self.downloaders_lock.release()
+
+	# Called from other threads when they have put something in a queue
+	def wakeup(self):
+		try:
+			os.write(self.wakeup_w, "x")
+		except OSError:
+			pass
+
+	def run(self):
+		while True:
+			try:
+				self.step()
+			except Exception:
+				traceback.print_exc()
+				time.sleep(1)
+
+	def step(self):
+		now = time.time()
+		self.start_delayed(now)
+		self.start_queued()
+
+		rlist = [self.wakeup_r]
+		wlist = []
+		deadline = None
+		for conn in self.connections:
+			want_read, want_write = conn.wants()
+			if want_read:
+				rlist.append(conn)
+			if want_write:
+				wlist.append(conn)
+			if deadline is None or conn.deadline < deadline:
+				deadline = conn.deadline
+		if len(self.delayed) > 0 and (deadline is None or self.delayed[0][0] < deadline):
+			deadline = self.delayed[0][0]
+		timeout = None if deadline is None else max(0, deadline - now)
+
+		try:
+			readable, writable, exceptional = select.select(rlist, wlist, [], timeout)
+		except select.error, e:
+			if e.args[0] == errno.EINTR:
+				return
+			raise
+
+		if self.wakeup_r in readable:
+			os.read(self.wakeup_r, 4096)
+			readable.remove(self.wakeup_r)
+
+		for conn in set(readable + writable):
+			conn.handle_io()
+
+		now = time.time()
+		for conn in self.connections[:]:
+			if conn.deadline <= now:
+				conn.handle_timeout()
+
+	# Start requests for queued tiles until the queues are empty or the
+	# per-server connexion limits are reached. We take one tile from each
+	# downloader in turn so that no layer is starved.
+	def start_queued(self):
+		self.downloaders_lock.acquire()
+		downloaders = []
+		for ref in self.downloaders[:]:
+			downloader = ref()
+			if downloader is None or downloader.queue.stopping:
+				self.downloaders.remove(ref)
+			else:
+				downloaders.append(downloader)
+		self.downloaders_lock.release()
+
+		while len(downloaders) > 0:
+			for downloader in downloaders[:]:
+				host = self.find_host(downloader.tileset)
+				item = downloader.queue.get(block=False) if host is not None else None
+				if item is None:
+					downloaders.remove(downloader)
+				else:
+					self.dispatch(MapTileFetch(downloader, item), host)
+
+	# Retry downloads whose time has come
+	def start_delayed(self, now):
+		while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+			when, serial, fetch = self.delayed[0]
+			downloader = fetch.downloader_ref()
+			if downloader is None:
+				heapq.heappop(self.delayed)
+				continue
+			if downloader.queue.stopping or not downloader.still_wanted(fetch.item[:3]):
+				heapq.heappop(self.delayed)
+				downloader.fetch_finished(fetch.item, False)
+				continue
+			host = self.find_host(downloader.tileset)
+			if host is None:
+				break
+			heapq.heappop(self.delayed)
+			self.dispatch(fetch, host)
+
+	# Return a server for the tileset which has a free connexion slot
+	# or None if they are all busy.
+	def find_host(self, tileset):
+		for i in range(tileset.get_hostname_count()):
+			key = (tileset.url_template.scheme, tileset.get_hostname())
+			host = self.hosts.get(key)
+			if host is None:
+				host = MapFetchHost(key[0], key[1], tileset.max_connections)
+				self.hosts[key] = host
+			else:
+				host.max_connections = max(host.max_connections, tileset.max_connections)
+			if host.active < host.max_connections:
+				return host
+		return None
+
+	def dispatch(self, fetch, host):
+		fetch.host = host
+		host.active += 1
+		conn = host.get_idle()
+		if conn is None:
+			try:
+				conn = MapFetchConnection(self, host)
+			except socket.gaierror, msg:
+				host.active -= 1
+				self.fetch_failed(fetch, _("Address lookup error: %s: %s") % (host.hostname, msg))
+				return
+			except socket.error, msg:
+				host.active -= 1
+				self.fetch_failed(fetch, _("socket error: %s") % msg)
+				return
+			self.connections.append(conn)
+		conn.send_request(fetch)
+
+	# Called by the connexion when a complete response has arrived
+	def response_received(self, conn, fetch, status, reason, headers, body):
+		fetch.host.active -= 1
+		if conn.keep_alive:
+			fetch.host.put_idle(conn)
+		else:
+			self.close_connection(conn)
+
+		downloader = fetch.downloader_ref()
+		zoom, x, y = fetch.item[:3]
+		debug_args = (fetch.tileset.key, zoom, x, y)
+
+		if status == 302:
+			location = headers.get("location", "")
+			fetch.redirects += 1
+			if not location.startswith("/") or fetch.redirects > 5:
+				if downloader is not None:
+					downloader.feedback.error(_("Tile %s/%d/%d/%d: Redirect loop") % debug_args)
+					downloader.fetch_finished(fetch.item, False)
+			else:
+				fetch.path = location
+				self.retry(fetch, 0)
+			return
+
+		if downloader is None:
+			return
+
+		modified = save_tile_response(downloader.feedback, downloader.cache, (zoom, x, y), fetch.url(),
+			status, reason, headers.get, body)
+		downloader.queue.record_latency(time.time() - fetch.start_time)
+
+		if modified is not None and downloader.done_callback:
+			try:
+				downloader.done_callback(zoom, x, y, modified)
+			except ReferenceError:
+				downloader.feedback.debug(1, " Fetch engine misses tile layer")
+
+		downloader.fetch_finished(fetch.item, True)
+
+	# Called by the connexion when the request could not be completed.
+	# If retry_now is true, the connexion was an idle one which the server
+	# had closed, so there is no reason to suppose that a new one will fail.
+	def request_failed(self, conn, fetch, message, retry_now=False):
+		fetch.host.active -= 1
+		self.close_connection(conn)
+		if retry_now:
+			self.retry(fetch, 0)
+		else:
+			self.fetch_failed(fetch, message)
+
+	def fetch_failed(self, fetch, message):
+		downloader = fetch.downloader_ref()
+		if downloader is None:
+			return
+		zoom, x, y = fetch.item[:3]
+		downloader.feedback.error(_("Tile %s/%d/%d/%d: %s") % (fetch.tileset.key, zoom, x, y, message))
+		fetch.attempts += 1
+		if downloader.max_attempts is not None and fetch.attempts >= downloader.max_attempts:
+			downloader.fetch_finished(fetch.item, False)
+		else:
+			self.retry(fetch, min(self.max_retry_delay, self.retry_delay * 2 ** (fetch.attempts - 1)))
+
+	def retry(self, fetch, delay):
+		self.serial += 1
+		heapq.heappush(self.delayed, (time.time() + delay, self.serial, fetch))
+
+	def close_connection(self, conn):
+		conn.close()
+		fetch_host = conn.host
+		if conn in fetch_host.idle:
+			fetch_host.idle.remove(conn)
+		if conn in self.connections:
+			self.connections.remove(conn)
+
+#=============================================================================
+# A tile to be downloaded, together with the state of the attempt
+#=============================================================================
+class MapTileFetch(object):
+	def __init__(self, downloader, item):
+		self.downloader_ref = weakref.ref(downloader)
+		self.tileset = downloader.tileset
+		self.item = item					# (zoom, x, y, remote_filename, mtime, etag)
+		self.path = item[3]
+		self.host = None
+		self.attempts = 0
+		self.redirects = 0
+		self.start_time = None
+
+	def url(self):
+		return "%s://%s%s" % (self.host.scheme, self.host.hostname, self.path)
+
+#=============================================================================
+# A server from which tiles are downloaded. Keeps count of the connexions
+# in use and a list of idle ones.
+#=============================================================================
+class MapFetchHost(object):
+	def __init__(self, scheme, hostname, max_connections):
+		self.scheme = scheme
+		self.hostname = hostname
+		self.max_connections = max_connections
+		self.active = 0
+		self.idle = []
+		self.address = None			# result of getaddrinfo()
+		self.idle_timeout = 10
+
+	# The first lookup blocks. The result is kept for the life of the program.
+	def resolve(self):
+		if self.address is None:
+			hostname, sep, port = self.hostname.partition(":")
+			if port == "":
+				port = 443 if self.scheme == "https" else 80
+			self.address = socket.getaddrinfo(hostname, int(port), 0, socket.SOCK_STREAM)[0]
+		return self.address
+
+	def get_idle(self):
+		if len(self.idle) > 0:
+			return self.idle.pop()
+		return None
+
+	def put_idle(self, conn):
+		conn.deadline = time.time() + self.idle_timeout
+		self.idle.append(conn)
+
+#=============================================================================
+# Non-blocking HTTP/1.1 client connexion. It is driven by the engine
+# which calls handle_io() when select() says the socket is ready.
+#=============================================================================
+class MapFetchConnection(object):
+	def __init__(self, engine, host):
+		self.engine = engine
+		self.host = host
+		self.fetch = None
+		self.keep_alive = False
+		self.requests = 0			# number of requests sent on this connexion
+		self.want_read = False
+		self.want_write = True
+		self.deadline = time.time() + engine.timeout
+
+		family, socktype, proto, canonname, sockaddr = host.resolve()
+		self.sock = socket.socket(family, socktype, proto)
+		self.sock.setblocking(False)
+		error = self.sock.connect_ex(sockaddr)
+		if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+			self.sock.close()
+			raise socket.error(error, os.strerror(error))
+		self.state = "connecting"
+
+	def fileno(self):
+		return self.sock.fileno()
+
+	def wants(self):
+		if self.state == "idle":
+			return (True, False)		# so that we notice if the server closes it
+		return (self.want_read, self.want_write)
+
+	def close(self):
+		self.state = "closed"
+		try:
+			self.sock.close()
+		except socket.error:
+			pass
+
+	def send_request(self, fetch):
+		self.fetch = fetch
+		fetch.start_time = time.time()
+		zoom, x, y, remote_filename, mtime, etag = fetch.item
+		hdrs = [("Host", self.host.hostname), ("User-Agent", "PyKarta")]
+		hdrs.extend(fetch.tileset.extra_headers.items())
+		if mtime is not None:
+			hdrs.append(("If-Modified-Since", http_date(mtime)))
+		if etag is not None:
+			hdrs.append(("If-None-Match", etag))
+		self.outbuf = "GET %s HTTP/1.1\r\n%s\r\n" % (fetch.path, "".join(map(lambda hdr: "%s: %s\r\n" % hdr, hdrs)))
+		self.inbuf = ""
+		self.status = None
+		self.received = False
+		self.requests += 1
+		self.deadline = time.time() + self.engine.timeout
+		if self.state == "idle":
+			self.state = "sending"
+			self.want_read, self.want_write = (False, True)
+
+	def handle_timeout(self):
+		if self.state == "idle":
+			self.engine.close_connection(self)
+		else:
+			self.fail(_("Timeout during download"))
+
+	def fail(self, message):
+		fetch = self.fetch
+		self.fetch = None
+		retry_now = self.requests > 1 and not self.received
+		self.engine.request_failed(self, fetch, message, retry_now)
+
+	def handle_io(self):
+		try:
+			self.deadline = time.time() + self.engine.timeout
+			if self.state == "connecting":
+				error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+				if error != 0:
+					raise socket.error(error, os.strerror(error))
+				if self.host.scheme == "https":
+					context = ssl.create_default_context()
+					self.sock = context.wrap_socket(self.sock, server_hostname=self.host.hostname.partition(":")[0], do_handshake_on_connect=False)
+					self.state = "handshake"
+				else:
+					self.state = "sending"
+			if self.state == "handshake":
+				self.sock.do_handshake()
+				self.state = "sending"
+			if self.state == "sending":
+				sent = self.sock.send(self.outbuf)
+				self.outbuf = self.outbuf[sent:]
+				self.want_read, self.want_write = (False, True)
+				if self.outbuf == "":
+					self.state = "reading"
+					self.want_read, self.want_write = (True, False)
+				return
+			if self.state == "reading":
+				self.read()
+				return
+			if self.state == "idle":
+				# Data or EOF on an idle connexion means that the server has closed it.
+				self.engine.close_connection(self)
+		except ssl.SSLWantReadError:
+			self.want_read, self.want_write = (True, False)
+		except ssl.SSLWantWriteError:
+			self.want_read, self.want_write = (False, True)
+		except (socket.error, ssl.SSLError), msg:
+			if getattr(msg, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK):
+				return
+			if self.state == "idle":
+				self.engine.close_connection(self)
+			else:
+				self.fail(_("socket error: %s") % msg)
+
+	def read(self):
+		data = self.sock.recv(65536)
+		eof = (data == "")
+		while not eof and isinstance(self.sock, ssl.SSLSocket) and self.sock.pending() > 0:
+			data += self.sock.recv(self.sock.pending())
+		if data != "":
+			self.received = True
+			self.inbuf += data
+		body = self.parse(eof)
+		if body is not None:
+			self.finish(body)
+		elif eof:
+			self.fail(_("no response") if self.status is None else _("connexion closed during download"))
+
+	# Parse what we have received so far. Returns the body once it is complete.
+	def parse(self, eof):
+		if self.status is None:
+			i = self.inbuf.find("\r\n\r\n")
+			if i == -1:
+				return None
+			lines = self.inbuf[:i].split("\r\n")
+			self.inbuf = self.inbuf[i+4:]
+			try:
+				self.version, status, self.reason = (lines[0].split(" ", 2) + [""])[:3]
+				self.status = int(status)
+			except ValueError:
+				raise socket.error("BadStatusLine")
+			self.headers = {}
+			for line in lines[1:]:
+				name, sep, value = line.partition(":")
+				self.headers[name.strip().lower()] = value.strip()
+			self.chunks = None
+			self.chunk_size = None
+			self.content_length = None
+			if self.status in (204, 304):
+				self.content_length = 0
+			elif self.headers.get("transfer-encoding", "").lower() == "chunked":
+				self.chunks = []
+			elif "content-length" in self.headers:
+				try:
+					self.content_length = int(self.headers["content-length"])
+				except ValueError:
+					raise socket.error("BadContentLength")
+				if self.content_length < 0:
+					raise socket.error("BadContentLength")
+
+		if self.chunks is not None:
+			return self.parse_chunks()
+		if self.content_length is not None:
+			if len(self.inbuf) >= self.content_length:
+				body = self.inbuf[:self.content_length]
+				self.inbuf = ""
+				return body
+			return None
+		if eof:								# body ends when the server closes
+			self.headers["connection"] = "close"
+			return self.inbuf
+		return None
+
+	def parse_chunks(self):
+		while True:
+			if self.chunk_size is None:		# expecting a chunk header
+				i = self.inbuf.find("\r\n")
+				if i == -1:
+					return None
+				try:
+					self.chunk_size = int(self.inbuf[:i].split(";")[0], 16)
+				except ValueError:
+					raise socket.error("BadChunkSize")
+				if self.chunk_size < 0:
+					raise socket.error("BadChunkSize")
+				self.inbuf = self.inbuf[i+2:]
+			if self.chunk_size == 0:		# last chunk, skip the trailer
+				if not self.inbuf.startswith("\r\n") and self.inbuf.find("\r\n\r\n") == -1:
+					return None
+				self.inbuf = ""
+				return "".join(self.chunks)
+			if len(self.inbuf) < self.chunk_size + 2:
+				return None
+			self.chunks.append(self.inbuf[:self.chunk_size])
+			self.inbuf = self.inbuf[self.chunk_size+2:]
+			self.chunk_size = None
+
+	def finish(self, body):
+		connection = self.headers.get("connection", "").lower()
+		if self.version == "HTTP/1.1":
+			self.keep_alive = (connection != "close")
+		else:
+			self.keep_alive = (connection == "keep-alive")
+		fetch = self.fetch
+		self.fetch = None
+		if self.keep_alive:
+			self.state = "idle"
+		self.engine.response_received(self, fetch, self.status, self.reason, self.headers, body)
@@ -14,9 +14,9 @@ class MapTileLayerMbtiles(MapTileLayer):
 	def __init__(self, mbtiles_filename):
 		MapTileLayer.__init__(self, MapRasterTile)
 
-		import sqlite3
-		self.conn = sqlite3.connect(mbtiles_filename)
-		self.cursor = self.conn.cursor()
+		self.mbtiles_filename = mbtiles_filename
+		self.inherited_conns = []
+		self.open()
 
 		self.tileset = MapTilesetRaster(mbtiles_filename,
 			zoom_min = int(self.fetch_metadata_item('minzoom', 0)),
@@ -28,6 +28,17 @@ class MapTileLayerMbtiles(MapTileLayer):
 		self.opts.zoom_max = self.tileset.zoom_max
 		self.opts.attribution = self.tileset.attribution
 
+	def open(self):
+		import sqlite3
+		self.conn = sqlite3.connect(self.mbtiles_filename)
+		self.cursor = self.conn.cursor()
+
+	# The connexion inherited from the parent is kept but never used
+	# (see MapTileCacheSqlite.reopen()).
+	def reopen(self):
+		self.inherited_conns.append(self.conn)
+		self.open()
+
 	def fetch_metadata_item(self, name, default):
 		self.cursor.execute("select value from metadata where name = ?", (name,))
 		result = self.cursor.fetchone()
@@ -1,8 +1,8 @@
 # encoding=utf-8
 # pykarta/maps/layers/tile_rndr_geojson.py
-# Base class for GeoJSON vector tile renderers
+# Base class for GeoJSON and Mapbox Vector Tile renderers
 # Copyright 2013--2018, Trinity College
-# Last modified: 24 May 2018
+# Last modified: 31 May 2018
 
 from __future__ import print_function
 try:
@@ -10,16 +10,29 @@ try:
 except ImportError:
 	import json
 import gzip
+import zlib
 import os
 import math
 import time
+import weakref
 import re
 
-from pykarta.geometry.projection import project_to_tilespace_pixel
+from pykarta.geometry.projection import project_to_tilespace_pixel, project_to_tilespace_pixels_flat
 from pykarta.geometry import Polygon
+from pykarta.geometry.packed import PackedPoints, new_coords_buffer
+from pykarta.formats.mvt import MvtTile, MvtLayer, MVT_POINT, MVT_LINESTRING, MVT_POLYGON
 from pykarta.draw import place_line_label, place_line_shields, polygon as draw_polygon, line_string as draw_line_string, line_string as draw_line_string, stroke_with_style, fill_with_style
 
+# Load a (possibly gzipped) JSON file. Accepts a filename
+# or a file-like object such as the tile cache may supply.
 def json_loader(filename):
+	if hasattr(filename, "read"):
+		try:
+			parsed_json = json.load(gzip.GzipFile(fileobj=filename, mode="rb"))
+		except IOError:
+			filename.seek(0)
+			parsed_json = json.load(filename)
+		return parsed_json
 	try:
 		f = gzip.GzipFile(filename, "rb")
 		parsed_json = json.load(f)
@@ -28,6 +41,24 @@ def json_loader(filename):
 		parsed_json = json.load(f)
 	return parsed_json
 
+# Load a (possibly gzipped) vector tile in either GeoJSON or Mapbox Vector
+# Tile format. Returns parsed JSON or an MvtTile. Accepts a filename or
+# a file-like object.
+def vector_tile_loader(filename):
+	if hasattr(filename, "read"):
+		data = filename.read()
+	else:
+		f = open(filename, "rb")
+		data = f.read()
+		f.close()
+	if data[:2] == "\x1f\x8b":
+		data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+	# A vector tile starts with a layer (field 3, length delimited).
+	# JSON can never start with this byte.
+	if data == "" or data[0] == "\x1a":
+		return MvtTile(data)
+	return json.loads(data)
+
 def _project_to_tilespace_pixels(coordinates, zoom, xtile, ytile):
 	return map(lambda p: project_to_tilespace_pixel(p[1], p[0], zoom, xtile, ytile), coordinates)
 
@@ -51,6 +82,8 @@ def project_to_tilespace_pixels(coordinates, zoom, xtile, ytile):
 # Base class for a tile which renders GeoJSON
 class MapGeoJSONTile(object):
 	draw_passes = 1					# draw1(), override for draw2(), etc.
+	label_passes = ()				# passes (counting from 0) which draw labels
+	decode_in_thread = True			# may be parsed in a background thread (see tile_http.py)
 	clip = None						# None for no clipping, or number of pixels beyond tile border
 	sort_key = None
 
@@ -67,29 +100,41 @@ class MapGeoJSONTile(object):
 
 		self.tileset = layer.tileset
 		self.dedup = layer.dedup
-		self.containing_map = layer.containing_map
+		self.containing_map = weakref.proxy(layer.containing_map)	# don't keep map alive from RAM cache
 
 		self.points = []
 		self.lines = []
 		self.polygons = []
 
+		# The lines and polygons are PackedPoints objects
+		# which refer to coordinates in this buffer.
+		self.coords = new_coords_buffer()
+
 		self.line_labels = []
 		self.line_shields = []
 		self.polygon_labels = []
 
-		# Load the data, uncompress it, and parse the JSON into Python objects
+		# Load the data, uncompress it, and parse the JSON or protobuf into Python objects
 		if self.timing_load:
 			self._elapsed_start("Parsing %s %s %d %d %d..." % (layer.tileset.key, type(self).__name__, zoom, x, y))
 		if data is not None:
-			parsed_json = data
+			parsed = data
 		else:
-			parsed_json = json_loader(filename)
+			parsed = vector_tile_loader(filename)
 
 		if self.timing_load:
 			self._elapsed()
 
-		# Interpret the JSON (now in the form of Python dicts and lists) as GeoJSON
-		self.load_geojson(parsed_json)
+		# A vector tile served for a single layer has just the one layer
+		if isinstance(parsed, MvtTile):
+			parsed = parsed.first_layer()
+
+		# Interpret the vector tile layer or the JSON (now in the form
+		# of Python dicts and lists) as GeoJSON
+		if isinstance(parsed, MvtLayer):
+			self.load_mvt(parsed)
+		elif parsed is not None:
+			self.load_geojson(parsed)
 
 		if self.label_lines:
 
@@ -125,15 +170,13 @@ class MapGeoJSONTile(object):
 						#label_center = polygon_obj.choose_label_center()
 
 						# For now we will compute a bounding box and put the label at the center.
-						min_x = 255
-						max_x = 0
-						min_y = 255
-						max_y = 0
-						for x, y in polygon:
-							min_x = min(min_x, x)
-							max_x = max(max_x, x)
-							min_y = min(min_y, y)
-							max_y = max(max_y, y)
+						if len(polygon) < 1:
+							continue
+						min_x, min_y, max_x, max_y = polygon.get_bbox()
+						min_x = min(min_x, 255)
+						max_x = max(max_x, 0)
+						min_y = min(min_y, 255)
+						max_y = max(max_y, 0)
 						area = ((max_x - min_x) * (max_y - min_y))
 						label_center = ((max_x + min_x) / 2, (max_y + min_y) / 2)
 
@@ -155,6 +198,11 @@ class MapGeoJSONTile(object):
 		lines = self.lines
 		polygons = self.polygons
 
+		# The lines and polygons are gathered here and then projected
+		# all at once, which is much faster if NumPy is available.
+		pending = []				# (list, id, properties, style)
+		coordinate_lists = []
+
 		assert geojson['type'] == 'FeatureCollection'
 		features = geojson['features']
 		if self.sort_key is not None:
@@ -190,24 +238,24 @@ class MapGeoJSONTile(object):
 				if geometry_type == 'LineString':
 					style = self.choose_line_style(properties)
 					if style is not None:
-						line = project_to_tilespace_pixels(coordinates, self.zoom, self.x, self.y)
-						lines.append((id, line, properties, style))
+						pending.append((lines, id, properties, style))
+						coordinate_lists.append(coordinates)
 					continue
 	
 				if geometry_type == 'MultiLineString':
 					style = self.choose_line_style(properties)
 					if style is not None:
 						for coordinates2 in coordinates:
-							line = project_to_tilespace_pixels(coordinates2, self.zoom, self.x, self.y)
-							lines.append((id, line, properties, style))
+							pending.append((lines, id, properties, style))
+							coordinate_lists.append(coordinates2)
 					continue
 	
 				if geometry_type == 'Polygon':
 					style = self.choose_polygon_style(properties)
 					if style is not None:
 						for coordinates2 in coordinates:
-							polygon = project_to_tilespace_pixels(coordinates2, self.zoom, self.x, self.y)
-							polygons.append((id, polygon, properties, style))
+							pending.append((polygons, id, properties, style))
+							coordinate_lists.append(coordinates2)
 					continue
 	
 				if geometry_type == 'MultiPolygon':
@@ -215,12 +263,66 @@ class MapGeoJSONTile(object):
 					if style is not None:
 						for coordinates2 in coordinates:
 							for coordinates3 in coordinates2:
-								polygon = project_to_tilespace_pixels(coordinates3, self.zoom, self.x, self.y)
-								polygons.append((id, polygon, properties, style))
+								pending.append((polygons, id, properties, style))
+								coordinate_lists.append(coordinates3)
 					continue
 	
 				print("Warning: unimplemented geometry type:", feature)
 
+		coords = self.coords
+		start = len(coords)
+		coords.extend(project_to_tilespace_pixels_flat(coordinate_lists, self.zoom, self.x, self.y))
+		for (feature_list, id, properties, style), coordinates in zip(pending, coordinate_lists):
+			end = start + len(coordinates) * 2
+			feature_list.append((id, PackedPoints(coords, start, end), properties, style))
+			start = end
+
+	# Load a layer of a Mapbox Vector Tile. Its coordinates are already
+	# relative to this tile, so they need only be scaled to pixels.
+	def load_mvt(self, layer):
+		points = self.points
+		lines = self.lines
+		polygons = self.polygons
+		coords = self.coords
+		scale = 256.0 / layer.extent
+
+		features = layer.features
+		if self.sort_key is not None:
+			features = sorted(features, key=lambda feature: feature.properties[self.sort_key])
+
+		for feature in features:
+			id = feature.id
+			properties = feature.properties
+			geometry_type = feature.type
+
+			if geometry_type == MVT_POINT:
+				style = self.choose_point_style(properties)
+				if style is not None:
+					for point in feature.get_parts(scale):
+						points.append((id, tuple(point), properties, style))
+
+			elif geometry_type == MVT_LINESTRING:
+				style = self.choose_line_style(properties)
+				if style is not None:
+					for line in feature.get_parts(scale):
+						lines.append((id, PackedPoints.pack(coords, line), properties, style))
+
+			elif geometry_type == MVT_POLYGON:
+				style = self.choose_polygon_style(properties)
+				if style is not None:
+					for ring in feature.get_parts(scale):
+						polygons.append((id, PackedPoints.pack(coords, ring), properties, style))
+
+			else:
+				print("Warning: unimplemented MVT geometry type:", geometry_type)
+
+	# Rough estimate of the memory occupied by this tile for the RAM cache.
+	def get_ram_size(self):
+		size = 1024 + 512 * (len(self.points) + len(self.lines) + len(self.polygons))
+		size += self.coords.itemsize * len(self.coords)
+		size += 256 * (len(self.line_labels) + len(self.line_shields) + len(self.polygon_labels))
+		return size
+
 	# Performance timer
 	def _elapsed_start(self, message):
 		print(" %s" % message, end="")
@@ -288,6 +390,8 @@ class MapGeoJSONTile(object):
 
 	@staticmethod
 	def scale_points(points, scale):
+		if isinstance(points, PackedPoints):
+			return points.scaled(scale)
 		return map(lambda point: (point[0]*scale,point[1]*scale), points)
 
 	# Use the supplied rule to determine the width of a feature
@@ -42,7 +42,8 @@ class MapTileset(object):
 			overzoom=True,				# enlarge tiles if lower layer allows more zoom
 			attribution=None,			# string or Cairo surface with logo or credit statement
 			max_age_in_days=30,			# how long to use files from cache
-			api_key_name=None
+			api_key_name=None,
+			max_connections=2			# limit on simultaneous connexions to each server
 			):
 		self.key = key
 		self.tile_class = tile_class
@@ -55,6 +56,7 @@ class MapTileset(object):
 		self.overzoom = overzoom
 		self.attribution = attribution
 		self.max_age_in_days = max_age_in_days
+		self.max_connections = max_connections
 		self.api_key_name = api_key_name
 		self.api_key = None
 		self.saturation = None			# FIXME: only implemented for raster
@@ -104,6 +106,12 @@ class MapTileset(object):
 		self.server_number = ((self.server_number + 1) % len(self.subdomains))
 		return self.url_template.netloc.replace("{s}", self.subdomains[self.server_number])
 
+	# How many different servers will get_hostname() rotate through?
+	def get_hostname_count(self):
+		if "{s}" in self.url_template.netloc:
+			return len(self.subdomains)
+		return 1
+
 	# Returns the path for the GET request to retrieve a particular tile.
 	# This implements the simple case of a URL template. Override in
 	# derived classes in order to support other schemes.
@@ -188,13 +196,24 @@ class MapTilesetWMS(MapTilesetRaster):
 		return path
 
 # Describes a set of vector tiles
+# If the URL template contains {format}, it is replaced with tile_format
+# or, if that is None, with pykarta.vector_tile_format.
 class MapTilesetVector(MapTileset):
-	def __init__(self, key, tile_class, zoom_max=16, renderer=None, zoom_substitutions=None, **kwargs):
-		MapTileset.__init__(self, key, tile_class, zoom_max=zoom_max, **kwargs)
+	def __init__(self, key, tile_class, zoom_max=16, renderer=None, zoom_substitutions=None, max_connections=8, tile_format=None, **kwargs):
+		MapTileset.__init__(self, key, tile_class, zoom_max=zoom_max, max_connections=max_connections, **kwargs)
 		self.extra_headers["Accept-Encoding"] = "gzip,deflate"
 		self.zoom_substitutions = zoom_substitutions
 		self.layer_cache_enabled = True
 		self.symbols = None
+		self.tile_format = tile_format
+
+	def late_init(self):
+		MapTileset.late_init(self)
+		if self.url_template is not None:
+			tile_format = self.tile_format or pykarta.vector_tile_format
+			self.url_template = self.url_template._replace(
+				path = self.url_template.path.replace("{format}", tile_format)
+				)
 
 tilesets = MapTilesets()
 
@@ -2,7 +2,7 @@
 # pykarta/maps/layers/tilesets_osm_vec.py
 # Vector tile sets and renderers for them
 # Copyright 2013--2018, Trinity College
-# Last modified: 25 May 2018
+# Last modified: 31 May 2018
 
 # http://colorbrewer2.org/ is helpful for picking color palates for maps.
 
@@ -13,9 +13,10 @@ import cairo
 import math
 import re
 import math
+import threading
 
 from tilesets_base import tilesets, MapTilesetVector
-from pykarta.maps.layers.tile_rndr_geojson import MapGeoJSONTile, json_loader
+from pykarta.maps.layers.tile_rndr_geojson import MapGeoJSONTile, vector_tile_loader
 from pykarta.maps.symbols import MapSymbolSet
 from pykarta.draw import \
 	draw_line_label_stroked as draw_line_label, \
@@ -49,6 +50,7 @@ class MapOsmLanduseTile(MapGeoJSONTile):
 		'color':(0.5, 0.5, 0.5),
 		}
 	draw_passes = 2	# set to 2 to enable labels, 1 to disable
+	label_passes = (1,)
 	label_polygons = True
 	def choose_polygon_style(self, properties):
 		landuse = properties.get("landuse", "?")
@@ -67,7 +69,7 @@ class MapOsmLanduseTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-landuse',
 	tile_class=MapOsmLanduseTile,
-	url_template="tiles/osm-vector-landuse/{z}/{x}/{y}.geojson", 
+	url_template="tiles/osm-vector-landuse/{z}/{x}/{y}.{format}", 
 	attribution=u"Map © OpenStreetMap contributors",
 	zoom_min=10,
 	))
@@ -116,7 +118,7 @@ class MapOsmWaterwaysTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-waterways',
 	tile_class=MapOsmWaterwaysTile,
-	url_template="tiles/osm-vector-waterways/{z}/{x}/{y}.geojson",
+	url_template="tiles/osm-vector-waterways/{z}/{x}/{y}.{format}",
 	zoom_min=11,		# at lower zooms osm-vector-water is enough
 	zoom_max=16,
 	))
@@ -129,7 +131,7 @@ class MapOsmWaterTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-water',
 	tile_class=MapOsmWaterTile,
-	url_template="tiles/osm-vector-water/{z}/{x}/{y}.geojson", 
+	url_template="tiles/osm-vector-water/{z}/{x}/{y}.{format}", 
 	attribution=u"Map © OpenStreetMap contributors",
 	zoom_min=4,
 	))
@@ -140,6 +142,7 @@ tilesets.append(MapTilesetVector('osm-vector-water',
 class MapOsmBuildingsTile(MapGeoJSONTile):
 	label_polygons = True
 	draw_passes = 2
+	label_passes = (1,)
 	label_style = {
 		'font-size':8,
 		'font-weight':'normal',
@@ -157,7 +160,7 @@ class MapOsmBuildingsTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-buildings',
 	tile_class=MapOsmBuildingsTile,
-	url_template="tiles/osm-vector-buildings/{z}/{x}/{y}.geojson", 
+	url_template="tiles/osm-vector-buildings/{z}/{x}/{y}.{format}", 
 	attribution=u"Map © OpenStreetMap contributors",
 	zoom_min=13,
 	))
@@ -429,7 +432,7 @@ class MapOsmRoadsTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-roads',
 	tile_class=MapOsmRoadsTile,
-	url_template="tiles/osm-vector-roads/{z}/{x}/{y}.geojson", 
+	url_template="tiles/osm-vector-roads/{z}/{x}/{y}.{format}", 
 	attribution=u"Map © OpenStreetMap contributors",
 	zoom_min=6,
 	))
@@ -437,7 +440,7 @@ tilesets.append(MapTilesetVector('osm-vector-roads',
 #-----------------------------------------------------------------------------
 
 class MapOsmRoadLabelsTile(MapGeoJSONTile):
-
+	label_passes = (0,)
 	label_lines = True
 
 	fontsizes = {
@@ -494,7 +497,7 @@ class MapOsmRoadLabelsTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-road-labels',
 	tile_class=MapOsmRoadLabelsTile,
-	url_template="tiles/osm-vector-road-labels/{z}/{x}/{y}.geojson", 
+	url_template="tiles/osm-vector-road-labels/{z}/{x}/{y}.{format}", 
 	attribution=u"Map © OpenStreetMap contributors",
 	zoom_min=10,
 	zoom_max=16,
@@ -567,7 +570,7 @@ class MapOsmAdminBordersTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-admin-borders',
 	tile_class=MapOsmAdminBordersTile,
-	url_template="tiles/osm-vector-admin-borders/{z}/{x}/{y}.geojson",
+	url_template="tiles/osm-vector-admin-borders/{z}/{x}/{y}.{format}",
 	zoom_min=4,
 	zoom_max=16,
 	))
@@ -575,15 +578,22 @@ tilesets.append(MapTilesetVector('osm-vector-admin-borders',
 #-----------------------------------------------------------------------------
 
 class MapOsmPoisTile(MapGeoJSONTile):
+	label_passes = (0,)
 	label_style = {
 		'font-size':8,
 		}
+	symbols_lock = threading.Lock()		# tiles may be parsed in several threads at once
 	def __init__(self, layer, filename, zoom, x, y, data=None):
-		if layer.tileset.symbols is None:
-			layer.tileset.symbols = MapSymbolSet()
-			path = os.path.join(os.path.dirname(__file__), "symbols")
-			for symbol in glob.glob("%s/*.svg" % path):
-				layer.tileset.symbols.add_symbol(symbol)
+		self.symbols_lock.acquire()
+		try:
+			if layer.tileset.symbols is None:
+				symbols = MapSymbolSet()
+				path = os.path.join(os.path.dirname(__file__), "symbols")
+				for symbol in glob.glob("%s/*.svg" % path):
+					symbols.add_symbol(symbol)
+				layer.tileset.symbols = symbols
+		finally:
+			self.symbols_lock.release()
 		MapGeoJSONTile.__init__(self, layer, filename, zoom, x, y, data)
 	def choose_point_style(self, properties):
 		amenity = properties.get("amenity")
@@ -604,7 +614,7 @@ class MapOsmPoisTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-pois',
 	tile_class=MapOsmPoisTile,
-	url_template="tiles/osm-vector-pois/{z}/{x}/{y}.geojson", 
+	url_template="tiles/osm-vector-pois/{z}/{x}/{y}.{format}", 
 	attribution=u"Map © OpenStreetMap contributors",
 	zoom_min=15,
 	))
@@ -612,6 +622,7 @@ tilesets.append(MapTilesetVector('osm-vector-pois',
 #-----------------------------------------------------------------------------
 
 class MapOsmPlacesTile(MapGeoJSONTile):
+	label_passes = (0,)
 	#sort_key = 'sort_key'
 	place_label_sizes = {
 		'state':    (6, 12, 16, 32),		# comes in at z5, goes out at z13
@@ -663,13 +674,29 @@ class MapOsmPlacesTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('osm-vector-places',
 	tile_class=MapOsmPlacesTile,
-	url_template="tiles/osm-vector-places/{z}/{x}/{y}.geojson",
+	url_template="tiles/osm-vector-places/{z}/{x}/{y}.{format}",
 	zoom_min=4,
 	zoom_max=14,
 	))
 
 #-----------------------------------------------------------------------------
 
+# Which passes of a MapOsmTile draw labels
+def combined_label_passes(tile_classes):
+	label_passes = []
+	start = 0
+	for layer_name, tile_class in tile_classes:
+		label_passes.extend([start + i for i in tile_class.label_passes])
+		start += tile_class.draw_passes
+	return tuple(label_passes)
+
+# The clip attribute of the tile class which draws each pass
+def combined_pass_clips(tile_classes):
+	pass_clips = []
+	for layer_name, tile_class in tile_classes:
+		pass_clips.extend([tile_class.clip] * tile_class.draw_passes)
+	return tuple(pass_clips)
+
 class MapOsmTile(object):
 	draw_passes = 12
 	tile_classes = (
@@ -683,11 +710,14 @@ class MapOsmTile(object):
 		("places", MapOsmPlacesTile),
 		("pois", MapOsmPoisTile),
 		)
+	label_passes = combined_label_passes(tile_classes)
+	pass_clips = combined_pass_clips(tile_classes)
+	decode_in_thread = True
 	def __init__(self, layer, filename, zoom, x, y, data=None):
-		parsed_json = json_loader(filename)
+		parsed = vector_tile_loader(filename)
 		self.passes = []
 		for layer_name, tile_class in self.tile_classes:
-			layer_data = parsed_json.get(layer_name)
+			layer_data = parsed.get(layer_name)
 			if layer_data is not None:
 				tile = tile_class(layer, None, zoom, x, y, data=layer_data)
 			else:
@@ -695,6 +725,12 @@ class MapOsmTile(object):
 			for i in range(tile_class.draw_passes):
 				self.passes.append((tile, i))
 		assert len(self.passes) == self.draw_passes
+	def get_ram_size(self):
+		size = 0
+		for tile, i in self.passes:
+			if tile is not None and i == 0:		# each subtile once
+				size += tile.get_ram_size()
+		return size
 	def draw(self, ctx, scale, draw_pass):
 		tile, i = self.passes[draw_pass]
 		if tile is not None:
@@ -702,7 +738,7 @@ class MapOsmTile(object):
 
 tilesets.append(MapTilesetVector('osm-vector',
 	tile_class=MapOsmTile,
-	url_template="tiles/osm-vector/{z}/{x}/{y}.geojson",
+	url_template="tiles/osm-vector/{z}/{x}/{y}.{format}",
 	zoom_min=4,
 	zoom_max=16,
 	))
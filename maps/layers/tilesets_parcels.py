@@ -2,7 +2,7 @@
 # pykarta/maps/layers/tilesets_parcel.py
 # Vector tile sets and renderers for them
 # Copyright 2013--2018, Trinity College
-# Last modified: 13 May 2018
+# Last modified: 31 May 2018
 
 import math
 import json
@@ -15,6 +15,7 @@ import pykarta.draw
 class MapParcelsTile(MapGeoJSONTile):
 	clip = 0
 	draw_passes = 2
+	label_passes = (1,)
 	def __init__(self, layer, filename, zoom, x, y):
 		MapGeoJSONTile.__init__(self, layer, filename, zoom, x, y)
 		self.labels = []
@@ -44,7 +45,7 @@ class MapParcelsTile(MapGeoJSONTile):
 
 tilesets.append(MapTilesetVector('parcels-pykarta',
 	tile_class=MapParcelsTile,
-	url_template="tiles/parcels/{z}/{x}/{y}.geojson",
+	url_template="tiles/parcels/{z}/{x}/{y}.{format}",
 	zoom_min=14,
 	zoom_max=16,
 	))
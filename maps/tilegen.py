@@ -1,37 +1,54 @@
 # pykarta/maps/tilegen.py
 # Copyright 2013--2017, Trinity College
-# Last modified: 3 February 2015
+# Last modified: 31 May 2018
 
 import cairo
 import os
 import StringIO
 import re
+import time
+import itertools
+import multiprocessing
+import signal
 
 from pykarta.maps import MapBase
+from pykarta.maps.layers.tile_cache import reopen_tile_caches
 from pykarta.geometry import BoundingBox
-from pykarta.misc import tile_count
 import pyapp.i18n
 from pykarta.geometry.projection import project_to_tilespace, unproject_from_tilespace
 
 # This is a Pykarta map object which produces map tiles as its output.
 # But rather than stitch them together on a Cairo surface, it saves
 # them to a tile store using a tile store object provided by the caller.
+#
+# If metatile_size is greater than one, the tiles are drawn in square
+# groups of that many tiles on a side (metatiles) and then cut apart.
+# The layers then set up their viewport and project and draw features
+# which cross tile boundaries once per metatile rather than once per
+# tile, and labels near the edges of tiles are not cut off.
 class MapTilegen(MapBase):
-	def __init__(self, writer, **kwargs):
+	def __init__(self, writer, metatile_size=1, **kwargs):
 		kwargs['tile_source'] = None
 		MapBase.__init__(self, **kwargs)
 		self.writer = writer
+		self.metatile_size = metatile_size
 		self.re_blank_surface = re.compile('^\0+$')
 
-	# Render a single object and store it in the tile store.
+	# Render a single tile. Returns it as PNG data or None if it is blank.
 	def render_tile(self, x, y, zoom):
+		return self.render_metatile(x, y, zoom, 1)[0][2]
+
+	# Render the size by size block of tiles whose top left tile is
+	# x, y. Returns a list of (x, y, tile_data) for its tiles. Tile_data
+	# is None for blank tiles.
+	def render_metatile(self, x, y, zoom, size):
 		self.top_left_pixel = (x, y)
 		self.zoom = zoom
-		self.width = 256
-		self.height = 256
-		self.lat, self.lon = unproject_from_tilespace(x + 0.5, y + 0.5, zoom)
+		self.width = 256 * size
+		self.height = 256 * size
+		self.lat, self.lon = unproject_from_tilespace(x + size / 2.0, y + size / 2.0, zoom)
 
-		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 256, 256)
+		surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
 		ctx = cairo.Context(surface)
 
 		for layer in self.layers_ordered:
@@ -39,6 +56,28 @@ class MapTilegen(MapBase):
 			layer.do_draw(ctx)
 
 		surface.flush()
+		if size == 1:
+			return [(x, y, self.surface_to_png(surface))]
+
+		# Nothing to cut up?
+		if self.re_blank_surface.match(surface.get_data()):
+			return [(x + dx, y + dy, None) for dx in range(size) for dy in range(size)]
+
+		# Copy each tile in turn to a tile-sized surface
+		tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, 256, 256)
+		tile_ctx = cairo.Context(tile)
+		tile_ctx.set_operator(cairo.OPERATOR_SOURCE)
+		results = []
+		for dx in range(size):
+			for dy in range(size):
+				tile_ctx.set_source_surface(surface, -256 * dx, -256 * dy)
+				tile_ctx.paint()
+				tile.flush()
+				results.append((x + dx, y + dy, self.surface_to_png(tile)))
+		return results
+
+	# Return the contents of a surface as PNG data or None if it is blank.
+	def surface_to_png(self, surface):
 		data = surface.get_data()
 		if self.re_blank_surface.match(data):
 			return None
@@ -47,32 +86,167 @@ class MapTilegen(MapBase):
 			surface.write_to_png(sio)
 			return sio.getvalue()
 
-	# Render all of the tiles required to cover the sum of the bounding
-	# boxes of all of the layers.
-	def render_tiles(self, zoom_start, zoom_stop):
+	# Render the tiles of a block. Returns the block's key, the number
+	# of tiles in it, and a list of (zoom, x, y, tile_data) for those
+	# which are not blank.
+	def render_block(self, block):
+		key, tiles = block
+		zoom = key[0]
+		size = min(self.metatile_size, 1 << zoom)
+		wanted = set(tiles)
+		metatiles = sorted(set([(x - x % size, y - y % size) for tile_zoom, x, y in tiles]))
+		results = []
+		for meta_x, meta_y in metatiles:
+			#print "render_metatile(%d, %d, %d, %d)" % (meta_x, meta_y, zoom, size)
+			for x, y, tile_data in self.render_metatile(meta_x, meta_y, zoom, size):
+				if tile_data is not None and (zoom, x, y) in wanted:
+					results.append((zoom, x, y, tile_data))
+				#else:
+				#	print " blank tile"
+		return (key, len(tiles), results)
+
+	# Divide the tiles required to cover the sum of the bounding boxes
+	# of all of the layers into square blocks of block_size tiles on a
+	# side. The blocks are aligned to multiples of block_size so that
+	# their keys, (zoom, x, y, block_size) of the top left tile, do not
+	# change if the bounding box does.
+	def plan_blocks(self, zoom_start, zoom_stop, block_size):
 		bbox = BoundingBox()
 		for layer in self.layers_ordered:
 			bbox.add_bbox(layer.get_bbox())
 
-		x_start, y_start = map(int, project_to_tilespace(bbox.max_lat, bbox.min_lon, zoom_start))
-		x_stop, y_stop = map(int, project_to_tilespace(bbox.min_lat, bbox.max_lon, zoom_start))
-		total = tile_count(x_stop-x_start+1, y_stop-y_start+1, zoom_stop-zoom_start+1)
-
-		count = 0
+		blocks = []
 		for zoom in range(zoom_start, zoom_stop+1):
 			x_start, y_start = map(int, project_to_tilespace(bbox.max_lat, bbox.min_lon, zoom))
 			x_stop, y_stop = map(int, project_to_tilespace(bbox.min_lat, bbox.max_lon, zoom))
-			for x in range(x_start-1, x_stop+2):
-				for y in range(y_start-1, y_stop+2):
-					#print "render_tile(%d, %d, %d)" % (x, y, zoom)
-					if (count % 73) == 0:	# 73 speeds things while letting all of the digits change
-						self.feedback.progress(count, total, _("Rending tile {count} of {total}").format(count=count, total=total))
-					tile_data = self.render_tile(x, y, zoom)
-					if tile_data is not None:
-						self.writer.add_tile(zoom, x, y, tile_data)
-					#else:
-					#	print " blank tile"
-					count += 1
+			x_start, y_start = x_start - 1, y_start - 1		# one tile of margin all around
+			x_stop, y_stop = x_stop + 1, y_stop + 1
+			for block_x in range(x_start // block_size * block_size, x_stop+1, block_size):
+				for block_y in range(y_start // block_size * block_size, y_stop+1, block_size):
+					tiles = []
+					for x in range(max(block_x, x_start), min(block_x + block_size - 1, x_stop) + 1):
+						for y in range(max(block_y, y_start), min(block_y + block_size - 1, y_stop) + 1):
+							tiles.append((zoom, x, y))
+					blocks.append(((zoom, block_x, block_y, block_size), tiles))
+		return blocks
+
+	# Render all of the tiles required to cover the sum of the bounding
+	# boxes of all of the layers.
+	#
+	# If processes is greater than one, the blocks of tiles are divided
+	# among that many worker processes. Each is forked from this one and
+	# so has its own copy of the layers. The tiles are sent back here
+	# and given to the writer.
+	#
+	# If the name of a checkpoint file is supplied, the blocks which have
+	# been rendered and committed to the writer are recorded in it and
+	# are skipped if the same run is started again.
+	def render_tiles(self, zoom_start, zoom_stop, processes=1, checkpoint=None, block_size=8, commit_interval=10.0):
+		# Blocks should be made of whole metatiles
+		if block_size % self.metatile_size != 0:
+			block_size += self.metatile_size - block_size % self.metatile_size
+
+		blocks = self.plan_blocks(zoom_start, zoom_stop, block_size)
+		total = sum([len(tiles) for key, tiles in blocks])
+
+		count = 0
+		if checkpoint is not None:
+			checkpoint = MapTilegenCheckpoint(checkpoint)
+			count = sum([len(tiles) for key, tiles in blocks if key in checkpoint])
+			blocks = [block for block in blocks if not block[0] in checkpoint]
+			if count > 0:
+				print "Resuming: %d of %d tiles already rendered" % (count, total)
+
+		if processes > 1:
+			global tilegen_worker_map
+			tilegen_worker_map = self
+			pool = multiprocessing.Pool(processes, tilegen_worker_init)
+			results = pool.imap_unordered(tilegen_worker, blocks)
+		else:
+			pool = None
+			results = itertools.imap(self.render_block, blocks)
+
+		uncommitted = []
+		last_commit = time.time()
+		try:
+			for key, tiles_in_block, tiles in results:
+				for zoom, x, y, tile_data in tiles:
+					self.writer.add_tile(zoom, x, y, tile_data)
+				uncommitted.append(key)
+				count += tiles_in_block
+				self.feedback.progress(count, total, _("Rending tile {count} of {total}").format(count=count, total=total))
+				if (time.time() - last_commit) >= commit_interval:
+					self.commit_blocks(checkpoint, uncommitted)
+					uncommitted = []
+					last_commit = time.time()
+			if pool is not None:
+				pool.close()
+		except:
+			if pool is not None:
+				pool.terminate()
+			raise
+		finally:
+			if pool is not None:
+				pool.join()
+			self.commit_blocks(checkpoint, uncommitted)
+			if checkpoint is not None:
+				checkpoint.close()
+
+	# Commit the tiles to the writer and then record the blocks from
+	# which they came in the checkpoint file.
+	def commit_blocks(self, checkpoint, keys):
+		self.writer.commit()
+		if checkpoint is not None:
+			checkpoint.add(keys)
+
+# The worker processes of MapTilegen.render_tiles() find the map here
+tilegen_worker_map = None
+
+# Leave Ctrl-C to the parent, which will terminate the workers.
+# Open new connexions to the databases which the layers use since
+# those inherited from the parent must not be used.
+def tilegen_worker_init():
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	reopen_tile_caches()
+	for layer in tilegen_worker_map.layers_ordered:
+		layer.reopen()
+
+def tilegen_worker(block):
+	return tilegen_worker_map.render_block(block)
+
+# The blocks of tiles which a run of MapTilegen.render_tiles() has
+# completed. The file has a line "zoom x y block_size" for each. A
+# partial line left by an interrupted write is ignored.
+class MapTilegenCheckpoint(object):
+	def __init__(self, filename):
+		self.done = set()
+		partial = False
+		if os.path.exists(filename):
+			with open(filename, "r") as f:
+				for line in f:
+					partial = not line.endswith("\n")
+					try:
+						zoom, x, y, block_size = map(int, line.split())
+					except ValueError:
+						continue
+					if not partial:
+						self.done.add((zoom, x, y, block_size))
+		self.fh = open(filename, "a")
+		if partial:
+			self.fh.write("\n")
+
+	def __contains__(self, key):
+		return key in self.done
+
+	def add(self, keys):
+		for key in keys:
+			self.fh.write("%d %d %d %d\n" % key)
+			self.done.add(key)
+		self.fh.flush()
+		os.fsync(self.fh.fileno())
+
+	def close(self):
+		self.fh.close()
 
 # Test
 if __name__ == "__main__":
@@ -80,8 +80,7 @@ class MapWidget(gtk.DrawingArea, MapBase):
 			for layer in self.layers_ordered:
 				self.feedback.debug(2, " %s" % layer.name)
 				start_time = time.time()
-				layer.cache_surface = None
-				layer.do_viewport()
+				layer.do_viewport()		# layer.do_draw_cached() will decide whether layer.cache_surface is still of use
 				self.elapsed(layer.name, start_time)
 				layer.stale = False
 			for layer in self.layers_osd:
@@ -321,7 +320,9 @@ class MapPrint(MapCairo):
 			self,
 			tile_source=None,
 			tile_cache_basedir=map_widget.tile_cache_basedir,
-			feedback=MapPrintProgress(main_window)
+			feedback=MapPrintProgress(main_window),
+			tile_fetch_engine=map_widget.tile_fetch_engine,
+			tile_cache_backend=map_widget.tile_cache_backend,
 			)
 
 		# Load the same map symbols as the MapWidget has
@@ -0,0 +1,102 @@
+#! /usr/bin/python
+# pykarta/server/build_address_index.py
+# Add lookup tables to the OpenAddresses database
+# Last modified: 31 May 2018
+#
+# Usage: build_address_index.py [--datadir DIR]
+#
+# The addresses table of openaddresses.sqlite holds the street, city, and
+# state as they appear in the source data. The geocoder module would have
+# to try several queries to find an address and could not match "Elm St"
+# to "Elm Street". So this adds:
+#
+# address_streets -- each distinct street, city, and state, normalized
+#   using the functions in pykarta.address and given a number
+# address_keys -- each address with a house number, by street number,
+#   with a covering index so that a lookup never reads the table itself
+# address_ranges -- an R*Tree of the house number ranges by street
+#   number, for addresses which give a range rather than a number
+#
+# When these tables are present the geocoder module finds an address with
+# one query. Run this again whenever openaddresses.sqlite is reloaded.
+
+from __future__ import print_function
+import os, sys, time
+import argparse
+import sqlite3
+
+try:
+	import pykarta
+except ImportError:
+	sys.path.insert(1, "../..")
+
+from pykarta.server.modules.geocoder_openaddresses import street_key, city_key, state_key
+
+def build_streets(cursor):
+	cursor.execute("DROP TABLE IF EXISTS address_streets")
+	cursor.execute("CREATE TABLE address_streets (street_id INTEGER PRIMARY KEY, street_key TEXT, city_key TEXT, state_key TEXT)")
+	cursor.execute("CREATE UNIQUE INDEX address_streets_key ON address_streets (street_key, city_key, state_key)")
+
+	# The spellings of each street as found in the addresses table and
+	# the number of the normalized street to which each belongs
+	cursor.execute("DROP TABLE IF EXISTS temp.address_street_names")
+	cursor.execute("CREATE TEMP TABLE address_street_names (street TEXT, city TEXT, region TEXT, street_id INTEGER)")
+
+	street_ids = {}
+	names = []
+	for street, city, region in cursor.execute("SELECT DISTINCT street, city, region FROM addresses").fetchall():
+		key = (street_key(street), city_key(city), state_key(region))
+		street_id = street_ids.get(key)
+		if street_id is None:
+			street_id = street_ids[key] = len(street_ids) + 1
+		names.append((street, city, region, street_id))
+	cursor.executemany("INSERT INTO address_streets (street_id, street_key, city_key, state_key) VALUES (?, ?, ?, ?)",
+		[(street_id,) + key for key, street_id in street_ids.items()])
+	cursor.executemany("INSERT INTO temp.address_street_names VALUES (?, ?, ?, ?)", names)
+	cursor.execute("CREATE INDEX temp.address_street_names_index ON address_street_names (street, city, region)")
+	print("address_streets: %d streets (%d spellings)" % (len(street_ids), len(names)))
+
+def build_keys(cursor):
+	cursor.execute("DROP TABLE IF EXISTS address_keys")
+	cursor.execute("CREATE TABLE address_keys (street_id INTEGER, house_number TEXT, apartment_number TEXT, postal_code TEXT, longitude REAL, latitude REAL)")
+	cursor.execute("""INSERT INTO address_keys
+		SELECT n.street_id, a.house_number, a.apartment_number, a.postal_code, a.longitude, a.latitude
+		FROM addresses a, temp.address_street_names n
+		WHERE a.house_number IS NOT NULL AND a.house_number != ''
+		AND n.street IS a.street AND n.city IS a.city AND n.region IS a.region
+		ORDER BY n.street_id, a.house_number""")
+	cursor.execute("CREATE INDEX address_keys_index ON address_keys (street_id, house_number, apartment_number, postal_code, longitude, latitude)")
+	cursor.execute("SELECT count(*) FROM address_keys")
+	print("address_keys: %d addresses" % cursor.fetchone()[0])
+
+def build_ranges(cursor):
+	cursor.execute("DROP TABLE IF EXISTS address_ranges")
+	cursor.execute("CREATE VIRTUAL TABLE address_ranges USING rtree_i32 (id, street_id_min, street_id_max, house_number_min, house_number_max)")
+	cursor.execute("""INSERT INTO address_ranges
+		SELECT a.rowid, n.street_id, n.street_id, a.house_number_start, a.house_number_end
+		FROM addresses a, temp.address_street_names n
+		WHERE a.house_number_start IS NOT NULL AND a.house_number_end IS NOT NULL
+		AND n.street IS a.street AND n.city IS a.city AND n.region IS a.region""")
+	cursor.execute("SELECT count(*) FROM address_ranges")
+	print("address_ranges: %d ranges" % cursor.fetchone()[0])
+
+def main():
+	parser = argparse.ArgumentParser(description="Add lookup tables to openaddresses.sqlite")
+	parser.add_argument("--datadir", default=os.path.join(os.environ['HOME'], "geo_data/processed"))
+	args = parser.parse_args()
+
+	conn = sqlite3.connect(os.path.join(args.datadir, "openaddresses.sqlite"))
+	cursor = conn.cursor()
+
+	for step in (build_streets, build_keys, build_ranges):
+		start_time = time.time()
+		step(cursor)
+		conn.commit()
+		print(" (%.1f seconds)" % (time.time() - start_time))
+
+	cursor.execute("ANALYZE")
+	conn.commit()
+	conn.close()
+
+if __name__ == "__main__":
+	main()
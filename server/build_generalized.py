@@ -0,0 +1,106 @@
+#! /usr/bin/python
+# pykarta/server/build_generalized.py
+# Make generalized copies of the tables of the OSM map database
+# Last modified: 31 May 2018
+#
+# Usage: build_generalized.py [--datadir DIR]
+#
+# For each band of zoom levels in tiles_osm_vec.generalized_zoom_bands,
+# this copies those rows of the lines and multipolygons tables which
+# some layer shows in the band into a new table, simplifying them to
+# one pixel at the highest zoom level of the band, and gives the new
+# table a spatial index. The tile module reads from these tables when
+# they exist rather than simplifying each feature at request time.
+# Run it again whenever osm_map.sqlite is reloaded.
+
+from __future__ import print_function
+import os, sys, time
+import argparse
+import sqlite3
+
+try:
+	import pykarta
+except ImportError:
+	sys.path.insert(1, "../..")
+
+from pykarta.server.modules.tiles_osm_vec import layers, plan_layer, \
+	generalized_tables, generalized_zoom_bands, generalized_table_name, \
+	pixel_in_degrees, a_speck
+
+# The where expression which selects the rows of a table which any
+# layer shows at any zoom level in the band
+def band_where(table, zoom_band):
+	wheres = []
+	for zoom in range(zoom_band[0], zoom_band[1]+1):
+		for layer_name, layer in layers.items():
+			if not isinstance(layer, dict) or layer.get('table') != table:
+				continue
+			plan = plan_layer(layer_name, zoom)
+			if plan is not None:
+				where = "( %s )" % plan['where'].replace(":a_speck", repr(a_speck(zoom)))
+				if not where in wheres:
+					wheres.append(where)
+	if len(wheres) == 0:
+		return None
+	return " OR ".join(wheres)
+
+def drop_table(cursor, name):
+	cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+	if cursor.fetchone() is not None:
+		cursor.execute("SELECT DisableSpatialIndex(?, 'Geometry')", (name,))
+		cursor.execute('DROP TABLE IF EXISTS "idx_%s_Geometry"' % name)
+		cursor.execute("SELECT DiscardGeometryColumn(?, 'Geometry')", (name,))
+		cursor.execute('DROP TABLE "%s"' % name)
+
+def build_generalized_table(cursor, table, zoom_band):
+	name = generalized_table_name(table, zoom_band)
+	drop_table(cursor, name)
+
+	where = band_where(table, zoom_band)
+	if where is None:
+		print("%s: no layers" % name)
+		return
+
+	# All of the columns except the geometry
+	cursor.execute('PRAGMA table_info("%s")' % table)
+	columns = [(row[1], row[2]) for row in cursor if row[1].lower() != "geometry"]
+
+	cursor.execute('CREATE TABLE "{name}" ({columns})'.format(
+		name=name,
+		columns=",".join(['"%s" %s' % (column, ("INTEGER PRIMARY KEY" if column == "ogc_fid" else column_type)) for column, column_type in columns]),
+		))
+	cursor.execute("SELECT AddGeometryColumn(?, 'Geometry', 4326, 'GEOMETRY', 'XY')", (name,))
+	cursor.execute('INSERT INTO "{name}" ({columns}, Geometry) SELECT {columns}, SimplifyPreserveTopology(Geometry, {tolerance!r}) FROM "{table}" WHERE {where}'.format(
+		name=name,
+		columns=",".join(['"%s"' % column for column, column_type in columns]),
+		tolerance=pixel_in_degrees(zoom_band[1]),
+		table=table,
+		where=where,
+		))
+	cursor.execute('DELETE FROM "%s" WHERE Geometry IS NULL' % name)
+	cursor.execute("SELECT CreateSpatialIndex(?, 'Geometry')", (name,))
+	cursor.execute('SELECT count(*) FROM "%s"' % name)
+	print("%s: %d rows" % (name, cursor.fetchone()[0]))
+
+def main():
+	parser = argparse.ArgumentParser(description="Make generalized copies of the tables of osm_map.sqlite")
+	parser.add_argument("--datadir", default=os.path.join(os.environ['HOME'], "geo_data/processed"))
+	args = parser.parse_args()
+
+	conn = sqlite3.connect(os.path.join(args.datadir, "osm_map.sqlite"))
+	conn.enable_load_extension(True)
+	conn.load_extension("mod_spatialite")
+	conn.enable_load_extension(False)
+	cursor = conn.cursor()
+
+	for table in generalized_tables:
+		for zoom_band in generalized_zoom_bands:
+			start_time = time.time()
+			build_generalized_table(cursor, table, zoom_band)
+			conn.commit()
+			print(" (%.1f seconds)" % (time.time() - start_time))
+
+	conn.close()
+
+if __name__ == "__main__":
+	main()
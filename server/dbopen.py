@@ -1,30 +1,84 @@
 # pykarta/servers/dbopen.py
-# Last modified: 16 May 2018
+# Last modified: 31 May 2018
+#
+# Each thread of the WSGI server gets its own connexion to each database
+# since SQLite connexions may not be shared between threads. Connexions
+# are opened read-only and tuned for serving (memory-mapped I/O, a
+# larger page cache, and a larger cache of prepared statements so that
+# the queries of the tile modules, which differ only in their
+# parameters, are compiled once per connexion).
+#
+# When a database is replaced (for instance by reloading the data or by
+# running build_generalized.py) its mtime changes. We check it now and
+# then and, if it has changed, each thread closes its connexion and
+# opens a new one the next time it needs it. This also keeps the
+# Last-Modified headers and the stamps on cached tiles up to date.
 
 from email.utils import formatdate, parsedate_tz, mktime_tz
 import os, time
 import sqlite3
 import threading
 
+# How often (in seconds) to check whether a database has been replaced
+db_check_interval = 5.0
+
+# Settings for each new connexion
+db_cached_statements = 256
+db_pragmas = (
+	"PRAGMA query_only=ON",
+	"PRAGMA mmap_size=268435456",		# 256 MiB
+	"PRAGMA cache_size=-32768",			# 32 MiB
+	"PRAGMA temp_store=MEMORY",
+	)
+
+# The mtime of each database as of the last check. Shared by all threads.
+db_mtimes = {}
+db_mtimes_lock = threading.Lock()
+
+# Return the mtime of a database file, checking it again if it was
+# last checked more than db_check_interval seconds ago.
+def db_mtime(db_filename):
+	now = time.time()
+	with db_mtimes_lock:
+		entry = db_mtimes.get(db_filename)
+		if entry is None or (now - entry[1]) >= db_check_interval:
+			entry = (int(os.path.getmtime(db_filename)), now)
+			db_mtimes[db_filename] = entry
+		return entry[0]
+
+# This thread's connexions
 class Databases(threading.local):
 	def __init__(self):
 		self.databases = {}
 
 databases = Databases()
 
+def db_connect(stderr, db_filename):
+	stderr.write("db_filename: %s\n" % db_filename)
+	conn = sqlite3.connect(db_filename, cached_statements=db_cached_statements)
+	conn.enable_load_extension(True)
+	conn.load_extension("mod_spatialite")
+	conn.enable_load_extension(False)
+	conn.row_factory = sqlite3.Row
+	cursor = conn.cursor()
+	for pragma in db_pragmas:
+		cursor.execute(pragma)
+	return cursor
+
 def dbopen(environ, db_basename):
 	stderr = environ['wsgi.errors']
 
-	if not db_basename in databases.databases:
-		db_filename = os.path.join(environ["DATADIR"], db_basename)
-		stderr.write("db_filename: %s\n" % db_filename)
-		conn = sqlite3.connect(db_filename)
-		conn.enable_load_extension(True)
-		conn.load_extension("mod_spatialite")
-		conn.enable_load_extension(False)
-		conn.row_factory = sqlite3.Row
-		databases.databases[db_basename] = (conn.cursor(), int(os.path.getmtime(db_filename)))
-	(cursor, last_modified) = databases.databases[db_basename]
+	db_filename = os.path.join(environ["DATADIR"], db_basename)
+	mtime = db_mtime(db_filename)
+	entry = databases.databases.get(db_basename)
+	if entry is not None and entry[1] != mtime:
+		stderr.write("database replaced: %s\n" % db_filename)
+		entry[0].connection.close()
+		entry = None
+	if entry is None:
+		entry = (db_connect(stderr, db_filename), mtime)
+		databases.databases[db_basename] = entry
+	(cursor, last_modified) = entry
 
 	time_now = time.time()
 	response_headers = [
@@ -44,3 +98,8 @@ def dbopen(environ, db_basename):
 
 	return (cursor, response_headers)
 
+# Return the modification time of a database which this thread
+# has opened with dbopen(). Tiles cached by the tile modules are
+# stamped with it.
+def db_last_modified(db_basename):
+	return databases.databases[db_basename][1]
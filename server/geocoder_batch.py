@@ -0,0 +1,92 @@
+# pykarta/server/geocoder_batch.py
+# Support for geocoding many addresses in one request
+# Last modified: 31 May 2018
+#
+# A batch request is a POST to the same URL as a single query. Its body is
+# a JSON list of addresses, each in the same form as a single query:
+#
+#   [[house_number, apartment_number, street, city, state, postal_code], ...]
+#
+# The response is a JSON list with a GeoJSON Feature (or null) for each
+# address, in the same order. It is sent as the results are found.
+#
+# Rather than running the geocoder's queries once for each address, the
+# geocoder modules join a chunk of addresses at a time against their
+# tables. The chunk is given to SQLite as a VALUES list in a WITH clause
+# (the database connexions are query-only, so no temporary table) and
+# all full chunks have the same query text so that the statement is
+# prepared only once.
+
+import json
+
+# Most addresses accepted in one request
+batch_max = 10000
+
+# Addresses per query. Keep the number of parameters below 999.
+batch_chunk = 100
+
+class BatchError(Exception):
+	pass
+
+# Read the list of addresses from the body of a POST request
+def read_batch(environ):
+	try:
+		length = int(environ.get('CONTENT_LENGTH') or 0)
+	except ValueError:
+		length = 0
+	if length <= 0:
+		raise BatchError("No addresses")
+	try:
+		addresses = json.loads(environ['wsgi.input'].read(length).decode("utf-8"))
+	except ValueError as e:
+		raise BatchError("Invalid JSON: %s" % str(e))
+	if not isinstance(addresses, list):
+		raise BatchError("Expected a list of addresses")
+	if len(addresses) > batch_max:
+		raise BatchError("Too many addresses (limit is %d)" % batch_max)
+	for address in addresses:
+		if not isinstance(address, list) or len(address) != 6:
+			raise BatchError("Each address must be a list of six items")
+	return addresses
+
+# Split a list into pieces of batch_chunk items
+def batch_chunks(items):
+	for i in range(0, len(items), batch_chunk):
+		yield items[i:i+batch_chunk]
+
+# Return a WITH clause which defines a table called batch with the
+# indicated columns and rows placeholders. The first column, i, is the
+# index of the address in the chunk.
+def batch_with_clause(columns, rows):
+	row = "(%s)" % ",".join(["?"] * (len(columns) + 1))
+	return "WITH batch(i,%s) AS (VALUES %s)" % (",".join(columns), ",".join([row] * rows))
+
+# Parameters for batch_with_clause(). Each item of rows is a list of
+# column values.
+def batch_params(rows):
+	params = []
+	for i, row in enumerate(rows):
+		params.append(i)
+		params.extend(row)
+	return params
+
+# Produce the response body from the results for the addresses
+def batch_response_pieces(features):
+	yield b"["
+	separator = b""
+	for feature in features:
+		yield separator + json.dumps(feature).encode("utf-8")
+		separator = b","
+	yield b"]"
+
+# Headers for a batch response. The answer depends on the request body,
+# so it must not be cached.
+def batch_response_headers(response_headers):
+	return [header for header in response_headers if header[0] == 'Date'] + [
+		('Content-Type', 'application/json'),
+		('Cache-Control', 'no-cache'),
+		]
+
+def batch_error(start_response, message):
+	start_response("400 Bad Request", [('Content-Type', 'text/plain')])
+	return [message.encode("utf-8")]
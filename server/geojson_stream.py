@@ -0,0 +1,53 @@
+# pykarta/server/geojson_stream.py
+# Write GeoJSON responses piece by piece
+# Last modified: 31 May 2018
+#
+# Spatialite's AsGeoJSON() already gives us the geometry as JSON text.
+# Rather than parsing it into Python lists only to have json.dump()
+# turn it back into text, the tile modules splice it directly into
+# the output and compress the result as it is produced.
+
+import json
+import zlib
+
+# Compress a sequence of strings in gzip format, yielding the compressed
+# data as it becomes available so that the response can start before
+# the query is finished.
+def gzip_chunks(pieces, buffer_size=65536):
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	buffer = []
+	buffered = 0
+	for piece in pieces:
+		buffer.append(piece)
+		buffered += len(piece)
+		if buffered >= buffer_size:
+			data = compressor.compress(_join(buffer))
+			buffer = []
+			buffered = 0
+			if data:
+				yield data
+	yield compressor.compress(_join(buffer)) + compressor.flush()
+
+def _join(pieces):
+	text = "".join(pieces)
+	if not isinstance(text, bytes):
+		text = text.encode("utf-8")
+	return text
+
+# A GeoJSON feature as text. geometry is the text from AsGeoJSON().
+def feature_text(id, geometry, properties):
+	return '{"type":"Feature","id":%s,"geometry":%s,"properties":%s}' % (
+		json.dumps(id),
+		geometry,
+		json.dumps(properties, separators=(',', ':')),
+		)
+
+# Yield the text of a FeatureCollection given the texts of its features
+def feature_collection_pieces(features):
+	yield '{"type":"FeatureCollection","features":['
+	separator = ''
+	for feature in features:
+		yield separator
+		yield feature
+		separator = ','
+	yield ']}'
@@ -2,8 +2,11 @@
 # Geocoder gets addresses from the Openaddresses project.
 # Last modified: 16 May 2018
 
-import os, json, time, re
+import os, json, time, re, string
+from pykarta.address import disabbreviate_street, disabbreviate_placename, abbreviate_state
 from pykarta.server.dbopen import dbopen
+from pykarta.server.geocoder_batch import read_batch, batch_chunks, batch_with_clause, batch_params, \
+	batch_response_pieces, batch_response_headers, batch_error, BatchError
 import threading
 try:
 	from urllib import unquote_plus
@@ -12,17 +15,157 @@ except ImportError:
 
 thread_data = threading.local()
 
-def application(environ, start_response):
-	stderr = environ['wsgi.errors']
+def address_feature(longitude, latitude):
+	return {
+		'type':'Feature',
+		'geometry':{'type':'Point', 'coordinates':[longitude, latitude]},
+		'properties':{'precision':'ROOF'}
+		}
 
-	cursor, response_headers = dbopen(environ, "openaddresses.sqlite")
-	if cursor is None:
-		start_response("304 Not Modified", response_headers)
-		return []
+#=============================================================================
+# Lookup using the tables made by build_address_index.py
+#=============================================================================
 
-	query_string = unquote_plus(environ['QUERY_STRING'])
-	house_number, apartment_number, street, city, state, postal_code = json.loads(query_string)
+# The street, city, and state are normalized so that, for instance,
+# "Elm St", "ELM STREET", and "Elm Street" all match.
+def street_key(street):
+	return disabbreviate_street(street or "").upper()
+def city_key(city):
+	return disabbreviate_placename(city or "").strip().upper()
+def state_key(state):
+	return abbreviate_state(string.capwords(state or "")).upper()
 
+# Have the tables made by build_address_index.py been added to
+# the database which this cursor reads?
+def has_address_index(cursor):
+	if getattr(thread_data, 'cursor', None) is not cursor:
+		cursor.execute("SELECT count(*) FROM sqlite_master WHERE name IN ('address_streets', 'address_keys', 'address_ranges')")
+		thread_data.has_address_index = (cursor.fetchone()[0] == 3)
+		thread_data.cursor = cursor
+	return thread_data.has_address_index
+
+# Find the street in address_streets, then either the house number in
+# the covering index of address_keys (preferring the right apartment),
+# or a range which includes it in the R*Tree address_ranges.
+indexed_query = """SELECT longitude, latitude FROM (
+	SELECT k.longitude, k.latitude, (CASE WHEN k.apartment_number = :apartment_number THEN 0 ELSE 1 END) AS rank
+		FROM address_streets s, address_keys k
+		WHERE s.street_key = :street AND s.city_key = :city AND s.state_key = :state
+		AND k.street_id = s.street_id AND k.house_number = :house_number
+		AND (:postal_code = '' OR k.postal_code = :postal_code OR k.postal_code IS NULL)
+	UNION ALL
+	SELECT a.longitude, a.latitude, 2 AS rank
+		FROM address_streets s, address_ranges r, addresses a
+		WHERE s.street_key = :street AND s.city_key = :city AND s.state_key = :state
+		AND r.street_id_min = s.street_id AND r.street_id_max = s.street_id
+		AND r.house_number_min <= :house_number_int AND r.house_number_max >= :house_number_int
+		AND a.rowid = r.id
+		AND (:postal_code = '' OR a.postal_code = :postal_code OR a.postal_code IS NULL)
+	) ORDER BY rank LIMIT 1"""
+def find_indexed(cursor, house_number, apartment_number, street, city, state, postal_code):
+	cursor.execute(indexed_query, {
+		'house_number': house_number,
+		'house_number_int': int(house_number) if house_number is not None and re.match(r'^\d+$', house_number) else None,
+		'apartment_number': apartment_number or None,
+		'street': street_key(street),
+		'city': city_key(city),
+		'state': state_key(state),
+		'postal_code': postal_code or '',
+		})
+	return cursor.fetchone()
+
+# The same for a chunk of addresses at a time (see geocoder_batch.py).
+# Each address is joined to its street, then the searches above are made
+# in order of preference, each picking the rowid of a match, and the first
+# which finds one wins.
+indexed_batch_columns = ("house_number", "apartment_number", "street", "city", "state", "postal_code", "house_number_int")
+indexed_batch_match = """(SELECT k.rowid FROM address_keys k
+	WHERE k.street_id = s.street_id AND k.house_number = b.house_number {apartment}
+	AND (b.postal_code = '' OR k.postal_code = b.postal_code OR k.postal_code IS NULL)
+	LIMIT 1)"""
+indexed_batch_select = """SELECT COALESCE(k.longitude, a.longitude), COALESCE(k.latitude, a.latitude)
+	FROM ( SELECT m.i AS i, m.key_match AS key_match,
+		CASE WHEN m.key_match IS NULL AND m.house_number_int IS NOT NULL THEN
+			(SELECT a.rowid FROM address_ranges r, addresses a
+			WHERE r.street_id_min = m.street_id AND r.street_id_max = m.street_id
+			AND r.house_number_min <= m.house_number_int AND r.house_number_max >= m.house_number_int
+			AND a.rowid = r.id
+			AND (m.postal_code = '' OR a.postal_code = m.postal_code OR a.postal_code IS NULL)
+			LIMIT 1)
+		END AS range_match
+		FROM ( SELECT b.i AS i, s.street_id AS street_id, b.house_number_int AS house_number_int,
+			b.postal_code AS postal_code,
+			COALESCE(
+				CASE WHEN b.apartment_number IS NOT NULL THEN {apartment} END,
+				{exact}
+				) AS key_match
+			FROM batch b LEFT JOIN address_streets s
+			ON s.street_key = b.street AND s.city_key = b.city AND s.state_key = b.state
+			) AS m
+		) AS r
+	LEFT JOIN address_keys k ON k.rowid = r.key_match
+	LEFT JOIN addresses a ON a.rowid = r.range_match
+	ORDER BY r.i""".format(
+	apartment=indexed_batch_match.format(apartment="AND k.apartment_number = b.apartment_number"),
+	exact=indexed_batch_match.format(apartment=""),
+	)
+def find_batch_indexed(cursor, addresses):
+	for chunk in batch_chunks(addresses):
+		rows = []
+		for house_number, apartment_number, street, city, state, postal_code in chunk:
+			if house_number is not None and re.match(r'^\d+$', house_number):
+				house_number_int = int(house_number)
+			else:
+				house_number_int = None
+			rows.append((house_number, apartment_number or None, street_key(street), city_key(city), state_key(state), postal_code or '', house_number_int))
+		cursor.execute("%s %s" % (batch_with_clause(indexed_batch_columns, len(rows)), indexed_batch_select), batch_params(rows))
+		for row in cursor.fetchall():
+			yield address_feature(row[0], row[1]) if row[0] is not None else None
+
+#=============================================================================
+# Lookup using only the addresses table
+#=============================================================================
+
+# Find each of a list of addresses. Yields a feature or None for each.
+# This does in one query for each chunk of addresses what the single
+# query below does in up to three queries for each. Each of the three
+# searches picks the rowid of a matching address and the first which
+# finds one wins.
+batch_columns = ("house_number", "apartment_number", "street", "city", "state", "postal_code", "house_number_int")
+batch_match = """(SELECT rowid FROM addresses a
+	WHERE {house} AND a.street = b.street AND a.city = b.city AND a.region = b.state
+	AND (b.postal_code IS NULL OR b.postal_code = '' OR a.postal_code = b.postal_code OR a.postal_code IS NULL)
+	LIMIT 1)"""
+batch_select = """SELECT a.longitude, a.latitude
+	FROM ( SELECT b.i AS i, COALESCE(
+		CASE WHEN b.apartment_number IS NOT NULL AND b.apartment_number != '' THEN {apartment} END,
+		{exact},
+		CASE WHEN b.house_number_int IS NOT NULL THEN {range} END
+		) AS match FROM batch b ) AS m
+	LEFT JOIN addresses a ON a.rowid = m.match
+	ORDER BY m.i""".format(
+	apartment=batch_match.format(house="a.apartment_number = b.apartment_number AND a.house_number = b.house_number"),
+	exact=batch_match.format(house="a.house_number = b.house_number"),
+	range=batch_match.format(house="a.house_number_start <= b.house_number_int AND a.house_number_end >= b.house_number_int"),
+	)
+def find_batch(stderr, cursor, addresses):
+	if has_address_index(cursor):
+		for feature in find_batch_indexed(cursor, addresses):
+			yield feature
+		return
+	for chunk in batch_chunks(addresses):
+		rows = []
+		for house_number, apartment_number, street, city, state, postal_code in chunk:
+			if house_number is not None and re.match(r'^\d+$', house_number):
+				house_number_int = int(house_number)
+			else:
+				house_number_int = None
+			rows.append((house_number, apartment_number, street, city, state, postal_code, house_number_int))
+		cursor.execute("%s %s" % (batch_with_clause(batch_columns, len(rows)), batch_select), batch_params(rows))
+		for row in cursor.fetchall():
+			yield address_feature(row[0], row[1]) if row[0] is not None else None
+
+def find_unindexed(cursor, house_number, apartment_number, street, city, state, postal_code):
 	# Build the query template
 	query_template = "SELECT longitude, latitude FROM addresses where {house} and street=? and city=? and region=?"
 	address_base = [
@@ -56,13 +199,40 @@ def application(environ, start_response):
 		cursor.execute(query_template.replace("{house}", "house_number_start <= ? and house_number_end >= ?"), [house_number, house_number] + address_base)
 		row = cursor.fetchone()
 
+	return row
+
+#=============================================================================
+# Request handler
+#=============================================================================
+
+def application(environ, start_response):
+	stderr = environ['wsgi.errors']
+
+	cursor, response_headers = dbopen(environ, "openaddresses.sqlite")
+	if cursor is None:
+		start_response("304 Not Modified", response_headers)
+		return []
+
+	if environ.get('REQUEST_METHOD') == 'POST':
+		try:
+			addresses = read_batch(environ)
+		except BatchError as e:
+			return batch_error(start_response, str(e))
+		stderr.write("Batch of %d addresses\n" % len(addresses))
+		start_response("200 OK", batch_response_headers(response_headers))
+		return batch_response_pieces(find_batch(stderr, cursor, addresses))
+
+	query_string = unquote_plus(environ['QUERY_STRING'])
+	address = json.loads(query_string)
+
+	if has_address_index(cursor):
+		row = find_indexed(cursor, *address)
+	else:
+		row = find_unindexed(cursor, *address)
+
 	# If we got a match, insert the latitude and longitude into a GeoJSON point object.
 	if row:
-		feature = {
-			'type':'Feature',
-			'geometry':{'type':'Point', 'coordinates':[row[0], row[1]]},
-			'properties':{'precision':'ROOF'}
-			}	
+		feature = address_feature(row[0], row[1])
 	else:
 		feature = None
 
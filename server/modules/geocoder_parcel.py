@@ -4,10 +4,45 @@
 
 import os, urllib, json, time
 from pykarta.server.dbopen import dbopen
+from pykarta.server.geocoder_batch import read_batch, batch_chunks, batch_with_clause, batch_params, \
+	batch_response_pieces, batch_response_headers, batch_error, BatchError
 import threading
 
 thread_data = threading.local()
 
+# Given the parcel's centroid as GeoJSON text, make the feature we return
+def parcel_feature(centroid):
+	return {
+		'type':'Feature',
+		'geometry':json.loads(centroid),
+		'properties':{'precision':'LOT'}
+		}
+
+# Find the parcel of each of a list of addresses. Yields a feature or None
+# for each address. This does in one query for each chunk of addresses
+# what the single query below does in one or two queries for each.
+batch_columns = ("house_number", "alt_house_number", "street", "city", "state", "postal_code")
+batch_match = """(SELECT centroid FROM parcel_addresses p
+	WHERE p.house_number = b.{house_number} AND p.street = b.street AND p.city = b.city AND p.state = b.state
+	AND (b.postal_code IS NULL OR b.postal_code = '' OR p.zip = b.postal_code OR p.zip = '' OR p.zip IS NULL)
+	LIMIT 1)"""
+batch_select = """SELECT COALESCE({exact}, {alt}) FROM batch b ORDER BY b.i""".format(
+	exact=batch_match.format(house_number="house_number"),
+	alt=batch_match.format(house_number="alt_house_number"),
+	)
+def find_batch(stderr, cursor, addresses):
+	for chunk in batch_chunks(addresses):
+		rows = []
+		for house_number, apartment_number, street, town, state, postal_code in chunk:
+			try:
+				alt_house_number = str(int(house_number) - 2)
+			except (ValueError, TypeError):
+				alt_house_number = None
+			rows.append((house_number, alt_house_number, street, town, state, postal_code))
+		cursor.execute("%s %s" % (batch_with_clause(batch_columns, len(rows)), batch_select), batch_params(rows))
+		for row in cursor.fetchall():
+			yield parcel_feature(row[0]) if row[0] is not None else None
+
 def application(environ, start_response):
 	stderr = environ['wsgi.errors']
 
@@ -16,6 +51,15 @@ def application(environ, start_response):
 		start_response("304 Not Modified", response_headers)
 		return []
 
+	if environ.get('REQUEST_METHOD') == 'POST':
+		try:
+			addresses = read_batch(environ)
+		except BatchError as e:
+			return batch_error(start_response, str(e))
+		stderr.write("Batch of %d addresses\n" % len(addresses))
+		start_response("200 OK", batch_response_headers(response_headers))
+		return batch_response_pieces(find_batch(stderr, cursor, addresses))
+
 	query_string = urllib.unquote_plus(environ['QUERY_STRING'])
 	#stderr.write("QUERY_STRING: %s\n" % query_string)
 	house_number, apartment_number, street, town, state, postal_code = json.loads(query_string)
@@ -51,12 +95,7 @@ def application(environ, start_response):
 
 	# If one or the other matched,
 	if row:
-		geometry = json.loads(row[0])
-		feature = {
-			'type':'Feature',
-			'geometry':geometry,
-			'properties':{'precision':'LOT'}
-			}	
+		feature = parcel_feature(row[0])
 	else:
 		feature = None
 
@@ -1,6 +1,6 @@
 # pykarta/server/modules/tiles_osm_vec.py
-# Produce GeoJSON tiles from OSM data stored in a Spatialite database
-# Last modified: 25 May 2018
+# Produce GeoJSON or Mapbox Vector Tile tiles from OSM data stored in a Spatialite database
+# Last modified: 31 May 2018
 
 # References:
 # https://docs.python.org/2/library/sqlite3.html
@@ -11,9 +11,17 @@
 # http://northredoubt.com/n/2012/01/18/spatialite-and-spatial-indexes/
 
 from __future__ import print_function
-import os, json, re, gzip, io
+import os, json, re
+
+try:
+	from collections import OrderedDict
+except ImportError:
+	from pykarta.fallback.ordereddict import OrderedDict
 from pykarta.geometry.projection import unproject_from_tilespace
-from pykarta.server.dbopen import dbopen
+from pykarta.server.dbopen import dbopen, db_last_modified
+from pykarta.server.tile_cache import tile_cache_open, tile_cache_tee
+from pykarta.server.geojson_stream import gzip_chunks, feature_text, feature_collection_pieces
+from pykarta.formats.mvt import MvtWriter, MIME_TYPE as MVT_MIME_TYPE
 
 # Sets of map layers for use together
 map_layer_sets = {
@@ -152,122 +160,334 @@ layers = {
 		'pad-bbox': False,
 	}
 
-def get_tile(stderr, cursor, layer_name, small_bbox, large_bbox, zoom):
+# build_generalized.py can make generalized copies of these tables for
+# each of these bands of zoom levels. Each copy holds only the rows which
+# some layer shows in its band, simplified to one pixel at the highest
+# zoom level of the band, and has its own spatial index.
+generalized_tables = ('lines', 'multipolygons')
+generalized_zoom_bands = ((4, 7), (8, 9), (10, 11), (12, 13), (14, 15))
+
+def generalized_table_name(table, zoom_band):
+	return "%s_z%d_%d" % ((table,) + zoom_band)
+
+# Return the name of the generalized copy of a table for a zoom level or
+# None if there is none.
+def generalized_table_for_zoom(table, zoom, table_names):
+	if table in generalized_tables:
+		for zoom_band in generalized_zoom_bands:
+			if zoom_band[0] <= zoom <= zoom_band[1]:
+				name = generalized_table_name(table, zoom_band)
+				if name in table_names:
+					return name
+	return None
+
+# Size of a pixel in degrees
+def pixel_in_degrees(zoom):
+	return 360.0 / (2.0 ** zoom) / 256.0
+
+# Decide how a layer is to be queried at this zoom level. Returns
+# None if the layer has nothing to show at this zoom level.
+# table_names is the set of tables in the database.
+def plan_layer(layer_name, zoom, table_names=()):
 	layer = layers.get(layer_name)
 	assert layer is not None
 
-	bbox = large_bbox if layer.get('pad-bbox',True) else small_bbox
+	where_expressions = layer['where_expressions']
+	where_index = (zoom - layer.get('zoom_min',0))
+	if where_index < 0:
+		return None
+	where = where_expressions[where_index if where_index < len(where_expressions) else -1]
+	where = where.replace("{a_speck}", ":a_speck")
 
+	bbox = 'large' if layer.get('pad-bbox',True) else 'small'
+
+	table = layer['table']
 	geometry = "__geometry__"
 	if layer.get('clip',True):
-		geometry = "Intersection(%s,%s)" % (geometry, bbox)
+		geometry = "Intersection(%s,%s)" % (geometry, bbox_sql[bbox])
 	simplification = layer.get('simplification',1.0)		# one pixel
 	if simplification is not None and zoom < layer.get('simplify-until',16):
-		simplification = 360.0 / (2.0 ** zoom) / 256.0 * simplification
-		geometry = "SimplifyPreserveTopology(%s,%f)" % (geometry, simplification)
+		# If there is a generalized copy of the table for this zoom level,
+		# its geometry is already simplified to one pixel.
+		generalized_table = generalized_table_for_zoom(table, zoom, table_names)
+		if generalized_table is not None:
+			table = generalized_table
+		if generalized_table is None or simplification != 1.0:
+			simplification = pixel_in_degrees(zoom) * simplification
+			geometry = "SimplifyPreserveTopology(%s,%f)" % (geometry, simplification)
 
-	columns = layer['columns']
+	columns = list(layer['columns'])
 	if 'other_tags' in layer:
-		columns = list(columns)
 		columns.append('other_tags')
 
-	# Build the part of the WHERE clause unique to this layer
-	where_expressions = layer['where_expressions']
-	where_index = (zoom - layer.get('zoom_min',0))
-	if where_index < 0:
-		return None
-	where = where_expressions[where_index if where_index < len(where_expressions) else -1]
-	pixel_in_degrees = 360.0 / (2.0 ** zoom) / 256.0
-	a_speck = (pixel_in_degrees * pixel_in_degrees) * 10.0	
-	where = where.replace("{a_speck}", str(a_speck))
-	stderr.write("where: %s\n" % where)
-
-	# In Spatialite we must join the spatial index table explicitly.
-	spatial_test = "ROWID IN ( SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{table}' AND search_frame = {bbox} )""".format(
-		table=layer['table'],
-		bbox=bbox
+	return {
+		'name': layer_name,
+		'layer': layer,
+		'table': table,
+		'where': where,
+		'bbox': bbox,
+		'geometry': geometry,
+		'columns': columns,
+		}
+
+# The bounding boxes are passed as parameters so that SQLite can build
+# each one once per query.
+bbox_sql = {
+	'small': "BuildMBR(:small_x1,:small_y1,:small_x2,:small_y2,4326)",
+	'large': "BuildMBR(:large_x1,:large_y1,:large_x2,:large_y2,4326)",
+	}
+
+def bbox_params(x, y, zoom):
+	params = {}
+	for name, pad in (('small', 0.0), ('large', 0.05)):
+		p1 = unproject_from_tilespace(x - pad, y - pad, zoom)
+		p2 = unproject_from_tilespace(x + 1.0 + pad, y + 1.0 + pad, zoom)
+		params[name + '_x1'] = p1[1]
+		params[name + '_y1'] = p1[0]
+		params[name + '_x2'] = p2[1]
+		params[name + '_y2'] = p2[0]
+	params['a_speck'] = a_speck(zoom)
+	return params
+
+# Area in square degrees below which polygons are not worth drawing
+def a_speck(zoom):
+	pixel = pixel_in_degrees(zoom)
+	return (pixel * pixel) * 10.0
+
+# Fetch the features of one or more layers which are drawn from the same
+# table. Rather than scanning the table once for each layer, we make one
+# pass using the spatial index, compute for each row flags which tell
+# which layers it belongs to, and then route it to those layers.
+# Yields (index of layer in plans, id, geometry as GeoJSON text, properties).
+def iter_table_features(stderr, cursor, table, plans, params):
+
+	# The columns needed by any of the layers
+	columns = []
+	for plan in plans:
+		for column in plan['columns']:
+			if not column in columns:
+				columns.append(column)
+
+	# Layers with the same clipping and simplification can share the GeoJSON.
+	geometries = []
+	for plan in plans:
+		if not plan['geometry'] in geometries:
+			geometries.append(plan['geometry'])
+		plan['geometry_index'] = geometries.index(plan['geometry'])
+	bboxes = sorted(set([plan['bbox'] for plan in plans]))
+
+	# Innermost query: find rows which any layer wants using the spatial index
+	# and note which layers want them.
+	query = """SELECT ogc_fid AS __id__, Geometry AS __geometry__, {columns}, {where_flags}
+		FROM {table}
+		WHERE ( {where} )
+		AND ROWID IN ( SELECT ROWID FROM SpatialIndex WHERE f_table_name = '{table}' AND search_frame = {bbox} )""".format(
+		columns=",".join(columns),
+		where_flags=",".join(["( %s ) AS __where%d__" % (plan['where'], i) for i, plan in enumerate(plans)]),
+		table=table,
+		where=" OR ".join(["( %s )" % plan['where'] for plan in plans]),
+		bbox=bbox_sql['large' if 'large' in bboxes else 'small'],
 		)
 
-	# Query to find what we want and do preliminary filtering using the spatial index.
-	query = "SELECT ogc_fid as __id__, Geometry as __geometry__, {columns} FROM {table} WHERE ( {where} ) AND {spatial_test}".format(
-		columns=(",".join(columns)),
-		table=layer['table'],
-		where=where,
-		spatial_test=spatial_test,
+	# Do more precise spatial filtering, once for each bounding box.
+	query = """SELECT *, {intersects}
+		FROM ( {query} ) AS q""".format(
+		intersects=",".join(["Intersects(%s, q.__geometry__) AS __intersects_%s__" % (bbox_sql[bbox], bbox) for bbox in bboxes]),
+		query=query,
 		)
 
-	# Enclose above query in another query which does more precision spatial
-	# filtering and converts the geometry to GeoJSON.
+	# Convert the geometry to GeoJSON once for each distinct clipping and
+	# simplification, but only if some layer will use it.
+	in_layer = ["( __where%d__ AND __intersects_%s__ )" % (i, plan['bbox']) for i, plan in enumerate(plans)]
+	geojson_columns = []
+	for j, geometry in enumerate(geometries):
+		geojson_columns.append("CASE WHEN {in_layers} THEN AsGeoJSON({geometry}) END AS __geojson{j}__".format(
+			in_layers=" OR ".join([in_layer[i] for i, plan in enumerate(plans) if plan['geometry_index'] == j]),
+			geometry=geometry,
+			j=j,
+			))
+	query = """SELECT __id__, {columns}, {flags}, {geojson_columns}
+		FROM ( {query} ) AS r
+		WHERE {in_any_layer}""".format(
+		columns=",".join(columns),
+		flags=",".join(["__where%d__" % i for i in range(len(plans))] + ["__intersects_%s__" % bbox for bbox in bboxes]),
+		geojson_columns=",".join(geojson_columns),
+		query=query,
+		in_any_layer=" OR ".join(in_layer),
+		)
 	stderr.write("query: %s\n" % query)
-	query = """SELECT AsGeoJSON({geometry}) as __geometry__, *
-				FROM ( {query} ) AS q
-				WHERE Intersects({bbox}, q.__geometry__)
-			""".format(query=query,bbox=bbox, spatial_test=spatial_test, geometry=geometry)
-	#stderr.write("query: %s\n" % query)
 
-	cursor.execute(query)
+	cursor.execute(query, params)
 
-	features = []
+	counts = [0] * len(plans)
 	for row in cursor:
-		if row['__geometry__'] is None:
-			stderr.write("invalid geometry: %s\n" % str(list(row)))
-			continue
-
-		row = dict(row)
-		id = row.pop('__id__')
-		geometry = json.loads(row.pop("__geometry__"))
-		properties = {}
-
-		if 'other_tags' in layer:
-			other_tags = row.pop('other_tags')
-			if other_tags is None:
-				other_tags = dict()
-			else:
-				try:
-					#other_tags = dict(map(lambda item: re.match(r'^"?([^"]+)"=>"([^"]*)"?$', item).groups(), other_tags.split('","')))
-					other_tags = json.loads("{%s}" % other_tags.replace('"=>"','":"'))
-					for tag in layer['other_tags']:
-						value = other_tags.get(tag)	
-						if value is not None:
-							properties[tag] = value
-				except AttributeError:
-					stderr.write("Failed to parse other_tags: %s\n" % other_tags)
-
-		for name, value in row.items():
-			if value is not None:
-				properties[name] = value
-
-		if 'highway' in properties:
-			m = re.match(r'^(.+)_link$', properties['highway'])
-			if m:
-				properties['highway'] = m.group(1)
-				properties['is_link'] = 'yes'
-
-		feature = {
-			'type': 'Feature',
-			'id': id,
-			'geometry': geometry,
-			'properties': properties,
-			}
-		features.append(feature)
-	stderr.write("Found %d feature(s)\n" % len(features))
-
-	geojson = {
-		'type': 'FeatureCollection',
-		'features': features,
-		}
+		for i, plan in enumerate(plans):
+			if not (row['__where%d__' % i] and row['__intersects_%s__' % plan['bbox']]):
+				continue
+			geometry = row['__geojson%d__' % plan['geometry_index']]
+			if geometry is None:
+				stderr.write("invalid geometry: %s\n" % str(list(row)))
+				continue
+			counts[i] += 1
+			yield (i, row['__id__'], geometry, make_properties(stderr, plan['layer'], row))
+
+	for plan, count in zip(plans, counts):
+		stderr.write("%s: found %d feature(s)\n" % (plan['name'], count))
+
+# Parse the hstore text in the other_tags column which ogr2ogr makes
+# from the OSM tags which do not have columns of their own. The same
+# few values (such as '"bridge"=>"yes"') turn up over and over, so
+# the results are kept. They must not be modified.
+other_tags_cache = {}
+other_tags_cache_size = 10000
+
+def parse_other_tags(stderr, other_tags):
+	parsed = other_tags_cache.get(other_tags)
+	if parsed is None:
+		try:
+			#parsed = dict(map(lambda item: re.match(r'^"?([^"]+)"=>"([^"]*)"?$', item).groups(), other_tags.split('","')))
+			parsed = json.loads("{%s}" % other_tags.replace('"=>"','":"'))
+		except ValueError:
+			stderr.write("Failed to parse other_tags: %s\n" % other_tags)
+			parsed = {}
+		if len(other_tags_cache) >= other_tags_cache_size:
+			other_tags_cache.clear()
+		other_tags_cache[other_tags] = parsed
+	return parsed
+
+# Make the properties of a GeoJSON feature from the layer's columns of a query result row
+def make_properties(stderr, layer, row):
+	properties = {}
+
+	if 'other_tags' in layer:
+		other_tags = row['other_tags']
+		if other_tags is not None:
+			other_tags = parse_other_tags(stderr, other_tags)
+			for tag in layer['other_tags']:
+				value = other_tags.get(tag)
+				if value is not None:
+					properties[tag] = value
+
+	for name in layer['columns']:
+		value = row[name]
+		if value is not None:
+			properties[name] = value
+
+	highway = properties.get('highway')
+	if highway is not None and highway.endswith('_link') and len(highway) > 5:
+		properties['highway'] = highway[:-5]
+		properties['is_link'] = 'yes'
+
+	return properties
+
+# Plan the queries for a list of layers. Layers which come from the same
+# table are fetched together. Returns an OrderedDict of table name to
+# a list of plans. Layers which have nothing at this zoom level are omitted.
+def plan_tables(cursor, layer_names, zoom):
+	cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+	table_names = set([row[0] for row in cursor])
+	tables = OrderedDict()
+	for layer_name in layer_names:
+		plan = plan_layer(layer_name, zoom, table_names)
+		if plan is not None:
+			tables.setdefault(plan['table'], []).append(plan)
+	return tables
+
+# Fetch the features of a list of layers. Returns a dict of layer name
+# to GeoJSON (as Python objects) which omits layers which have nothing
+# at this zoom level.
+def get_tiles(stderr, cursor, layer_names, x, y, zoom):
+	params = bbox_params(x, y, zoom)
+	result = {}
+	for table, plans in plan_tables(cursor, layer_names, zoom).items():
+		features = [[] for plan in plans]
+		for i, id, geometry, properties in iter_table_features(stderr, cursor, table, plans, params):
+			features[i].append({
+				'type': 'Feature',
+				'id': id,
+				'geometry': json.loads(geometry),
+				'properties': properties,
+				})
+		for plan, layer_features in zip(plans, features):
+			result[plan['name']] = {
+				'type': 'FeatureCollection',
+				'features': layer_features,
+				}
+	return result
+
+# Yield the text of the GeoJSON for a layer or for a set of layers
+def geojson_pieces(stderr, cursor, layer_name, x, y, zoom):
+	params = bbox_params(x, y, zoom)
 
-	return geojson
+	# A single layer is a FeatureCollection which we can write out
+	# as the rows arrive.
+	if not layer_name in map_layer_sets:
+		tables = plan_tables(cursor, [layer_name], zoom)
+		if len(tables) == 0:
+			yield 'null'
+			return
+		table, plans = list(tables.items())[0]
+		features = (feature_text(id, geometry, properties) for i, id, geometry, properties in iter_table_features(stderr, cursor, table, plans, params))
+		for piece in feature_collection_pieces(features):
+			yield piece
+		return
+
+	# A set of layers is an object with a FeatureCollection for each layer.
+	# Since the rows of a table are routed to several layers, we hold
+	# the features until we have finished with the table.
+	yield '{'
+	separator = ''
+	for table, plans in plan_tables(cursor, map_layer_sets[layer_name], zoom).items():
+		features = [[] for plan in plans]
+		for i, id, geometry, properties in iter_table_features(stderr, cursor, table, plans, params):
+			features[i].append(feature_text(id, geometry, properties))
+		for plan, layer_features in zip(plans, features):
+			yield separator
+			yield '%s:' % json.dumps(plan['name'].replace("osm-vector-",""))
+			for piece in feature_collection_pieces(layer_features):
+				yield piece
+			separator = ','
+	yield '}'
+
+content_types = {
+	'mvt': MVT_MIME_TYPE,
+	'geojson': 'application/json',
+	}
+
+# Produce a tile (or a set of layers) in the indicated format. Yields
+# pieces of the compressed tile.
+def render_tile_chunks(stderr, cursor, layer_name, zoom, x, y, tile_format):
+	if tile_format == "mvt":
+		if layer_name in map_layer_sets:
+			layer_names = map_layer_sets[layer_name]
+		else:
+			layer_names = [layer_name]
+		tiles = get_tiles(stderr, cursor, layer_names, x, y, zoom)
+
+		# Each layer becomes a layer of the vector tile. The coordinates are
+		# projected here, once, rather than by each client.
+		writer = MvtWriter(zoom, x, y)
+		for layer_name in layer_names:
+			if layer_name in tiles:
+				writer.add_layer(layer_name.replace("osm-vector-",""), tiles[layer_name]['features'])
+		return gzip_chunks([writer.getvalue()])
+	else:
+		return gzip_chunks(geojson_pieces(stderr, cursor, layer_name, x, y, zoom))
+
+# Produce a tile (or a set of layers) in the indicated format, compressed
+def render_tile(stderr, cursor, layer_name, zoom, x, y, tile_format):
+	return b"".join(render_tile_chunks(stderr, cursor, layer_name, zoom, x, y, tile_format))
 
 def application(environ, start_response):
 	stderr = environ['wsgi.errors']
 
-	m = re.match(r'^/([^/]+)/(\d+)/(\d+)/(\d+)\.geojson$', environ['PATH_INFO'])
+	m = re.match(r'^/([^/]+)/(\d+)/(\d+)/(\d+)\.(geojson|mvt)$', environ['PATH_INFO'])
 	assert m, environ['PATH_INFO']
 	layer_name = m.group(1)
 	zoom = int(m.group(2))
 	x = int(m.group(3))
 	y = int(m.group(4))
+	tile_format = m.group(5)
 	stderr.write("%s tile (%d, %d) at zoom %d...\n" % (layer_name, x, y, zoom))
 	assert zoom <= 16
 
@@ -276,42 +496,31 @@ def application(environ, start_response):
 		start_response("304 Not Modified", response_headers)
 		return []
 
-	p1 = unproject_from_tilespace(x, y, zoom)
-	p2 = unproject_from_tilespace(x + 1.0, y + 1.0, zoom)
-	small_bbox = 'BuildMBR(%f,%f,%f,%f,4326)' % (p1[1], p1[0], p2[1], p2[0])
-
-	p1 = unproject_from_tilespace(x - 0.05, y - 0.05, zoom)
-	p2 = unproject_from_tilespace(x + 1.05, y + 1.05, zoom)
-	large_bbox = 'BuildMBR(%f,%f,%f,%f,4326)' % (p1[1], p1[0], p2[1], p2[0])
-
-	if layer_name in map_layer_sets:
-		layer_names = map_layer_sets[layer_name]
-		geojson = {}
-		for layer_name in layer_names:
-			tile_geojson = get_tile(stderr, cursor, layer_name, small_bbox, large_bbox, zoom)
-			if tile_geojson is not None:
-				geojson[layer_name.replace("osm-vector-","")] = tile_geojson
+	# Serve the tile from the cache if it was made from this version of the
+	# database. Otherwise send it as it is produced and then cache it.
+	cache = tile_cache_open(environ, layer_name, tile_format)
+	db_mtime = db_last_modified("osm_map.sqlite")
+	data = cache.get(zoom, x, y, db_mtime) if cache is not None else None
+	if data is not None:
+		stderr.write("Cache hit\n")
+		chunks = [data]
 	else:
-		geojson = get_tile(stderr, cursor, layer_name, small_bbox, large_bbox, zoom)
-
-	# Convert Python objects to JSON and compress
-	out = io.BytesIO()
-	with gzip.GzipFile(fileobj=out, mode='w') as fo:
-		json.dump(geojson, fo)
-	geojson = out.getvalue()
+		chunks = render_tile_chunks(stderr, cursor, layer_name, zoom, x, y, tile_format)
+		if cache is not None:
+			chunks = tile_cache_tee(cache, zoom, x, y, db_mtime, chunks)
 
 	start_response("200 OK", response_headers + [
-		('Content-Type', 'application/json'),
+		('Content-Type', content_types[tile_format]),
 		('Content-Encoding', 'gzip'),
 		])
-	return [geojson]
+	return chunks
 
 if __name__ == "__main__":
 	import sys
 	def dummy_start_response(code, headers):
 		print(code, headers)
 	application({
-		'PATH_INFO': "/osm-vector-roads/16/19528/24304.geojson",
+		'PATH_INFO': "/osm-vector-roads/16/19528/24304.mvt",
 		'wsgi.errors': sys.stderr,
 		}, dummy_start_response)
  
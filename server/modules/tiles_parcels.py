@@ -1,38 +1,40 @@
 # pykarta/server/modules/tiles_parcels.py
-# Produce GeoJSON tiles from parcel boundaries stored in a Spatialite database
-# Last modified: 16 May 2018
+# Produce GeoJSON or Mapbox Vector Tile tiles from parcel boundaries stored in a Spatialite database
+# Last modified: 31 May 2018
 
 from __future__ import print_function
-import os, json, re, gzip, io
+import os, json, re
 from pykarta.geometry.projection import unproject_from_tilespace
-from pykarta.server.dbopen import dbopen
+from pykarta.server.dbopen import dbopen, db_last_modified
+from pykarta.server.tile_cache import tile_cache_open, tile_cache_tee
+from pykarta.server.geojson_stream import gzip_chunks, feature_text, feature_collection_pieces
+from pykarta.formats.mvt import MvtWriter, MIME_TYPE as MVT_MIME_TYPE
 
-def application(environ, start_response):
-	stderr = environ['wsgi.errors']
-
-	m = re.match(r'^/(\d+)/(\d+)/(\d+)\.geojson$', environ['PATH_INFO'])
-	assert m, environ['PATH_INFO']
-	zoom = int(m.group(1))
-	x = int(m.group(2))
-	y = int(m.group(3))
-	stderr.write("Parcel tile (%d, %d) at zoom %d...\n" % (x, y, zoom))
-	assert zoom <= 16
-
-	cursor, response_headers = dbopen(environ, "parcels.sqlite")
-	if cursor is None:
-		start_response("304 Not Modified", response_headers)
-		return []
+content_types = {
+	'mvt': MVT_MIME_TYPE,
+	'geojson': 'application/json',
+	}
 
+# Yield (id, geometry as GeoJSON text, properties) for each parcel in the tile
+def iter_features(stderr, cursor, zoom, x, y):
 	p1 = unproject_from_tilespace(x - 0.05, y - 0.05, zoom)
 	p2 = unproject_from_tilespace(x + 1.05, y + 1.05, zoom)
-	bbox = 'BuildMBR(%f,%f,%f,%f,4326)' % (p1[1], p1[0], p2[1], p2[0])
+
+	# The bounding box and tolerance are passed as parameters so that
+	# the query text is the same for every tile and its prepared
+	# statement can be reused.
+	bbox = 'BuildMBR(:x1,:y1,:x2,:y2,4326)'
+	params = {
+		'x1': p1[1],
+		'y1': p1[0],
+		'x2': p2[1],
+		'y2': p2[0],
+		}
 
 	geometry = "Intersection(Geometry,{bbox})".format(bbox=bbox)
 	if zoom < 16:
-		geometry = "SimplifyPreserveTopology({geometry},{simplification})".format(
-			geometry=geometry,
-			simplification = 360.0 / (2.0 ** zoom) / 256.0		# one pixel
-			)
+		geometry = "SimplifyPreserveTopology({geometry},:simplification)".format(geometry=geometry)
+		params['simplification'] = 360.0 / (2.0 ** zoom) / 256.0		# one pixel
 	else:
 		stderr.write("Not simplified\n")
 
@@ -42,38 +44,70 @@ def application(environ, start_response):
 		AND ROWID IN ( SELECT ROWID FROM SpatialIndex WHERE f_table_name = 'parcels' AND search_frame = {bbox} )
 		""".format(geometry=geometry, bbox=bbox)
 
-	cursor.execute(query)
+	cursor.execute(query, params)
 
-	features = []
+	count = 0
 	for row in cursor:
 		if row['__geometry__'] is None:
 			continue
 		row = dict(row)
-		feature = {
-			'type': 'Feature',
-			'id': row.pop("__id__"),
-			'geometry': json.loads(row.pop("__geometry__")),
-			'properties': row,
-			}
-		features.append(feature)
-	stderr.write("Found %d feature(s)\n" % len(features))
-
-	geojson = {
-		'type': 'FeatureCollection',
-		'features': features,
-		}
+		count += 1
+		yield (row.pop("__id__"), row.pop("__geometry__"), row)
+	stderr.write("Found %d feature(s)\n" % count)
+
+# Produce a tile in the indicated format. Yields pieces of the compressed tile.
+def render_tile_chunks(stderr, cursor, zoom, x, y, tile_format):
+	features = iter_features(stderr, cursor, zoom, x, y)
+	if tile_format == "mvt":
+		writer = MvtWriter(zoom, x, y)
+		writer.add_layer("parcels", [
+			{'type': 'Feature', 'id': id, 'geometry': json.loads(geometry), 'properties': properties}
+			for id, geometry, properties in features
+			])
+		return gzip_chunks([writer.getvalue()])
+	else:
+		# The geometry text from Spatialite goes straight into the output.
+		return gzip_chunks(feature_collection_pieces(feature_text(id, geometry, properties) for id, geometry, properties in features))
+
+# Produce a tile in the indicated format, compressed
+def render_tile(stderr, cursor, zoom, x, y, tile_format):
+	return b"".join(render_tile_chunks(stderr, cursor, zoom, x, y, tile_format))
+
+def application(environ, start_response):
+	stderr = environ['wsgi.errors']
+
+	m = re.match(r'^/(\d+)/(\d+)/(\d+)\.(geojson|mvt)$', environ['PATH_INFO'])
+	assert m, environ['PATH_INFO']
+	zoom = int(m.group(1))
+	x = int(m.group(2))
+	y = int(m.group(3))
+	tile_format = m.group(4)
+	stderr.write("Parcel tile (%d, %d) at zoom %d...\n" % (x, y, zoom))
+	assert zoom <= 16
 
-	# Convert to JSON and compress
-	out = io.BytesIO()
-	with gzip.GzipFile(fileobj=out, mode='w') as fo:
-		json.dump(geojson, fo)
-	geojson = out.getvalue()
+	cursor, response_headers = dbopen(environ, "parcels.sqlite")
+	if cursor is None:
+		start_response("304 Not Modified", response_headers)
+		return []
+
+	# Serve the tile from the cache if it was made from this version of the
+	# database. Otherwise send it as it is produced and then cache it.
+	cache = tile_cache_open(environ, "parcels", tile_format)
+	db_mtime = db_last_modified("parcels.sqlite")
+	data = cache.get(zoom, x, y, db_mtime) if cache is not None else None
+	if data is not None:
+		stderr.write("Cache hit\n")
+		chunks = [data]
+	else:
+		chunks = render_tile_chunks(stderr, cursor, zoom, x, y, tile_format)
+		if cache is not None:
+			chunks = tile_cache_tee(cache, zoom, x, y, db_mtime, chunks)
 
 	start_response("200 OK", response_headers + [
-		('Content-Type', 'application/json'),
+		('Content-Type', content_types[tile_format]),
 		('Content-Encoding', 'gzip'),
 		])
-	return [geojson]
+	return chunks
 
 if __name__ == "__main__":
 	def dummy_start_response(code, headers):
@@ -0,0 +1,185 @@
+# pykarta/server/prefork.py
+# Serve a WSGI application from a fixed set of worker processes
+# Last modified: 31 May 2018
+#
+# Under a threaded server the GIL allows only one request at a time to
+# run Python code, and the tile modules spend much of their time in
+# Python building properties, encoding MVT, and compressing. So here
+# the listening socket is opened once and then a number of worker
+# processes are forked, each of which accepts connexions on it and
+# opens its own database connexions (see dbopen.py).
+#
+# The workers are replaced (gracefully: each finishes the request it
+# is working on) when the master process receives SIGHUP or when one
+# of the databases in DATADIR is replaced. Workers which die are
+# restarted. SIGINT or SIGTERM stops the server. Workers which have
+# been told to stop but are still running after stop_timeout seconds
+# are killed.
+
+from __future__ import print_function
+import os, sys, time, errno
+import glob
+import signal
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+# How often (in seconds) the master checks the databases and its workers
+check_interval = 2.0
+
+# How long (in seconds) a worker has to finish its request once told to stop
+stop_timeout = 30.0
+
+class RequestHandler(WSGIRequestHandler):
+	# Do not look up the client's hostname for each request
+	def address_string(self):
+		return self.client_address[0]
+
+	def log_message(self, format, *args):
+		sys.stderr.write("[%d] %s - - [%s] %s\n" % (os.getpid(), self.address_string(), self.log_date_time_string(), format % args))
+
+#=============================================================================
+# Worker
+#=============================================================================
+
+def worker_main(httpd):
+	stopping = []
+	def stop(signum, frame):
+		stopping.append(signum)
+	signal.signal(signal.SIGTERM, stop)
+	signal.signal(signal.SIGHUP, signal.SIG_IGN)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)		# the master will tell us
+
+	# Wake up now and then to see whether we have been told to stop
+	httpd.timeout = 1.0
+	while not stopping:
+		httpd.handle_request()
+
+#=============================================================================
+# Master
+#=============================================================================
+
+# Return the mtimes of the databases in the data directory
+def database_mtimes(datadir):
+	mtimes = {}
+	for filename in glob.glob(os.path.join(datadir, "*.sqlite")):
+		try:
+			mtimes[filename] = os.path.getmtime(filename)
+		except OSError:		# in the middle of being replaced
+			pass
+	return mtimes
+
+def serve(application, host, port, processes, datadir=None):
+	httpd = make_server(host, port, application, handler_class=RequestHandler)
+	print("Serving HTTP on %s port %d with %d processes..." % (host, port, processes))
+
+	workers = set()
+	retiring = {}		# pid of replaced worker to time by which it must exit
+	signals = []
+	def on_signal(signum, frame):
+		signals.append(signum)
+	signal.signal(signal.SIGHUP, on_signal)
+	signal.signal(signal.SIGINT, on_signal)
+	signal.signal(signal.SIGTERM, on_signal)
+
+	def start_worker():
+		sys.stdout.flush()
+		sys.stderr.flush()
+		pid = os.fork()
+		if pid == 0:
+			status = 0
+			try:
+				worker_main(httpd)
+			except:
+				import traceback
+				traceback.print_exc()
+				status = 1
+			finally:
+				os._exit(status)
+		workers.add(pid)
+
+	def stop_workers(pids):
+		for pid in pids:
+			try:
+				os.kill(pid, signal.SIGTERM)
+			except OSError:		# already gone
+				pass
+
+	# Kill those replaced workers which have not exited in time
+	def kill_late_workers(now):
+		for pid, deadline in retiring.items():
+			if now >= deadline:
+				print("Worker %d did not stop, killing it" % pid)
+				try:
+					os.kill(pid, signal.SIGKILL)
+				except OSError:
+					pass
+				retiring[pid] = float("inf")	# kill only once, waitpid() will collect it
+
+	mtimes = database_mtimes(datadir) if datadir is not None else {}
+	try:
+		while True:
+
+			# Collect workers which have exited.
+			while True:
+				try:
+					pid, status = os.waitpid(-1, os.WNOHANG)
+				except OSError as e:
+					if e.errno == errno.ECHILD:
+						break
+					raise
+				if pid == 0:
+					break
+				if pid in workers:
+					print("Worker %d exited with status %d" % (pid, status))
+					workers.discard(pid)
+				retiring.pop(pid, None)
+
+			restart = False
+			while signals:
+				signum = signals.pop(0)
+				if signum == signal.SIGHUP:
+					print("SIGHUP received")
+					restart = True
+				else:
+					return
+			if datadir is not None:
+				new_mtimes = database_mtimes(datadir)
+				if new_mtimes != mtimes:
+					print("Databases changed")
+					mtimes = new_mtimes
+					restart = True
+
+			# Old workers finish what they are doing and exit while
+			# the new ones start accepting connexions.
+			if restart:
+				print("Replacing workers")
+				old_workers = list(workers)
+				workers.clear()
+				stop_workers(old_workers)
+				deadline = time.time() + stop_timeout
+				for pid in old_workers:
+					retiring[pid] = deadline
+			kill_late_workers(time.time())
+
+			while len(workers) < processes:
+				start_worker()
+
+			time.sleep(check_interval)
+	finally:
+		print("Stopping workers")
+		stop_workers(list(workers))
+		deadline = time.time() + stop_timeout
+		for pid in workers:
+			retiring[pid] = deadline
+		while retiring:
+			try:
+				pid, status = os.waitpid(-1, os.WNOHANG)
+			except OSError as e:
+				if e.errno == errno.ECHILD:
+					break
+				raise
+			if pid != 0:
+				retiring.pop(pid, None)
+				continue
+			kill_late_workers(time.time())
+			time.sleep(0.1)
+		httpd.server_close()
@@ -0,0 +1,146 @@
+#! /usr/bin/python
+# pykarta/server/seed.py
+# Produce tiles in advance and load them into the tile server's cache
+# Last modified: 31 May 2018
+#
+# Example:
+#  python seed.py --processes 4 42.0,-73.5,42.9,-71.8 10 16 osm-vector parcels
+#
+# The tiles are made by a pool of worker processes, each with its own
+# Spatialite connexion, and are written by this process to the MBTiles
+# files which the tile modules use as their cache (see tile_cache.py).
+# They are stamped with the mtimes of the databases so that the server
+# will serve them without running any queries until the databases are
+# replaced. Tiles which are already in the cache are skipped, so an
+# interrupted run can simply be restarted.
+
+from __future__ import print_function
+import os, sys, time
+import argparse
+import multiprocessing
+
+try:
+	import pykarta
+except ImportError:
+	sys.path.insert(1, "../..")
+
+from pykarta.geometry.projection import project_to_tilespace
+from pykarta.server.dbopen import dbopen
+from pykarta.server.tile_cache import TileCache, tile_cache_filename
+from pykarta.server.modules import tiles_osm_vec, tiles_parcels
+
+# Layer name to the database from which its tiles are made
+def layer_database(layer_name):
+	if layer_name == "parcels":
+		return "parcels.sqlite"
+	if layer_name in tiles_osm_vec.layers or layer_name in tiles_osm_vec.map_layer_sets:
+		return "osm_map.sqlite"
+	return None
+
+# Yield the (zoom, x, y) of the tiles which cover a bounding box
+def tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, zoom_start, zoom_stop):
+	for zoom in range(zoom_start, zoom_stop+1):
+		limit = 2 ** zoom - 1
+		x_start, y_start = project_to_tilespace(max_lat, min_lon, zoom)
+		x_stop, y_stop = project_to_tilespace(min_lat, max_lon, zoom)
+		for x in range(max(int(x_start), 0), min(int(x_stop), limit) + 1):
+			for y in range(max(int(y_start), 0), min(int(y_stop), limit) + 1):
+				yield (zoom, x, y)
+
+#=============================================================================
+# Worker processes
+#=============================================================================
+
+# The tile modules write their queries to wsgi.errors
+class NullWriter(object):
+	def write(self, text):
+		pass
+
+worker_environ = None
+
+def worker_init(datadir, verbose):
+	global worker_environ
+	worker_environ = {
+		'DATADIR': datadir,
+		'wsgi.errors': sys.stderr if verbose else NullWriter(),
+		}
+
+def worker_render(task):
+	layer_name, tile_format, zoom, x, y = task
+	stderr = worker_environ['wsgi.errors']
+	cursor, response_headers = dbopen(worker_environ, layer_database(layer_name))
+	if layer_name == "parcels":
+		data = tiles_parcels.render_tile(stderr, cursor, zoom, x, y, tile_format)
+	else:
+		data = tiles_osm_vec.render_tile(stderr, cursor, layer_name, zoom, x, y, tile_format)
+	return (task, data)
+
+#=============================================================================
+# Main
+#=============================================================================
+def main():
+	parser = argparse.ArgumentParser(description="Load tiles into the PyKarta tile server's cache")
+	parser.add_argument("bbox", help="min_lat,min_lon,max_lat,max_lon")
+	parser.add_argument("zoom_start", type=int)
+	parser.add_argument("zoom_stop", type=int)
+	parser.add_argument("layers", nargs="+", help="osm-vector, osm-vector-roads, ..., parcels")
+	parser.add_argument("--datadir", default=os.path.join(os.environ['HOME'], "geo_data/processed"))
+	parser.add_argument("--cachedir", default=None, help="default: DATADIR/tile_cache")
+	parser.add_argument("--format", dest="tile_format", choices=("mvt", "geojson"), default="mvt")
+	parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+	parser.add_argument("--verbose", action="store_true")
+	args = parser.parse_args()
+
+	min_lat, min_lon, max_lat, max_lon = map(float, args.bbox.split(","))
+	assert 0 <= args.zoom_start <= args.zoom_stop <= 16
+	cachedir = args.cachedir if args.cachedir is not None else os.path.join(args.datadir, "tile_cache")
+
+	caches = {}
+	db_mtimes = {}
+	for layer_name in args.layers:
+		db_basename = layer_database(layer_name)
+		if db_basename is None:
+			parser.error("no such layer: %s" % layer_name)
+		db_mtimes[layer_name] = int(os.path.getmtime(os.path.join(args.datadir, db_basename)))
+		caches[layer_name] = TileCache(tile_cache_filename(cachedir, layer_name, args.tile_format), layer_name, args.tile_format)
+
+	# Make a list of the tiles which are not yet in the cache
+	tasks = []
+	skipped = 0
+	for zoom, x, y in tiles_in_bbox(min_lat, min_lon, max_lat, max_lon, args.zoom_start, args.zoom_stop):
+		for layer_name in args.layers:
+			if caches[layer_name].get(zoom, x, y, db_mtimes[layer_name]) is not None:
+				skipped += 1
+			else:
+				tasks.append((layer_name, args.tile_format, zoom, x, y))
+	total = len(tasks)
+	print("%d tiles to make, %d already in cache" % (total, skipped))
+
+	pool = multiprocessing.Pool(args.processes, worker_init, (args.datadir, args.verbose))
+	start_time = last_report = time.time()
+	count = 0
+	try:
+		for (layer_name, tile_format, zoom, x, y), data in pool.imap_unordered(worker_render, tasks, chunksize=8):
+			caches[layer_name].put(zoom, x, y, db_mtimes[layer_name], data, commit=False)
+			count += 1
+			now = time.time()
+			if (now - last_report) >= 1.0 or count == total:
+				elapsed = now - start_time
+				rate = count / elapsed if elapsed > 0 else 0.0
+				print("\r%d of %d tiles (%d%%), %.1f tiles/second" % (count, total, count * 100 / total, rate), end="")
+				sys.stdout.flush()
+				for cache in caches.values():
+					cache.commit()
+				last_report = now
+		pool.close()
+	except KeyboardInterrupt:
+		pool.terminate()
+		print("\nInterrupted")
+	finally:
+		pool.join()
+		for cache in caches.values():
+			cache.commit()
+	print("")
+
+if __name__ == "__main__":
+	main()
@@ -28,12 +28,15 @@ routes = {
 		'hello': app_hello,
 		}
 
+# Where the databases are if the WSGI environment does not say
+default_datadir = os.path.join(os.environ['HOME'], "geo_data/processed")
+
 def application(environ, start_response):
 	stderr = environ['wsgi.errors']
 	#stderr.write("\n")
 
 	if not 'DATADIR' in environ:
-		environ['DATADIR'] = os.environ['HOME'] + "/geo_data/processed"
+		environ['DATADIR'] = default_datadir
 
 	m = re.match(r'^/([^/]+)/([^/]+)(.*)$', environ['PATH_INFO'])
 	if not m:
@@ -57,10 +60,23 @@ def application(environ, start_response):
 if __name__ == "__main__":
 	import sys
 	sys.path.insert(1, "../..")
-	#from wsgiref.simple_server import make_server
-	#httpd = make_server('', 8000, application)
-	#print("Serving HTTP on port 8000...")
-	#httpd.serve_forever()
-	from werkzeug.serving import run_simple
-	run_simple('localhost', 8000, application, threaded=True)
+	import argparse
+	parser = argparse.ArgumentParser(description="PyKarta tile and geocoder server")
+	parser.add_argument("--host", default="localhost")
+	parser.add_argument("--port", type=int, default=8000)
+	parser.add_argument("--datadir", default=None)
+	parser.add_argument("--processes", type=int, default=0, help="number of worker processes to pre-fork (default: run threaded in one process)")
+	args = parser.parse_args()
+	if args.datadir is not None:
+		default_datadir = args.datadir
+	if args.processes > 0:
+		from pykarta.server.prefork import serve
+		serve(application, args.host, args.port, args.processes, datadir=default_datadir)
+	else:
+		#from wsgiref.simple_server import make_server
+		#httpd = make_server('', 8000, application)
+		#print("Serving HTTP on port 8000...")
+		#httpd.serve_forever()
+		from werkzeug.serving import run_simple
+		run_simple(args.host, args.port, application, threaded=True)
 
@@ -0,0 +1,103 @@
+# pykarta/server/tile_cache.py
+# Cache of the tiles produced by the tile modules
+# Last modified: 31 May 2018
+#
+# A tile depends only on its layer, format, and coordinates and on the
+# database from which it was made, yet producing one takes a spatial
+# query, conversion to GeoJSON or MVT, and compression. So we keep the
+# compressed tiles in MBTiles files, one for each layer and format, and
+# serve them from there until the database is replaced. Each tile is
+# stamped with the mtime of the database from which it was made.
+#
+# The cache directory is taken from TILECACHEDIR in the WSGI environment.
+# It defaults to DATADIR/tile_cache. Set it to an empty string to
+# disable the cache.
+
+import os
+import sqlite3
+import threading
+
+# The format of tile_data as the MBTiles spec names it
+mbtiles_formats = {
+	"mvt": "pbf",
+	"geojson": "json",
+	}
+
+# SQLite connexions may not be shared between threads
+class TileCaches(threading.local):
+	def __init__(self):
+		self.caches = {}
+
+tile_caches = TileCaches()
+
+class TileCache(object):
+	def __init__(self, filename, layer_name, tile_format):
+		self.filename = filename
+		dirname = os.path.dirname(filename)
+		if not os.path.isdir(dirname):
+			try:
+				os.makedirs(dirname)
+			except OSError:		# another thread got there first
+				pass
+		self.conn = sqlite3.connect(filename, timeout=30)
+		self.conn.text_factory = str
+		self.cursor = self.conn.cursor()
+		self.cursor.execute("PRAGMA journal_mode=WAL")
+		self.cursor.execute("PRAGMA synchronous=NORMAL")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS metadata (name text, value text)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS metadata_index ON metadata (name)")
+		self.cursor.execute("CREATE TABLE IF NOT EXISTS tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob, db_mtime integer)")
+		self.cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)")
+		self.cursor.executemany("INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)", (
+			('name', layer_name),
+			('format', mbtiles_formats.get(tile_format, tile_format)),
+			('compression', 'gzip'),
+			))
+		self.conn.commit()
+
+	# Return the compressed tile or None if it is not in the cache
+	# or was made from an older version of the database.
+	def get(self, zoom, x, y, db_mtime):
+		self.cursor.execute("SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ? AND db_mtime = ?", (zoom, x, (2**zoom-1) - y, db_mtime))
+		row = self.cursor.fetchone()
+		if row is None:
+			return None
+		return bytes(row[0])
+
+	# Store a compressed tile. When loading many tiles, pass commit=False
+	# and call commit() now and then.
+	def put(self, zoom, x, y, db_mtime, data, commit=True):
+		self.cursor.execute("INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data, db_mtime) VALUES (?, ?, ?, ?, ?)", (zoom, x, (2**zoom-1) - y, sqlite3.Binary(data), db_mtime))
+		if commit:
+			self.conn.commit()
+
+	def commit(self):
+		self.conn.commit()
+
+def tile_cache_filename(cache_dir, layer_name, tile_format):
+	return os.path.join(cache_dir, "%s.%s.mbtiles" % (layer_name, tile_format))
+
+# Pass the pieces of a tile through to the response while keeping a copy.
+# The tile is stored once the last piece has been sent.
+def tile_cache_tee(cache, zoom, x, y, db_mtime, chunks):
+	saved = []
+	for chunk in chunks:
+		saved.append(chunk)
+		yield chunk
+	cache.put(zoom, x, y, db_mtime, b"".join(saved))
+
+# Return this thread's connexion to the cache for a layer and
+# format or None if caching is disabled.
+def tile_cache_open(environ, layer_name, tile_format):
+	cache_dir = environ.get('TILECACHEDIR')
+	if cache_dir is None:
+		cache_dir = os.path.join(environ['DATADIR'], "tile_cache")
+	if cache_dir == "":
+		return None
+	filename = tile_cache_filename(cache_dir, layer_name, tile_format)
+	cache = tile_caches.caches.get(filename)
+	if cache is None:
+		environ['wsgi.errors'].write("tile cache: %s\n" % filename)
+		cache = TileCache(filename, layer_name, tile_format)
+		tile_caches.caches[filename] = cache
+	return cache
@@ -0,0 +1,88 @@
+#! /usr/bin/python
+# Show that in concurrent mode GeocoderMulti does not query geocoders
+# which come after one which has found a precise match. The geocoders
+# here send their requests through GeocoderBase.get_blocking() to a
+# fake HTTP connexion which records them.
+
+import time
+import threading
+import __builtin__
+if not hasattr(__builtin__, "_"):
+	__builtin__._ = lambda text: text
+
+import pykarta
+pykarta.api_keys.setdefault("bing", "")
+from pykarta.geocoder.multi import GeocoderMulti
+from pykarta.geocoder.geocoder_base import GeocoderBase, GeocoderResult
+
+#============================================================================
+
+class FakeResponse(object):
+	status = 200
+	reason = "OK"
+	def read(self):
+		return "answer"
+
+class FakeConnection(object):
+	def __init__(self, geocoder):
+		self.geocoder = geocoder
+	def putrequest(self, method, path):
+		self.geocoder.sent.append(path)
+	def putheader(self, name, value):
+		pass
+	def endheaders(self, message_body=None):
+		pass
+	def getresponse(self):
+		time.sleep(self.geocoder.latency)
+		return FakeResponse()
+
+class FakeGeocoder(GeocoderBase):
+	url_server = "geocoder.example.com"
+	def __init__(self, name, precision, latency, delay=0.0, metered=False):
+		GeocoderBase.__init__(self)
+		self.name = name
+		self.precision = precision
+		self.latency = latency
+		self.delay = delay
+		self.metered = metered
+		self.sent = []
+		self.conn = FakeConnection(self)
+	def FindAddr(self, address, countrycode=None):
+		result = GeocoderResult(address, self.name)
+		self.get("/%s" % self.name)
+		if self.precision is not None:
+			result.coordinates = (42.0, -72.0)
+			result.precision = self.precision
+		return result
+
+def run(geocoders):
+	multi = GeocoderMulti(concurrent=True)
+	multi.geocoders = [(geocoder, False) for geocoder in geocoders]
+	multi.geocoder_locks = [threading.Lock() for geocoder in geocoders]
+	result = multi.FindAddr(["1", "Elm Street", "", "Westfield", "MA", ""], bypass_cache=True)
+	time.sleep(1.0)		# give abandoned threads time to do whatever they will do
+	return result
+
+print "=== Precise match from the first geocoder ==="
+first = FakeGeocoder("first", "ROOF", 0.1)
+second = FakeGeocoder("second", "ROOF", 0.1, delay=0.5)
+second.last_request_time = time.time()		# must wait before sending
+metered = FakeGeocoder("metered", "ROOF", 0.1, metered=True)
+result = run([first, second, metered])
+print "Source:", result.source
+for geocoder in (first, second, metered):
+	print "%s: %d request(s) sent" % (geocoder.name, len(geocoder.sent))
+assert result.source == "first"
+assert len(second.sent) == 0
+assert len(metered.sent) == 0
+
+print "=== Only an interpolated match before the metered geocoder ==="
+first = FakeGeocoder("first", None, 0.1)
+second = FakeGeocoder("second", "INTERPOLATED", 0.1)
+metered = FakeGeocoder("metered", "ROOF", 0.1, metered=True)
+result = run([first, second, metered])
+print "Source:", result.source
+for geocoder in (first, second, metered):
+	print "%s: %d request(s) sent" % (geocoder.name, len(geocoder.sent))
+assert result.source == "metered"
+assert len(metered.sent) == 1
@@ -0,0 +1,58 @@
+#! /usr/bin/python
+# Write a Mapbox Vector Tile and read it back
+
+from __future__ import print_function
+import sys
+import json
+sys.path.insert(1, "../..")
+from pykarta.formats.mvt import MvtWriter, MvtTile
+
+#============================================================================
+
+def feature(properties):
+	return {
+		'type': 'Feature',
+		'geometry': {'type': 'Point', 'coordinates': [-72.68, 41.77]},
+		'properties': properties,
+		}
+
+print("=== Scalar and nested properties ===")
+writer = MvtWriter(15, 9769, 12176)
+writer.add_layer("test", [
+	feature({'name': u'Elm Street', 'lanes': 2, 'width': 7.5, 'oneway': True,
+		'ref': ['US 5', 'MA 10'], 'tags': {'surface': 'asphalt', 'lit': 'yes'}}),
+	feature({'ref': ['US 5', 'MA 10'], 'tags': {'lit': 'yes', 'surface': 'asphalt'}}),
+	])
+layer = MvtTile(writer.getvalue()).get("test")
+for decoded in layer.features:
+	print(decoded.properties)
+properties = layer.features[0].properties
+assert properties['name'] == u'Elm Street'
+assert properties['lanes'] == 2 and properties['width'] == 7.5 and properties['oneway'] is True
+assert json.loads(properties['ref']) == ['US 5', 'MA 10']
+assert json.loads(properties['tags']) == {'surface': 'asphalt', 'lit': 'yes'}
+# The same nested value is stored once, however its keys are ordered.
+assert layer.features[1].properties['ref'] == properties['ref']
+assert layer.features[1].properties['tags'] == properties['tags']
+assert layer.features[1].properties['name'] is None
+
+print("=== Properties which are None ===")
+writer = MvtWriter(15, 9769, 12176)
+writer.add_layer("test", [
+	feature({'waterway': None, 'name': None}),
+	feature({'waterway': 'stream', 'name': None}),
+	])
+layer = MvtTile(writer.getvalue()).get("test")
+for decoded in layer.features:
+	print(decoded.properties)
+assert layer.features[0].properties == {'waterway': None, 'name': None}
+assert layer.features[1].properties == {'waterway': 'stream', 'name': None}
+
+print("=== Value which cannot be stored ===")
+writer = MvtWriter(15, 9769, 12176)
+try:
+	writer.add_layer("test", [feature({'members': set([1, 2])})])
+except TypeError as e:
+	print("TypeError:", e)
+else:
+	raise AssertionError("set accepted")
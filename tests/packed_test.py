@@ -0,0 +1,94 @@
+#! /usr/bin/python
+# Check that PackedPoints behaves like a list of (x, y) tuples
+
+from __future__ import print_function
+import sys
+sys.path.insert(1, "../..")
+
+from pykarta.geometry.packed import PackedPoints, new_coords_buffer
+from pykarta.geometry.projection import project_to_tilespace_pixels_flat
+from pykarta.draw import line_string, place_line_label
+
+#============================================================================
+
+# Three features sharing one buffer, as in a vector tile
+lines = [
+	[(0.0, 0.0), (10.0, 0.0), (10.0, 20.0)],
+	[(5.5, 6.5)],
+	[(100.0, 50.0), (200.0, 50.0), (200.0, 150.0), (100.0, 150.0)],
+	]
+coords = new_coords_buffer()
+packed = [PackedPoints.pack(coords, [value for point in line for value in point]) for line in lines]
+
+print("=== Per-feature offsets ===")
+for p in packed:
+	print(p.start, p.end)
+assert [(p.start, p.end) for p in packed] == [(0, 6), (6, 8), (8, 16)]
+assert len(coords) == 16
+
+print("=== Indexing and iteration ===")
+for p, line in zip(packed, lines):
+	print(list(p))
+	assert len(p) == len(line)
+	assert list(p) == line
+	assert [p[i] for i in range(len(p))] == line
+	assert p[-1] == line[-1]
+	for i in (len(line), -len(line) - 1):
+		try:
+			p[i]
+		except IndexError:
+			pass
+		else:
+			raise AssertionError("index %d accepted" % i)
+assert packed[2].get_bbox() == (100.0, 50.0, 200.0, 150.0)
+
+print("=== Scaled view ===")
+scaled = packed[0].scaled(2.0)
+print(list(scaled))
+assert list(scaled) == [(0.0, 0.0), (20.0, 0.0), (20.0, 40.0)]
+assert scaled[1] == (20.0, 0.0)
+assert list(packed[0]) == lines[0]		# not changed
+
+print("=== From projected coordinate lists ===")
+coordinate_lists = [
+	[[-72.765, 42.123], [-72.760, 42.125]],
+	[[-72.750, 42.120], [-72.755, 42.121], [-72.758, 42.127]],
+	]
+coords = new_coords_buffer()
+coords.extend(project_to_tilespace_pixels_flat(coordinate_lists, 14, 4880, 6074))
+start = 0
+for coordinates in coordinate_lists:
+	end = start + len(coordinates) * 2
+	p = PackedPoints(coords, start, end)
+	assert len(p) == len(coordinates)
+	assert list(p) == [(coords[i], coords[i+1]) for i in range(start, end, 2)]
+	start = end
+assert start == len(coords)
+print("OK")
+
+#============================================================================
+
+# Records the path which is drawn
+class PathRecorder(object):
+	def __init__(self):
+		self.path = []
+	def move_to(self, x, y):
+		self.path.append(('move_to', x, y))
+	def line_to(self, x, y):
+		self.path.append(('line_to', x, y))
+
+print("=== Drawing ===")
+for p, line in zip(packed, lines):
+	ctx = PathRecorder()
+	line_string(ctx, p)
+	print(ctx.path)
+	assert ctx.path == [('move_to',) + line[0]] + [('line_to',) + point for point in line[1:]]
+
+print("=== Line labels ===")
+for p, line in ((packed[0], lines[0]), (packed[2], lines[2]), (packed[2].scaled(0.5), [(x*0.5, y*0.5) for x, y in lines[2]])):
+	placement = place_line_label(p, "Elm Street", fontsize=8)
+	print(placement)
+	assert placement == place_line_label(line, "Elm Street", fontsize=8)
+assert place_line_label(packed[0], "Elm Street", fontsize=8) is None		# too short
+assert place_line_label(packed[2], "Elm Street", fontsize=8, tilesize=256) is not None
+assert place_line_label(packed[2].scaled(2.0), "Elm Street", fontsize=8, tilesize=256) is None
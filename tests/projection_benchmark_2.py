@@ -48,3 +48,19 @@ print("Starting optimized test...")
 seconds = timeit.timeit('optimized_project_to_tilespace_pixels(points, 0, 0, 0)', number=100, setup="from __main__ import optimized_project_to_tilespace_pixels, points")
 print("%d points/second" % (len(points) * 100 / seconds))
 
+
+# Batched projection as used by MapGeoJSONTile. This uses NumPy if it is installed.
+from pykarta.geometry import projection
+from pykarta.geometry.projection import project_to_tilespace_pixels_flat
+print(list(project_to_tilespace_pixels_flat([[[-72.765, 42.123]]], 14, 4880, 6074)))
+
+print("Starting batched test (NumPy %s)..." % ("available" if projection.numpy is not None else "not available"))
+lines = [points[i:i+100] for i in range(0, len(points), 100)]
+seconds = timeit.timeit('project_to_tilespace_pixels_flat(lines, 0, 0, 0)', number=100, setup="from __main__ import project_to_tilespace_pixels_flat, lines")
+print("%d points/second" % (len(points) * 100 / seconds))
+
+if projection.numpy is not None:
+	print("Starting batched test without NumPy...")
+	projection.numpy = None
+	seconds = timeit.timeit('project_to_tilespace_pixels_flat(lines, 0, 0, 0)', number=100, setup="from __main__ import project_to_tilespace_pixels_flat, lines")
+	print("%d points/second" % (len(points) * 100 / seconds))
@@ -0,0 +1,72 @@
+#! /usr/bin/python
+# Check the batch projection functions against project_to_tilespace(),
+# both with NumPy (if it is installed) and without it.
+
+from __future__ import print_function
+import sys
+sys.path.insert(1, "../..")
+
+from pykarta.geometry import projection
+from pykarta.geometry.projection import project_to_tilespace, project_to_tilespace_pixels_flat
+
+numpy_module = projection.numpy
+
+# Enough points that the NumPy code is used
+coordinates = [[-72.765 + i * 0.0001, 42.123 + i * 0.0001] for i in range(projection.numpy_threshold * 2)]
+lines = [coordinates[:40], coordinates[40:]]
+zoom, xtile, ytile = 14, 4880, 6074
+
+def near(a, b, tolerance):
+	return abs(a - b) <= tolerance
+
+def check_flat(lines, label):
+	flat = project_to_tilespace_pixels_flat(lines, zoom, xtile, ytile)
+	assert len(flat) == len(coordinates) * 2, label
+	for i, p in enumerate(coordinates):
+		x, y = project_to_tilespace(p[1], p[0], zoom)
+		# The results are single-precision floats.
+		assert near(flat[i*2], (x - xtile) * 256.0, 0.01), label
+		assert near(flat[i*2+1], (y - ytile) * 256.0, 0.01), label
+	print(label, "OK")
+
+for use_numpy in (True, False):
+	if use_numpy and numpy_module is None:
+		print("NumPy is not installed")
+		continue
+	projection.numpy = numpy_module if use_numpy else None
+	label = "with NumPy" if use_numpy else "without NumPy"
+
+	print("=== project_to_tilespace_pixels_flat() %s ===" % label)
+	check_flat(lines, "[lon, lat]")
+	check_flat([[p + [100.0] for p in line] for line in lines], "[lon, lat, z]")
+
+projection.numpy = numpy_module
+
+# The same for the projection of points to the screen
+import tempfile
+from pykarta.geometry import Point
+from pykarta.maps.base import MapCairo
+
+map_obj = MapCairo(tile_source=None, tile_cache_basedir=tempfile.mkdtemp())
+map_obj.set_size(1024, 768)
+map_obj.set_center_and_zoom(42.13, -72.75, 14)
+points = [Point(p[1], p[0]) for p in coordinates]
+expected = [map_obj.project_point(point) for point in points]
+
+for use_numpy in (True, False):
+	if use_numpy and numpy_module is None:
+		continue
+	projection.numpy = numpy_module if use_numpy else None
+	label = "with NumPy" if use_numpy else "without NumPy"
+
+	print("=== MapBase.project_points() %s ===" % label)
+	for name, arg in (("list", points), ("iterator", iter(points)), ("generator", (point for point in points))):
+		result = map_obj.project_points(arg)
+		assert len(result) == len(expected), name
+		for (x, y), (x2, y2) in zip(result, expected):
+			# The rounding of the two may differ where a point
+			# falls right on a pixel boundary.
+			assert near(x, x2, 1) and near(y, y2, 1), name
+		print(name, "OK")
+
+projection.numpy = numpy_module